@@ -0,0 +1,212 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Columns of the database the aggregates can be grouped by
+GROUP_COLUMNS = ['award', 'tier', 'wg', 'sq', 'user']
+
+# Running sums kept per group. The errors are the differences between GPT's score and the user's one, for the
+# evaluations that have both.
+STATISTICS = ['count', 'score_count', 'score_sum', 'score_squares', 'pair_count', 'error_sum', 'absolute_error_sum',
+              'squared_error_sum', 'prompt_tokens', 'completion_tokens']
+_S = {name: i for i, name in enumerate(STATISTICS)}
+
+# Score histogram bins: 0, 0.5, ..., 20
+BIN_WIDTH = 0.5
+N_BINS = int(20 / BIN_WIDTH) + 1
+
+TREND_FREQUENCIES = {'day': 'D', 'week': 'W', 'month': 'M'}
+
+
+class _Aggregates:
+    """
+    Running statistics and score histograms of groups of evaluations, one row per group key, in numpy arrays that
+    grow as new keys appear.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._keys = []
+        self.statistics = np.zeros((0, len(STATISTICS)))
+        self.histograms = np.zeros((0, N_BINS), dtype=np.int64)
+
+    def keys(self):
+        return list(self._keys)
+
+    def get(self, key):
+        return self._index.get(key)
+
+    def codes(self, keys):
+        """
+        Row numbers of the keys (an array of unique keys), adding rows for the new ones.
+        """
+        new_keys = [key for key in keys if key not in self._index]
+        if new_keys:
+            for key in new_keys:
+                self._index[key] = len(self._keys)
+                self._keys.append(key)
+            self.statistics = np.vstack([self.statistics, np.zeros((len(new_keys), len(STATISTICS)))])
+            self.histograms = np.vstack([self.histograms, np.zeros((len(new_keys), N_BINS), dtype=np.int64)])
+        return np.array([self._index[key] for key in keys], dtype=np.int64)
+
+    def add(self, codes, statistics, bins):
+        n = len(self._keys)
+        for i in range(len(STATISTICS)):
+            self.statistics[:, i] += np.bincount(codes, weights=statistics[:, i], minlength=n)
+        scored = bins >= 0
+        self.histograms += np.bincount(codes[scored] * N_BINS + bins[scored],
+                                       minlength=n * N_BINS).reshape(n, N_BINS)
+
+
+def _factorize(values):
+    # Integer codes of the values and the unique values, with missing values as a None key
+    values = pd.Series(values).astype(object)
+    codes, uniques = pd.factorize(values.where(values.notna(), None))
+    uniques = list(uniques)
+    if (codes < 0).any():
+        uniques.append(None)
+        codes = np.where(codes < 0, len(uniques) - 1, codes)
+    return codes, uniques
+
+
+class ScoreAnalytics:
+    """
+    Precomputed aggregates of the evaluation database for the dashboards: for all the evaluations and per award,
+    tier, wing, squadron and user, the running counts and sums of the scores, of the tokens and of the calibration
+    errors against the users' scores, a histogram of the scores, and the same per day for the trends. Adding
+    evaluations updates the aggregates with a few vectorized operations over the new rows only, and the queries
+    only read the aggregates, so their cost does not depend on the size of the database.
+    """
+
+    def __init__(self):
+        self._totals = {column: _Aggregates() for column in [None] + GROUP_COLUMNS}
+        self._days = {column: _Aggregates() for column in [None] + GROUP_COLUMNS}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def add(self, rows):
+        """
+        Adds the rows (a DataFrame with the database columns) to the aggregates.
+        """
+        if len(rows) == 0:
+            return
+
+        score = pd.to_numeric(rows['score'], errors='coerce').to_numpy(dtype=float)
+        user_score = pd.to_numeric(rows['user_score'], errors='coerce').to_numpy(dtype=float)
+        has_score = ~np.isnan(score)
+        has_pair = has_score & ~np.isnan(user_score)
+        error = np.where(has_pair, score - np.nan_to_num(user_score), 0.0)
+
+        statistics = np.zeros((len(rows), len(STATISTICS)))
+        statistics[:, _S['count']] = 1
+        statistics[:, _S['score_count']] = has_score
+        statistics[:, _S['score_sum']] = np.where(has_score, score, 0.0)
+        statistics[:, _S['score_squares']] = np.where(has_score, score, 0.0) ** 2
+        statistics[:, _S['pair_count']] = has_pair
+        statistics[:, _S['error_sum']] = error
+        statistics[:, _S['absolute_error_sum']] = np.abs(error)
+        statistics[:, _S['squared_error_sum']] = error ** 2
+        for column in ('prompt_tokens', 'completion_tokens'):
+            statistics[:, _S[column]] = np.nan_to_num(pd.to_numeric(rows[column], errors='coerce')
+                                                      .to_numpy(dtype=float))
+
+        bins = np.where(has_score, np.clip(np.round(np.nan_to_num(score) / BIN_WIDTH), 0, N_BINS - 1), -1)
+        bins = bins.astype(np.int64)
+
+        # Days since the epoch, missing times fall on day 0
+        times = pd.to_datetime(rows['datetime'], errors='coerce').to_numpy(dtype='datetime64[D]')
+        days = np.where(np.isnat(times), 0, times.astype(np.int64))
+        first_day, n_days = days.min(), days.max() - days.min() + 1
+
+        for column in [None] + GROUP_COLUMNS:
+            if column is None:
+                value_codes, values = np.zeros(len(rows), dtype=np.int64), [None]
+            else:
+                value_codes, values = _factorize(rows[column])
+
+            codes = self._totals[column].codes(values)[value_codes]
+            self._totals[column].add(codes, statistics, bins)
+
+            # One key per value and day, for the trends
+            pair_codes, pairs = pd.factorize(value_codes * n_days + (days - first_day))
+            value_codes_of_pairs, days_of_pairs = np.divmod(pairs, n_days)
+            keys = [(values[value_code], int(day + first_day))
+                    for value_code, day in zip(value_codes_of_pairs, days_of_pairs)]
+            codes = self._days[column].codes(keys)[pair_codes]
+            self._days[column].add(codes, statistics, bins)
+
+        self._length += len(rows)
+        logging.info(f'Added {len(rows)} rows to the analytics, which cover {len(self)} rows.')
+
+    def summary(self, column=None):
+        """
+        One row per value of the column (award, tier, wg, sq or user; None for all the evaluations at once):
+        number of evaluations, mean, standard deviation and median of the scores, and the calibration against the
+        users' scores: number of evaluations with both scores, mean error (GPT's score minus the user's one), mean
+        absolute error and root mean squared error. Also the mean tokens per evaluation.
+        """
+        aggregates = self._totals[column]
+        return self._frame(aggregates.statistics, aggregates.histograms,
+                           pd.Index(aggregates.keys(), name=column or 'all'))
+
+    def histogram(self, column=None, value=None):
+        """
+        Number of scores in every bin (0, 0.5, ..., 20) of the evaluations with the given value of the column (all
+        the evaluations by default), as a Series.
+        """
+        aggregates = self._totals[column]
+        code = aggregates.get(value)
+        counts = aggregates.histograms[code] if code is not None else np.zeros(N_BINS, dtype=np.int64)
+        return pd.Series(counts, index=pd.Index(np.arange(N_BINS) * BIN_WIDTH, name='score'), name='count')
+
+    def trend(self, column=None, value=None, frequency='day'):
+        """
+        Evolution of the evaluations with the given value of the column (all the evaluations by default): one row
+        per day, week or month, with the same statistics as summary.
+        """
+        aggregates = self._days[column]
+        keys = [key for key in aggregates.keys() if key[0] == value]
+        if not keys:
+            return self._frame(np.zeros((0, len(STATISTICS))), np.zeros((0, N_BINS), dtype=np.int64),
+                               pd.DatetimeIndex([], name='date'))
+
+        codes = np.array([aggregates.get(key) for key in keys])
+        dates = pd.to_datetime(np.array([day for _, day in keys], dtype='datetime64[D]'))
+        periods = dates.to_period(TREND_FREQUENCIES[frequency]).to_timestamp()
+        period_codes, unique_periods = pd.factorize(periods, sort=True)
+
+        statistics = np.zeros((len(unique_periods), len(STATISTICS)))
+        histograms = np.zeros((len(unique_periods), N_BINS), dtype=np.int64)
+        np.add.at(statistics, period_codes, aggregates.statistics[codes])
+        np.add.at(histograms, period_codes, aggregates.histograms[codes])
+        return self._frame(statistics, histograms, pd.DatetimeIndex(unique_periods, name='date'))
+
+    @staticmethod
+    def _frame(statistics, histograms, index):
+        s = {name: statistics[:, i] for name, i in _S.items()}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = s['score_sum'] / s['score_count']
+            variance = np.maximum(s['score_squares'] / s['score_count'] - mean ** 2, 0)
+            frame = pd.DataFrame({'count': s['count'].astype(np.int64),
+                                  'mean_score': mean,
+                                  'std_score': np.sqrt(variance),
+                                  'median_score': _histogram_median(histograms),
+                                  'calibration_count': s['pair_count'].astype(np.int64),
+                                  'mean_error': s['error_sum'] / s['pair_count'],
+                                  'mean_absolute_error': s['absolute_error_sum'] / s['pair_count'],
+                                  'rmse': np.sqrt(s['squared_error_sum'] / s['pair_count']),
+                                  'mean_prompt_tokens': s['prompt_tokens'] / s['count'],
+                                  'mean_completion_tokens': s['completion_tokens'] / s['count']},
+                                 index=index)
+        return frame.sort_index() if not isinstance(index, pd.DatetimeIndex) else frame
+
+
+def _histogram_median(histograms):
+    # Lower median, at the resolution of the bins
+    totals = histograms.sum(axis=1)
+    cumulative = np.cumsum(histograms, axis=1)
+    medians = np.argmax(cumulative * 2 >= totals[:, None], axis=1) * BIN_WIDTH
+    return np.where(totals > 0, medians, np.nan)
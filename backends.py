@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+
+# Roles of the requests the engine makes, each routed to a backend: the final grade, and a cheap first look at a
+# statement (e.g., by a local model) before spending a remote request on it
+GRADE = 'grade'
+PRESCREEN = 'prescreen'
+
+
+class BackendError(Exception):
+    """
+    Error of a backend that is not the OpenAI module (those raise openai.error.OpenAIError).
+    """
+
+    def __init__(self, message, headers=None):
+        super().__init__(message)
+        self.headers = headers or {}
+
+
+class RetryableBackendError(BackendError):
+    """
+    Error worth retrying: rate limits, server errors and network hiccups.
+    """
+
+
+class LLMBackend:
+    """
+    A chat completion backend. chat() takes OpenAI style messages and returns an OpenAI style response (a dictionary
+    with choices and usage), or an iterator of response chunks if stream is True. Every backend gets its own
+    request scheduler in the engine, with max_concurrency workers and the backend's rate limits (None: unlimited).
+    """
+
+    name = 'backend'
+
+    def __init__(self, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None, model=None):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # Model to ask for, instead of the engine's GPT engine parameter
+        self.model = model
+
+    def chat(self, messages, parameters, max_tokens, stream=False, n=1, timeout=None, api_key=None):
+        raise NotImplementedError
+
+    def model_for(self, parameters):
+        return self.model or parameters['engine']
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    The OpenAI API, through the openai module. The key and base URL are passed with every request instead of being
+    set on the module, so that sessions can use their own key. The openai module keeps one HTTP session (and its
+    connection pool) per thread, and the scheduler's workers are long lived, so connections are reused.
+    """
+
+    name = 'openai'
+
+    def __init__(self, api_key=None, api_base=None, max_concurrency=8, requests_per_minute=3500,
+                 tokens_per_minute=90000, model=None):
+        super().__init__(max_concurrency, requests_per_minute, tokens_per_minute, model)
+        # Without an explicit key, use the same environment variable as the openai module
+        self.api_key = api_key if api_key is not None else os.environ.get('OPENAI_API_KEY')
+        self.api_base = api_base
+
+    def chat(self, messages, parameters, max_tokens, stream=False, n=1, timeout=None, api_key=None):
+        import openai
+
+        # The session's key, if any, or the backend's one
+        key_arguments = {'api_key': api_key or self.api_key}
+        if self.api_base is not None:
+            key_arguments['api_base'] = self.api_base
+
+        return openai.ChatCompletion.create(
+            model = self.model_for(parameters),
+            messages = messages,
+            temperature = parameters['temperature'],
+            top_p = parameters['top_p'],
+            stream = stream,
+            stop = parameters['stop'],
+            max_tokens = max_tokens,
+            presence_penalty = parameters['presence_penalty'],
+            frequency_penalty = parameters['frequency_penalty'],
+            n = n,
+            request_timeout = timeout,
+            **key_arguments
+        )
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Any server implementing OpenAI's chat completion endpoint, e.g., a local vLLM, llama.cpp or Ollama server, at
+    base_url (e.g., http://localhost:8000/v1). Requests go through a requests session whose connection pool holds
+    max_concurrency connections.
+    """
+
+    name = 'openai-compatible'
+
+    def __init__(self, base_url, api_key=None, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None,
+                 model=None):
+        super().__init__(max_concurrency, requests_per_minute, tokens_per_minute, model)
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def chat(self, messages, parameters, max_tokens, stream=False, n=1, timeout=None, api_key=None):
+        import requests
+
+        payload = {'model': self.model_for(parameters),
+                   'messages': messages,
+                   'temperature': parameters['temperature'],
+                   'top_p': parameters['top_p'],
+                   'max_tokens': max_tokens,
+                   'presence_penalty': parameters['presence_penalty'],
+                   'frequency_penalty': parameters['frequency_penalty'],
+                   'n': n,
+                   'stream': stream}
+        if parameters['stop'] is not None:
+            payload['stop'] = parameters['stop']
+        headers = {'Authorization': f'Bearer {api_key or self.api_key}'} if (api_key or self.api_key) else {}
+
+        try:
+            response = self._session.post(f'{self.base_url}/chat/completions', json=payload, headers=headers,
+                                          timeout=timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableBackendError(f'{self.base_url} is unreachable: {e}') from e
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableBackendError(f'{self.base_url} answered {response.status_code}: {response.text[:200]}',
+                                        headers={k.lower(): v for k, v in response.headers.items()})
+        if response.status_code >= 400:
+            raise BackendError(f'{self.base_url} answered {response.status_code}: {response.text[:200]}')
+
+        if stream:
+            return self._chunks(response)
+        return response.json()
+
+    @staticmethod
+    def _chunks(response):
+        # Server-sent events, one JSON chunk per data line
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                yield json.loads(data)
+
+
+class LocalModelBackend(LLMBackend):
+    """
+    A model run in-process on the CPU with llama.cpp (the llama_cpp module, optional), from a GGUF file. The model is
+    loaded on the first request. A llama.cpp context serves one request at a time, so requests are serialized.
+    """
+
+    name = 'local'
+
+    def __init__(self, model_path, n_ctx=4096, n_threads=None, model=None):
+        super().__init__(max_concurrency=1, model=model or os.path.basename(model_path))
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+
+        self._llama = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._llama is None:
+            try:
+                from llama_cpp import Llama
+            except ImportError:
+                raise ImportError('The local model backend requires llama-cpp-python '
+                                  '(pip install llama-cpp-python).') from None
+            self._llama = Llama(model_path=self.model_path, n_ctx=self.n_ctx, n_threads=self.n_threads,
+                                verbose=False)
+            logging.info(f'Loaded local model {self.model_path}.')
+        return self._llama
+
+    def chat(self, messages, parameters, max_tokens, stream=False, n=1, timeout=None, api_key=None):
+        arguments = dict(messages=messages,
+                         temperature=parameters['temperature'],
+                         top_p=parameters['top_p'],
+                         max_tokens=max_tokens,
+                         stop=parameters['stop'] or [],
+                         presence_penalty=parameters['presence_penalty'],
+                         frequency_penalty=parameters['frequency_penalty'])
+        if stream:
+            return self._stream(arguments)
+
+        with self._lock:
+            llama = self._load()
+            responses = [llama.create_chat_completion(**arguments) for _ in range(n)]
+        return {'model': self.model,
+                'choices': [dict(response['choices'][0], index=i) for i, response in enumerate(responses)],
+                'usage': {'prompt_tokens': responses[0]['usage']['prompt_tokens'],
+                          'completion_tokens': sum(r['usage']['completion_tokens'] for r in responses)}}
+
+    def _stream(self, arguments):
+        with self._lock:
+            yield from self._load().create_chat_completion(stream=True, **arguments)
@@ -0,0 +1,235 @@
+"""
+End-to-end benchmark of the evaluation pipeline against the fake chat completion server (fake_llm.py):
+
+    python benchmarks/bench_pipeline.py --latency 0.2 --statements 100 --output pipeline.json
+
+Workloads:
+    single    statements graded one after the other, as in the app
+    batch     statements graded at once with extract_evaluations
+    cached    the same batch again, served from the completion cache
+    sessions  several sessions grading and committing concurrently
+    commit    cost of committing an evaluation (and of loading and compacting) as the database grows
+
+The report (JSON) has the throughput and latency percentiles of every workload, the engine's per-stage timings,
+and the commit costs per database size, so that two runs can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_llm import FakeLLMServer, canned_reply  # noqa: E402
+
+ACTIONS = ('Led', 'Managed', 'Trained', 'Briefed', 'Coordinated', 'Streamlined', 'Deployed', 'Mentored')
+OBJECTS = ('Amn', 'analysts', 'sorties', 'intel reports', 'training events', 'inspections')
+RESULTS = ('saved', 'cut', 'enabled', 'delivered', 'secured')
+
+
+def statements(n, offset=0):
+    """
+    n distinct, deterministic performance statements.
+    """
+    return [f'- {ACTIONS[i % len(ACTIONS)]} {5 + i % 40} {OBJECTS[i % len(OBJECTS)]} for mission {offset + i}; '
+            f'{RESULTS[i % len(RESULTS)]} {10 + i % 90} hrs /// boosted wing readiness'
+            for i in range(offset, offset + n)]
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{int(q * 100)}': values[min(len(values) - 1, int(q * len(values)))] for q in (0.5, 0.95, 0.99)}
+
+
+def make_engine(directory, url, workers, cache=False, database_file_path=None):
+    from engine import EvaluatorEngine
+
+    return EvaluatorEngine(api_key='fake', api_base=url,
+                           database_file_path=database_file_path or os.path.join(directory, 'database.csv'),
+                           lookup_file_path=os.path.join(directory, 'lookup.csv'),
+                           cache_file_path=os.path.join(directory, 'cache.sqlite') if cache else None,
+                           max_concurrent_requests=workers,
+                           requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9)
+
+
+def run_single(engine, texts):
+    session = engine.new_session()
+    latencies = []
+    start = time.perf_counter()
+    for text in texts:
+        t = time.perf_counter()
+        session.extract_evaluation(text, 'bench', None)
+        session.commit()
+        latencies.append(time.perf_counter() - t)
+    return _result(len(texts), time.perf_counter() - start, latencies)
+
+
+def run_batch(engine, texts):
+    session = engine.new_session()
+    start = time.perf_counter()
+    session.extract_evaluations(texts, 'bench')
+    session.commit_batch()
+    return _result(len(texts), time.perf_counter() - start)
+
+
+def run_sessions(engine, texts, n_sessions):
+    latencies = []
+    lock = threading.Lock()
+
+    def work(session_texts):
+        session = engine.new_session()
+        for text in session_texts:
+            t = time.perf_counter()
+            session.extract_evaluation(text, 'bench', None)
+            session.commit()
+            with lock:
+                latencies.append(time.perf_counter() - t)
+
+    threads = [threading.Thread(target=work, args=(texts[i::n_sessions],)) for i in range(n_sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return _result(len(texts), time.perf_counter() - start, latencies)
+
+
+def _result(n, elapsed, latencies=None):
+    result = {'n': n, 'seconds': elapsed, 'per_second': n / elapsed if elapsed > 0 else None}
+    if latencies:
+        result['latency'] = percentiles(latencies)
+    return result
+
+
+def synthetic_database(n_rows):
+    """
+    Database of n_rows evaluations, quick to build even for millions of rows.
+    """
+    import numpy as np
+    import pandas as pd
+    from storage import DATABASE_COLUMNS
+
+    replies = [canned_reply(text) for text in statements(16)]
+    ids = np.arange(n_rows)
+    database = pd.DataFrame({
+        'statement': [f'- Led {i % 40} Amn for mission {i}; saved {i % 90} hrs' for i in range(n_rows)],
+        'score': (ids % 17 + 4).astype(float),
+        'user_score': np.where(ids % 3 == 0, np.nan, ids % 21),
+        'explanation': [replies[i % len(replies)].rsplit('Total Score', 1)[0].strip() for i in range(n_rows)],
+        'award': 'Performer of the Month', 'tier': 'Amn', 'wg': '480 ISRW', 'sq': '30 IS', 'user': 'bench',
+        'datetime': pd.Timestamp('2023-01-01') + pd.to_timedelta(ids, unit='m'),
+        'prompt_tokens': 3000, 'completion_tokens': 120,
+    })
+    return database.reindex(columns=DATABASE_COLUMNS)
+
+
+def run_commit(directory, url, sizes, compact):
+    """
+    For every size, commits an evaluation to a database of that many rows, before the database is loaded (only the
+    file is appended to) and after, and times the load and optionally the compaction.
+    """
+    from storage import open_store
+
+    results = []
+    for size in sizes:
+        database_file_path = os.path.join(directory, f'database_{size}.csv')
+        open_store(database_file_path).compact(synthetic_database(size))
+        file_mb = os.path.getsize(database_file_path) / 2 ** 20
+
+        engine = make_engine(directory, url, workers=1, cache=True, database_file_path=database_file_path)
+        session = engine.new_session()
+        session.extract_evaluation(statements(1)[0], 'bench', None)
+        commit_statement = session._current_extracted_statement
+
+        def timed(function):
+            start = time.perf_counter()
+            function()
+            return time.perf_counter() - start
+
+        result = {'rows': size, 'file_mb': file_mb}
+        result['commit_cold'] = timed(lambda: engine.insert_evaluations([commit_statement]))
+        result['load'] = timed(engine.database_size)
+        result['commit_warm'] = timed(lambda: engine.insert_evaluations([commit_statement]))
+        if compact:
+            result['compact'] = timed(engine.compact)
+        results.append(result)
+        print(f'commit    {size:>9} rows: ' + ', '.join(f'{k} {v * 1000:.1f} ms' for k, v in result.items()
+                                                       if k not in ('rows', 'file_mb')), file=sys.stderr)
+        os.remove(database_file_path)
+    return results
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'time': datetime.now().isoformat(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'revision': revision}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the evaluation pipeline against a fake GPT server.')
+    parser.add_argument('--workloads', default='single,batch,cached,sessions,commit',
+                        help='Comma separated workloads to run.')
+    parser.add_argument('--statements', type=int, default=50, help='Statements graded per workload.')
+    parser.add_argument('--workers', type=int, default=8, help='Maximum concurrent GPT requests of the engine.')
+    parser.add_argument('--sessions', type=int, default=4, help='Concurrent sessions of the sessions workload.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fixed latency of the fake server, in seconds.')
+    parser.add_argument('--tokens-per-second', type=float, default=None, help='Generation speed of the fake server.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the requests that fail.')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000,1000000',
+                        help='Database sizes of the commit workload.')
+    parser.add_argument('--compact', action='store_true', help='Also time the compaction in the commit workload.')
+    parser.add_argument('--output', default=None, help='File to write the JSON report to (default: stdout).')
+    args = parser.parse_args(argv)
+    workloads = args.workloads.split(',')
+
+    report = {'environment': environment(), 'config': vars(args), 'workloads': {}}
+    with tempfile.TemporaryDirectory() as directory, \
+            FakeLLMServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                          error_rate=args.error_rate) as server:
+        # Every workload grades new statements, so none of them is served from another one's cache
+        engine = make_engine(directory, server.url, args.workers, cache=True)
+        runs = {'single': lambda: run_single(engine, statements(args.statements, offset=0)),
+                'batch': lambda: run_batch(engine, statements(args.statements, offset=10 ** 6)),
+                'cached': lambda: run_batch(engine, statements(args.statements, offset=10 ** 6)),
+                'sessions': lambda: run_sessions(engine, statements(args.statements, offset=2 * 10 ** 6),
+                                                 args.sessions)}
+        for name in workloads:
+            if name not in runs:
+                continue
+            engine.metrics.reset()
+            result = runs[name]()
+            result['stages'] = engine.metrics.summary()
+            result['counters'] = engine.metrics.counters()
+            report['workloads'][name] = result
+            print(f'{name:>9}: {result["n"]} statements in {result["seconds"]:.2f} s '
+                  f'({result["per_second"]:.1f}/s)', file=sys.stderr)
+
+        if 'commit' in workloads:
+            report['workloads']['commit'] = run_commit(directory, server.url,
+                                                       [int(size) for size in args.sizes.split(',')], args.compact)
+        report['server'] = {'requests': server.n_requests, 'errors': server.n_errors}
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
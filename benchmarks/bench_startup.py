@@ -0,0 +1,91 @@
+"""
+Startup time of the evaluator, i.e., what a container restart or a new replica pays before serving:
+
+    python benchmarks/bench_startup.py --database ./data/default_database.csv --repeat 5
+
+Every run happens in a fresh interpreter, so nothing is cached in sys.modules. The stages are cumulative:
+importing the engine, constructing it, the first database access and the first search (what the first render
+of the app does), and importing the Streamlit app itself if streamlit is installed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+timings = {{}}
+start = time.perf_counter()
+import engine
+timings['import_engine'] = time.perf_counter() - start
+e = engine.EvaluatorEngine(api_key='none', database_file_path={database!r}, cache_file_path={cache!r},
+                           lookup_file_path={lookup!r})
+timings['construct_engine'] = time.perf_counter() - start
+timings['heavy_modules'] = sorted(m for m in ('pandas', 'numpy', 'openai') if m in sys.modules)
+e.database_size()
+timings['first_database_access'] = time.perf_counter() - start
+e.search(None, limit=100)
+timings['first_search'] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+CHILD_APP = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import main
+print(json.dumps({{'import_app': time.perf_counter() - start}}))
+"""
+
+
+def run_child(code):
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the startup time of the evaluator engine.')
+    parser.add_argument('--database', default=os.path.join(ROOT, 'data', 'default_database.csv'))
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters to time.')
+    parser.add_argument('--json', default=None, help='Also write the report to this file.')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Work on a copy, so that a migration of the database does not change the original
+        database = os.path.join(tmp, 'database.csv')
+        if os.path.exists(args.database):
+            with open(args.database, 'rb') as source, open(database, 'wb') as destination:
+                destination.write(source.read())
+        code = CHILD.format(root=ROOT, database=database, cache=os.path.join(tmp, 'cache.sqlite'),
+                            lookup=os.path.join(tmp, 'lookup.csv'))
+        runs = [run_child(code) for _ in range(args.repeat)]
+
+        try:
+            import streamlit  # noqa: F401
+            runs_app = [run_child(CHILD_APP.format(root=ROOT)) for _ in range(args.repeat)]
+        except ImportError:
+            runs_app = []
+
+    report = {'database': args.database, 'repeat': args.repeat,
+              'heavy_modules_after_construct': runs[0]['heavy_modules']}
+    for stage in ('import_engine', 'construct_engine', 'first_database_access', 'first_search'):
+        report[stage] = statistics.median(run[stage] for run in runs)
+    if runs_app:
+        report['import_app'] = statistics.median(run['import_app'] for run in runs_app)
+
+    for stage, value in report.items():
+        if isinstance(value, float):
+            print(f'{stage:>24}: {value * 1000:8.1f} ms')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Load time and memory of the database formats, on a synthetic database of the given size:
+
+    python benchmarks/bench_storage.py --rows 100000 --repeat 3 --json storage.json
+
+Every load happens in a fresh interpreter. The RSS is measured after the imports and after the load, the
+difference is what holding the database costs. The Parquet store needs pyarrow.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHILD = """
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+import pandas, storage
+if {path!r}.endswith('.parquet'):
+    storage._parquet()
+    import pyarrow
+
+def rss():
+    # Current resident set size in kB, from /proc on Linux, the peak one elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+rss_before = rss()
+start = time.perf_counter()
+database = storage.open_store({path!r}).load(**{kwargs!r})
+elapsed = time.perf_counter() - start
+rss_after = rss()
+print(json.dumps({{'load': elapsed, 'rss_mb': (rss_after - rss_before) / 1024, 'rows': len(database)}}))
+"""
+
+WORDS = ('led', 'managed', 'trained', 'Amn', 'mission', 'saved', 'hours', 'sorties', 'intel', 'flight',
+         'analysts', 'readiness', 'briefed', 'wing', 'squadron', 'deployed', 'streamlined', 'program')
+
+
+def synthetic_database(n_rows, seed=0):
+    import pandas as pd
+    from storage import DATABASE_COLUMNS
+
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    rows = []
+    for i in range(n_rows):
+        statement = '- ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(15, 30)))
+        explanation = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(60, 120)))
+        rows.append((statement, rng.randint(0, 40) / 2, rng.choice([None, rng.randint(0, 20)]), explanation,
+                     rng.choice(['Performer of the Month', 'of the Quarter', 'of the Year']),
+                     rng.choice(['Amn', 'NCO', 'SNCO', 'CGO']), rng.choice(['480 ISRW', '363 ISRW']),
+                     rng.choice(['30 IS', '10 IS', '45 IS']), f'user{rng.randint(0, 50)}',
+                     start + timedelta(minutes=i), rng.randint(1000, 2000), rng.randint(100, 400)))
+    # The evaluations of a single sample, without criteria scores
+    return pd.DataFrame(rows, columns=DATABASE_COLUMNS[:12]).reindex(columns=DATABASE_COLUMNS)
+
+
+def run_child(path, **kwargs):
+    code = CHILD.format(root=ROOT, path=path, kwargs=kwargs)
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the CSV and Parquet database formats.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help='Number of fresh interpreters per measurement.')
+    parser.add_argument('--json', default=None, help='Also write the report to this file.')
+    args = parser.parse_args(argv)
+
+    from storage import open_store
+
+    report = {'rows': args.rows, 'repeat': args.repeat}
+    with tempfile.TemporaryDirectory() as tmp:
+        database = synthetic_database(args.rows)
+        cases = {'csv': (os.path.join(tmp, 'database.csv'), {})}
+        try:
+            import pyarrow  # noqa: F401
+            path = os.path.join(tmp, 'database.parquet')
+            cases['parquet'] = (path, {})
+            cases['parquet_scores_only'] = (path, {'columns': ['score', 'award', 'tier', 'datetime']})
+        except ImportError:
+            print('pyarrow is not installed, only measuring the CSV format.', file=sys.stderr)
+
+        for path in {path for path, _ in cases.values()}:
+            open_store(path).compact(database)
+
+        for name, (path, kwargs) in cases.items():
+            runs = [run_child(path, **kwargs) for _ in range(args.repeat)]
+            size = sum(os.path.getsize(os.path.join(dir_path, f)) for dir_path, _, files in os.walk(path)
+                       for f in files) if os.path.isdir(path) else os.path.getsize(path)
+            report[name] = {'load_s': statistics.median(run['load'] for run in runs),
+                            'rss_mb': statistics.median(run['rss_mb'] for run in runs),
+                            'file_mb': size / 2 ** 20}
+            print(f'{name:>20}: load {report[name]["load_s"] * 1000:8.1f} ms, '
+                  f'RSS +{report[name]["rss_mb"]:7.1f} MB, file {report[name]["file_mb"]:7.1f} MB')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Deterministic stand-in for the OpenAI chat completion endpoint, to benchmark the engine without the network:
+
+    python benchmarks/fake_llm.py --port 8099 --latency 0.2 --tokens-per-second 50
+
+then point the engine to it with api_base='http://127.0.0.1:8099/v1'. Every reply is a canned evaluation whose
+'Total Score: x/20' only depends on the statement, so runs are reproducible. The latency is a fixed part plus the
+time to generate the completion at the given token rate, plus an optional random jitter, and a fraction of the requests can fail with rate limit
+(429) or server (500) errors. Streaming and the n parameter are supported, and prompts asking for JSON (the
+structured output mode) get a JSON reply.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_TEMPLATE = """- Action: {action}
+    Score: {action_score}/5
+
+- Result: {result}
+    Score: {result_score}/5
+
+- Impact: {impact}
+    Score: {impact_score}/5
+
+- Scope: {scope}
+    Score: {scope_score}/5
+
+Total Score: {total}/20
+"""
+
+
+def canned_reply(statement, sample=0, output_format='text'):
+    """
+    Evaluation of the statement, always the same for the same statement and sample number.
+    """
+    digest = hashlib.sha256(f'{statement}|{sample}'.encode('utf-8')).digest()
+    scores = [1 + digest[i] % 5 for i in range(4)]
+    if output_format == 'json':
+        return json.dumps({'action': {'justification': 'The member took clear and decisive action.',
+                                      'score': scores[0]},
+                           'result': {'justification': 'The result is quantified and tied to the action.',
+                                      'score': scores[1]},
+                           'impact': {'justification': 'The impact on the mission is stated.', 'score': scores[2]},
+                           'scope': {'justification': 'The scope is at the squadron level.', 'score': scores[3]},
+                           'total': sum(scores),
+                           'justification': 'State the impact beyond the squadron.'}, indent=2)
+    return REPLY_TEMPLATE.format(action='The member took clear and decisive action.', action_score=scores[0],
+                                 result='The result is quantified and tied to the action.', result_score=scores[1],
+                                 impact='The impact on the mission is stated.', impact_score=scores[2],
+                                 scope='The scope is at the squadron level.', scope_score=scores[3],
+                                 total=sum(scores))
+
+
+class FakeLLMServer:
+    """
+    Fake chat completion server, run in a background thread.
+    """
+
+    def __init__(self, port=0, latency=0.1, tokens_per_second=None, error_rate=0.0, error_status=429, seed=0,
+                 jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+        self.n_requests = 0
+        self.n_errors = 0
+        # Requests being served, and the most served at once
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Statements in the order their replies were sent
+        self.replied = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}/v1'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name='fake-llm')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _should_fail(self):
+        with self._lock:
+            self.n_requests += 1
+            fail = self._random.random() < self.error_rate
+            self.n_errors += fail
+            return fail
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def _exit(self, statement=None):
+        with self._lock:
+            self.in_flight -= 1
+            if statement is not None:
+                self.replied.append(statement)
+
+    def _generation_time(self, completion):
+        # About 4 characters per token
+        if not self.tokens_per_second:
+            return 0.0
+        return len(completion) / 4 / self.tokens_per_second
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                time.sleep(server._enter())
+                statement = None
+                try:
+                    statement = self._reply(request)
+                finally:
+                    server._exit(statement)
+
+            def _reply(self, request):
+                if server._should_fail():
+                    self._send_json(server.error_status,
+                                    {'error': {'message': 'Fake error.', 'type': 'fake_error', 'code': None}},
+                                    headers={'Retry-After': '0'})
+                    return
+
+                statement = request['messages'][-1]['content']
+                prompt_tokens = sum(len(m['content']) for m in request['messages']) // 4
+                output_format = 'json' if any('JSON object' in m['content'] for m in request['messages']
+                                              if m['role'] == 'system') else 'text'
+                completions = [canned_reply(statement, i, output_format) for i in range(request.get('n', 1))]
+                if request.get('stream'):
+                    self._stream(completions[0], server._generation_time(completions[0]))
+                    return statement
+
+                time.sleep(max(server._generation_time(c) for c in completions))
+                self._send_json(200, {
+                    'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()),
+                    'model': request.get('model'),
+                    'choices': [{'index': i, 'message': {'role': 'assistant', 'content': c},
+                                 'finish_reason': 'stop'} for i, c in enumerate(completions)],
+                    'usage': {'prompt_tokens': prompt_tokens,
+                              'completion_tokens': sum(len(c) // 4 for c in completions),
+                              'total_tokens': prompt_tokens + sum(len(c) // 4 for c in completions)}})
+                return statement
+
+            def _stream(self, completion, generation_time):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                lines = completion.splitlines(keepends=True)
+                for line in lines:
+                    time.sleep(generation_time / len(lines))
+                    chunk = {'object': 'chat.completion.chunk',
+                             'choices': [{'index': 0, 'delta': {'content': line}, 'finish_reason': None}]}
+                    self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b'data: [DONE]\n\n')
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a fake OpenAI chat completion server.')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.1, help='Fixed latency of every request, in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Random extra latency of every request, up to this many seconds.')
+    parser.add_argument('--tokens-per-second', type=float, default=None,
+                        help='Generation speed, adds to the latency (default: instant).')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the requests that fail.')
+    parser.add_argument('--error-status', type=int, default=429, help='HTTP status of the failures.')
+    args = parser.parse_args(argv)
+
+    server = FakeLLMServer(port=args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                           error_rate=args.error_rate, error_status=args.error_status, jitter=args.jitter)
+    print(f'Serving fake chat completions on {server.url}')
+    server.start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
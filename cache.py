@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class CompletionCache:
+    """
+    Persistent on-disk cache of GPT completions, stored in a SQLite file. Entries are keyed by a hash of the full
+    message list and the GPT parameters, so the same statement graded under the same award, tier, wing, squadron,
+    model and sampling parameters is only sent to OpenAI once. Entries expire after ttl seconds, and the least
+    recently used ones are evicted when the cache grows over max_entries or max_bytes.
+    """
+
+    def __init__(self, file_path='./data/completion_cache.sqlite',
+                 max_entries=10000,
+                 max_bytes=50 * 1024 * 1024,
+                 ttl=30 * 24 * 3600):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        # The cache is shared by the threads of batch evaluations, hence a single connection behind a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.file_path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS completions ('
+                                 'key TEXT PRIMARY KEY, '
+                                 'completion TEXT NOT NULL, '
+                                 'size INTEGER NOT NULL, '
+                                 'created REAL NOT NULL, '
+                                 'last_access REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)')
+        self._connection.commit()
+
+    @staticmethod
+    def key(messages, gpt_parameters):
+        """
+        Content hash of the messages and the GPT parameters that determine the completion.
+        """
+        content = json.dumps({'messages': messages, 'parameters': gpt_parameters}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached completion for the key, or None if there is no (fresh) entry.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT completion, created FROM completions WHERE key = ?',
+                                           (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._connection.execute('DELETE FROM completions WHERE key = ?', (key,))
+                self._connection.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute('UPDATE completions SET last_access = ? WHERE key = ?', (now, key))
+            self._connection.commit()
+            self.hits += 1
+
+        logging.info(f'Completion cache hit for {key}.')
+        return row[0]
+
+    def put(self, key, completion):
+        now = time.time()
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)',
+                                     (key, completion, len(completion.encode('utf-8')), now, now))
+            self._evict(now)
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM completions')
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def _evict(self, now):
+        self._connection.execute('DELETE FROM completions WHERE created < ?', (now - self.ttl,))
+
+        entries, size = self._connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+
+        # Walk the entries from the least recently used until both limits hold again
+        to_delete = []
+        for key, entry_size in self._connection.execute('SELECT key, size FROM completions ORDER BY last_access'):
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            entries -= 1
+            size -= entry_size
+        self._connection.executemany('DELETE FROM completions WHERE key = ?', to_delete)
+        logging.info(f'Evicted {len(to_delete)} entries from the completion cache.')
@@ -0,0 +1,34 @@
+import json
+from datetime import datetime as dt
+
+
+def json_default(value):
+    """
+    JSON form of the values json does not know, as found in statement tuples and DataFrames: times as ISO strings,
+    numpy scalars as Python ones, and missing values (pd.NA, NaT, NaN) as null.
+    """
+    import pandas as pd
+
+    # Only pandas or numpy values get here, pandas is imported already
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    return value.isoformat() if hasattr(value, 'isoformat') else value.item()
+
+
+def dumps(payload):
+    return json.dumps(payload, default=json_default)
+
+
+def decode_statement_tuple(statement_tuple):
+    """
+    A statement tuple from its JSON list (see dumps), with its time back to a datetime. None stays None.
+    """
+    from storage import DATABASE_COLUMNS
+
+    if statement_tuple is None:
+        return None
+    statement_tuple = list(statement_tuple)
+    datetime_index = DATABASE_COLUMNS.index('datetime')
+    if statement_tuple[datetime_index] is not None:
+        statement_tuple[datetime_index] = dt.fromisoformat(statement_tuple[datetime_index])
+    return tuple(statement_tuple)
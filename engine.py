@@ -1,85 +1,928 @@
-import openai
-import io
-import pandas as pd
+import functools
+import hashlib
+import json
 import logging
 import re
-import streamlit as st
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
 from prompts import *
+from backends import OpenAIBackend, GRADE, PRESCREEN
+from cache import CompletionCache
+from exports import write_export, DEFAULT_CHUNK_SIZE, EXPORT_SPOOL_SIZE
+from metrics import Metrics
+from scheduler import RequestScheduler, INTERACTIVE, BATCH
+from tokens import count_message_tokens, count_tokens, fit_to_context
+from validation import StatementValidator
+
+# pandas, numpy and openai (and the modules that need them) take most of the import time, and many code paths never
+# use them, e.g., evaluations served from the cache. They are imported where needed, see _load_database and _gpt_request.
+
+# Number of samples of a multi-sample evaluation drawn before checking whether their scores already agree
+EARLY_STOPPING_SAMPLES = 3
 
 class EvaluatorEngine:
     """
     The main class of the Evaluator engine. It stores the database and application parameters, as well as
     coordinates the calls to GPT-3 model, leveraging the preprocessor and postprocessor. In this manner,
     it provides the capability both to insert new statements and to query the database.
+
+    The engine is shared by every user of the app, so it does not hold any evaluation in progress: those live in
+    EvaluationSession objects (see new_session), one per user. Writes to the database are serialized by a lock,
+    while GPT calls run concurrently.
     """
 
-    def __init__(self, api_key = st.secrets["OPENAI_API_KEY"],
+    def __init__(self, api_key = None,
                  database_file_path = './data/default_database.csv',
                  gpt_engine = 'gpt-3.5-turbo',
-                 gpt_temperature=0.7):
+                 gpt_temperature=0.7,
+                 gpt_max_tokens=1000,
+                 api_base = None,
+                 max_concurrent_requests = 8,
+                 requests_per_minute = 3500,
+                 tokens_per_minute = 90000,
+                 request_timeout = 60,
+                 request_deadline = 180,
+                 compact_every = 1000,
+                 cache_file_path = './data/completion_cache.sqlite',
+                 lookup_file_path = './data/lookup.csv',
+                 metrics_file_path = None,
+                 backends = None,
+                 routes = None,
+                 write_ahead_log = True,
+                 checkpoint_interval = 5.0,
+                 read_only = False):
         self._database_file_path = database_file_path
+        self._lookup_file_path = lookup_file_path
+        self._compact_every = compact_every
 
-        # Load the database or create it from scratch if needed
-        try:
-            self.database = pd.read_csv(self._database_file_path)
-            logging.info(f'Loaded database from {self._database_file_path}.')
-        except FileNotFoundError:
-            self.database = pd.DataFrame(columns=['statement', 'score', 'user_score',
-                                                  'explanation', 'award', 'tier',
-                                                  'wg', 'sq', 'user', 'datetime'])
-            self._save()
-            logging.info(f'Created database in {self._database_file_path}')
+        # The database is loaded (or created from scratch) on first access. New evaluations are kept as rows
+        # in _pending_rows (in memory, once loaded) and _unsaved_rows (not yet on disk) until they are needed.
+        self._storage = None
+        self._lookup = None
+        self._database = None
+        self._pending_rows = []
+        self._unsaved_rows = []
+        # Rows taken by the running checkpoint that may not be in the file yet
+        self._saving_rows = []
+
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_timeout = request_timeout
+        self.request_deadline = request_deadline
 
+        # GPT requests go to backends (see backends.py), named in backends, and routed by role (GRADE or PRESCREEN)
+        # in routes. By default, everything goes to OpenAI. Every backend has its own scheduler: concurrency limit,
+        # rate limits, retries and priorities. A request that has not succeeded request_deadline seconds after
+        # it was made is given up.
+        if backends is None:
+            # api_base points the client somewhere else than OpenAI, e.g. a local stub of the chat completion endpoint
+            backends = {'openai': OpenAIBackend(api_key=api_key, api_base=api_base,
+                                                max_concurrency=max_concurrent_requests,
+                                                requests_per_minute=requests_per_minute,
+                                                tokens_per_minute=tokens_per_minute)}
+        self._backends = {}
+        self._schedulers = {}
+        for name, backend in backends.items():
+            self.add_backend(name, backend)
+        default_backend = next(iter(backends))
+        self.routes = {GRADE: default_backend, PRESCREEN: default_backend}
+        self.routes.update(routes or {})
+
+        # Completions are cached on disk, unless no cache file is given
+        self._cache = CompletionCache(cache_file_path) if cache_file_path is not None else None
 
-        openai.api_key = api_key
         self.gpt_parameters = {'engine': gpt_engine,
                                'temperature': gpt_temperature,
-                               'max_tokens': 1000,
+                               'max_tokens': gpt_max_tokens,
                                'top_p': 1.0,
                                'frequency_penalty': 0.0,
                                'presence_penalty': 0.0,
                                'stop': None}
 
-        self.statement_parameters = {'award': award_dict['Performer of the Month'],
-                                     'tier': tier_dict['Amn'],
-                                     'wg': wg_pri_dict['480 ISRW'],
-                                     'sq': sq_pri_dict['30 IS']}
+        # Default parameters of new sessions. Keys of award_dict, tier_dict, wg_pri_dict and sq_pri_dict
+        self.statement_parameters = {'award': 'Performer of the Month',
+                                     'tier': 'Amn',
+                                     'wg': '480 ISRW',
+                                     'sq': '30 IS'}
 
-        self._current_extracted_statement = None
+        # The write lock guards the state in memory, and is only held briefly. The database file is only written by
+        # checkpoints (one at a time, under the checkpoint lock), outside of the write lock so insertions do not
+        # wait for the disk; the storage lock keeps the loads of the file from seeing it half written. A thread
+        # that holds the write lock never takes the checkpoint lock.
+        self._write_lock = threading.RLock()
+        self._checkpoint_lock = threading.RLock()
+        self._storage_lock = threading.Lock()
+
+        # Timing of every stage of the pipeline, also appended to a file if one is given
+        self.metrics = Metrics(metrics_file_path)
+
+        # Built on the first search (or analytics query), then kept up to date on every insertion
+        self._search_index = None
+        self._similarity_index = None
+        self._analytics = None
 
         # Create preprocessor and postprocessor for GPT inputs and outputs
         self._preprocessor = StatementPreprocessor()
         self._postprocessor = StatementPostprocessor()
+        # Rule-based checks of the statements, before any GPT request
+        self.validator = StatementValidator()
+
+        # Commits go to a write-ahead log next to the database file (see wal.py), and reach the database file at
+        # the next checkpoint, every checkpoint_interval seconds in the background. The commits a crash left in
+        # the log are replayed now. The log is locked: opening a second engine on the same database fails (with
+        # WriteAheadLogLocked), unless it is read_only, i.e., it never writes the database, e.g., the commands
+        # that only read it next to the app, or the worker processes.
+        self.read_only = read_only
+        self.checkpoint_interval = checkpoint_interval
+        self._wal = None
+        self._checkpoint_stop = threading.Event()
+        if write_ahead_log and not read_only:
+            self._open_write_ahead_log()
+
+    def validate_statement(self, statement_utterance):
+        """
+        Checks the statement against the rules of a performance statement, without GPT. Returns a
+        validation.ValidationResult (valid, errors, warnings).
+        """
+        with self.metrics.span('validation'):
+            return self.validator.validate(statement_utterance)
+
+    def add_backend(self, name, backend):
+        """
+        Adds (or replaces) a backend, which requests can then be routed to, e.g., engine.routes[PRESCREEN] = name.
+        """
+        self._backends[name] = backend
+        self._schedulers[name] = RequestScheduler(requests_per_minute=backend.requests_per_minute,
+                                                  tokens_per_minute=backend.tokens_per_minute,
+                                                  max_workers=backend.max_concurrency,
+                                                  request_timeout=self.request_timeout)
+
+    @property
+    def api_key(self):
+        """
+        The OpenAI key of the engine, i.e., of its first OpenAI backend.
+        """
+        for backend in self._backends.values():
+            if isinstance(backend, OpenAIBackend):
+                return backend.api_key
+        return None
+
+    def _get_storage(self):
+        if self._storage is None:
+            from storage import open_store
+            self._storage = open_store(self._database_file_path, compact_every=self._compact_every)
+        return self._storage
+
+    def _load_database(self):
+        self._install_database(*self._read_database())
+
+    def _read_database(self):
+        """
+        Loads the database file. Returns it along with the rows of the running checkpoint that are not in it yet.
+        """
+        from storage import PriorityLookup
+
+        with self._storage_lock:
+            database = self._get_storage().load(read_only=self.read_only)
+
+            # The database only stores the keys of the award, tier, wing and squadron, not their texts.
+            # Databases from before that get migrated (and shrunk) on load.
+            lookup = PriorityLookup(self._lookup_file_path, read_only=self.read_only)
+            database, n_replaced = lookup.normalize(database)
+            if n_replaced > 0 and not self.read_only:
+                self._storage.compact(database)
+                logging.info(f'Migrated {n_replaced} texts in the database to their keys.')
+
+            return database, lookup, list(self._saving_rows)
+
+    def _install_database(self, database, lookup, saving_rows):
+        with self._write_lock:
+            if self._database is not None:
+                return
+            self._database = database
+            self._lookup = lookup
+            # Rows inserted before the load that are not in the file yet, e.g., commits waiting in the write-ahead
+            # log for the next checkpoint
+            self._pending_rows.extend(saving_rows + self._unsaved_rows)
+
+    @property
+    def database(self):
+        """
+        The evaluation database as a DataFrame, loaded on first access. Rows inserted since the last access
+        are concatenated all at once, so inserting does not copy the whole database every time.
+        """
+        import pandas as pd
+        from storage import DATABASE_COLUMNS
+
+        with self._write_lock:
+            if self._database is None:
+                self._load_database()
+            if self._pending_rows:
+                df_to_add = pd.DataFrame(self._pending_rows, columns=DATABASE_COLUMNS)
+                self._database = pd.concat([self._database, df_to_add], ignore_index=True)
+                self._pending_rows = []
+            return self._database
+
+    def database_size(self):
+        with self._write_lock:
+            return len(self.database)
+
+    def _save(self, rows):
+        """
+        Appends the rows taken by a checkpoint to the database file, or rewrites the file if they cannot be
+        appended or it needs compacting.
+        """
+        import pandas as pd
+        from storage import DATABASE_COLUMNS
 
-    def _save(self):
-        logging.info(f'Database has {len(self.database)} facts.')
+        logging.info(f'Saving {len(rows)} new facts.')
 
-        self.database.to_csv(self._database_file_path, index=False)
+        with self.metrics.span('save', rows=len(rows)):
+            storage = self._get_storage()
+            with self._storage_lock:
+                appended = storage.append(pd.DataFrame(rows, columns=DATABASE_COLUMNS))
+                if appended:
+                    self._saving_rows = []
+            if not appended or storage.needs_compaction():
+                self._rewrite()
 
         logging.info(f'Saved database in {self._database_file_path}.')
 
+    def _rewrite(self):
+        """
+        Rewrites the whole database file from the database, loaded first if needed. Runs under the checkpoint lock.
+        """
+        if self._database is None:
+            self._install_database(*self._read_database())
+        with self._write_lock:
+            database = self.database
+            # The rows inserted until now are in the new file
+            self._saving_rows = self._saving_rows + self._unsaved_rows
+            self._unsaved_rows = []
+        with self._storage_lock:
+            self._get_storage().compact(database)
+            self._saving_rows = []
+
+    def _restore_saving_rows(self):
+        # The rows of a failed checkpoint that are not in the file go to the next one
+        with self._write_lock:
+            self._unsaved_rows[:0] = self._saving_rows
+            self._saving_rows = []
+
+    def compact(self):
+        """
+        Rewrites the whole database file from the in-memory database.
+        """
+        self._check_writable()
+        with self._checkpoint_lock:
+            self.checkpoint()
+            try:
+                self._rewrite()
+            except Exception:
+                self._restore_saving_rows()
+                raise
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f'The engine is read-only, it cannot write {self._database_file_path}.')
+
+    def _open_write_ahead_log(self):
+        from wal import WriteAheadLog
+
+        self._wal = WriteAheadLog(f'{self._database_file_path}.wal')
+        self._replay_write_ahead_log()
+        threading.Thread(target=self._checkpoint_loop, daemon=True, name='checkpoint').start()
+
+    def _replay_write_ahead_log(self):
+        """
+        Inserts the commits of the write-ahead log that are not in the database file yet, i.e., that were not
+        checkpointed before the engine stopped. A commit is identified by its statement and time.
+        """
+        from codec import decode_statement_tuple
+
+        statement_tuples = [decode_statement_tuple(s) for record in self._wal.records() for s in record]
+        if not statement_tuples:
+            self._wal.truncate()
+            return
+
+        with self.metrics.span('replay', rows=len(statement_tuples)):
+            missing = self.missing_evaluations(statement_tuples)
+            if missing:
+                self._insert_evaluations(missing)
+                self.checkpoint()
+            self._wal.truncate()
+        logging.warning(f'Replayed {len(missing)} commits of the write-ahead log of {self._database_file_path} '
+                        f'({len(statement_tuples) - len(missing)} were already saved).')
+
+    def missing_evaluations(self, statement_tuples):
+        """
+        The statement tuples that are not in the database yet, in order and without duplicates. An evaluation is
+        identified by its statement and time.
+        """
+        import pandas as pd
+        from storage import DATABASE_COLUMNS
+
+        datetime_index = DATABASE_COLUMNS.index('datetime')
+        with self._write_lock:
+            database = self.database
+            committed = set(zip(database['statement'], pd.to_datetime(database['datetime'], errors='coerce')))
+        missing = []
+        for s in statement_tuples:
+            key = (s[0], pd.Timestamp(s[datetime_index]))
+            if key not in committed:
+                committed.add(key)
+                missing.append(s)
+        return missing
+
+    def _checkpoint_loop(self):
+        while not self._checkpoint_stop.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                logging.exception('Checkpoint failed, the commits stay in the write-ahead log.')
+
+    def checkpoint(self):
+        """
+        Saves the commits of the write-ahead log to the database file, then drops them from the log. Runs in the
+        background; call it before exiting to leave the database file complete (the log would otherwise be replayed
+        by the next engine). Without a log, saves the unsaved evaluations. Only the rows are taken under the write
+        lock: insertions go on while the file is written, and their commits stay in the log for the next checkpoint.
+        """
+        if self.read_only:
+            return
+        with self._checkpoint_lock:
+            with self._write_lock:
+                n_records = self._wal.n_records if self._wal is not None else 0
+                if not self._unsaved_rows and n_records == 0:
+                    return
+                rows, self._unsaved_rows = self._unsaved_rows, []
+                self._saving_rows = rows
+
+            with self.metrics.span('checkpoint', records=n_records):
+                try:
+                    if rows:
+                        self._save(rows)
+                except Exception:
+                    self._restore_saving_rows()
+                    raise
+                if self._wal is not None:
+                    self._wal.truncate(n_records)
+
+    def close(self):
+        """
+        Stops the background checkpoints after a last one, and releases the write-ahead log.
+        """
+        self._checkpoint_stop.set()
+        with self._checkpoint_lock:
+            self.checkpoint()
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
+    def new_session(self):
+        """
+        Creates the evaluation context of a new user, starting from the engine's default parameters.
+        """
+        return EvaluationSession(self)
+
+    def insert_evaluations(self, statement_tuples):
+        """
+        Inserts already extracted statements into the database and saves them: to the write-ahead log if there
+        is one, to the database file otherwise. Either way they are on disk when this returns. Safe to call from
+        several sessions at once: the insertions are serialized.
+        """
+        self._check_writable()
+        with self._write_lock:
+            if self._wal is not None:
+                with self.metrics.span('wal', rows=len(statement_tuples)):
+                    self._wal.append(statement_tuples)
+            self._insert_evaluations(statement_tuples)
+        if self._wal is None:
+            self.checkpoint()
+
+    def _insert_evaluations(self, statement_tuples):
+        """
+        Inserts several already extracted statements into the database at once.
+        """
+        import pandas as pd
+        from storage import DATABASE_COLUMNS
+
+        with self._write_lock, self.metrics.span('insert', rows=len(statement_tuples)):
+            logging.info(f'Inserting {len(statement_tuples)} statements: {statement_tuples}')
+
+            # Until the database is loaded, the new rows are only kept to be saved, and go to memory on load
+            if self._database is not None:
+                self._pending_rows.extend(statement_tuples)
+            self._unsaved_rows.extend(statement_tuples)
+
+            if self._search_index is not None or self._analytics is not None:
+                rows = pd.DataFrame(statement_tuples, columns=DATABASE_COLUMNS)
+                if self._search_index is not None:
+                    self._search_index.add(rows)
+                if self._analytics is not None:
+                    self._analytics.add(rows)
+            if self._similarity_index is not None:
+                self._similarity_index.add([s[0] for s in statement_tuples])
+
+    ##########
+    # Search #
+    ##########
+
+    def search(self, query=None, award=None, tier=None, wg=None, sq=None, user=None,
+               min_score=None, max_score=None, start=None, end=None, limit=100):
+        """
+        Searches the stored evaluations. The query matches the words of the statement and the explanation, the
+        other arguments filter the results (None means no filter). Returns the matching rows of the database,
+        most recent first.
+        """
+        from search import SearchIndex
+
+        with self._write_lock:
+            if self._search_index is None:
+                self._search_index = SearchIndex()
+                self._search_index.add(self.database)
+            row_ids = self._search_index.search(query, award=award, tier=tier, wg=wg, sq=sq, user=user,
+                                                min_score=min_score, max_score=max_score,
+                                                start=start, end=end, limit=limit)
+            return self.database.iloc[row_ids]
+
+    def find_similar(self, statement_utterance, k=5, min_similarity=0.0, parameters=None, only_valid=False):
+        """
+        Finds the k stored statements most similar to the given one (more like this), without calling GPT.
+        parameters, a dictionary with the award, tier, wg and sq keys, restricts the search to the evaluations
+        made under those parameters, and only_valid to the ones with a justification. Returns the matching rows
+        of the database with an additional similarity column (between 0 and 1), most similar first.
+        """
+        import numpy as np
+        from similarity import SimilarityIndex
+
+        with self._write_lock:
+            database = self.database
+            if self._similarity_index is None:
+                self._similarity_index = SimilarityIndex()
+                self._similarity_index.add(database['statement'])
+
+            row_mask = None
+            if parameters is not None or only_valid:
+                row_mask = np.ones(len(database), dtype=bool)
+                for dimension, value in (parameters or {}).items():
+                    row_mask &= (database[dimension] == value).to_numpy()
+                if only_valid:
+                    row_mask &= database['explanation'].notna().to_numpy()
+
+            neighbours = self._similarity_index.query(statement_utterance, k=k, min_similarity=min_similarity,
+                                                      row_mask=row_mask)
+            results = database.iloc[[row_id for row_id, _ in neighbours]].copy()
+            results['similarity'] = [similarity for _, similarity in neighbours]
+            return results
+
+    def analytics(self):
+        """
+        Returns the ScoreAnalytics of the stored evaluations: score distributions, calibration against the users'
+        scores and trends, overall and per award, tier, wing, squadron and user. Built from the database on the
+        first call, then updated on every insertion, so its queries do not scan the database.
+        """
+        from analytics import ScoreAnalytics
+
+        with self._write_lock:
+            if self._analytics is None:
+                analytics = ScoreAnalytics()
+                with self.metrics.span('analytics', rows=self.database_size()):
+                    analytics.add(self.database)
+                self._analytics = analytics
+            return self._analytics
+
+    ###########
+    # GPT API #
+    ###########
+
+    def _gpt_chat(self, messages, gpt_parameters, stream=False, use_cache=True, bypass_cache=False, api_key=None,
+                  priority=INTERACTIVE, role=GRADE):
+        """
+        Sends the messages to GPT and returns the completion, along with its token usage as a dictionary
+        (prompt_tokens, completion_tokens). Completions are looked up in the cache first, unless bypass_cache
+        is True (e.g., to resample an evaluation at a nonzero temperature), in which case the new completion
+        replaces the cached one. The api_key, if given, replaces the engine's one for this request only.
+        The priority (scheduler.INTERACTIVE or scheduler.BATCH) decides which requests go first when the
+        rate limits are reached, and the role (backends.GRADE or backends.PRESCREEN) which backend answers.
+        """
+        if stream:
+            completion = ''.join(self._gpt_chat_stream(messages, gpt_parameters, use_cache=use_cache,
+                                                       bypass_cache=bypass_cache, api_key=api_key,
+                                                       priority=priority, role=role))
+            return completion, self._count_usage(messages, completion, gpt_parameters)
+
+        use_cache = self._cache is not None and use_cache
+        if use_cache:
+            cache_key = self._cache_key(messages, gpt_parameters, role)
+            if not bypass_cache:
+                completion = self._cached_completion(cache_key)
+                if completion is not None:
+                    return completion, self._count_usage(messages, completion, gpt_parameters)
+
+        with self.metrics.span('gpt', model=gpt_parameters['engine'], backend=self.routes[role],
+                               cache_hit=False) as span:
+            response = self._gpt_request(messages, gpt_parameters, stream=False, api_key=api_key, priority=priority,
+                                         role=role)
+
+            completion = response['choices'][0]['message']['content']
+            logging.info(f'GPT Response: {completion}')
+
+            if use_cache:
+                self._cache.put(cache_key, completion)
+
+            if 'usage' in response:
+                usage = {'prompt_tokens': response['usage']['prompt_tokens'],
+                         'completion_tokens': response['usage']['completion_tokens']}
+            else:
+                usage = self._count_usage(messages, completion, gpt_parameters)
+            logging.info(f'GPT Usage: {usage}')
+            self._count_spent_tokens(usage, span)
+
+        return completion, usage
+
+    def _gpt_chat_stream(self, messages, gpt_parameters, use_cache=True, bypass_cache=False, api_key=None,
+                         priority=INTERACTIVE, role=GRADE):
+        """
+        Same as _gpt_chat, but yields the completion piece by piece as GPT generates it. A cached completion
+        is yielded all at once.
+        """
+        use_cache = self._cache is not None and use_cache
+        if use_cache:
+            cache_key = self._cache_key(messages, gpt_parameters, role)
+            if not bypass_cache:
+                completion = self._cached_completion(cache_key)
+                if completion is not None:
+                    yield completion
+                    return
+
+        with self.metrics.span('gpt', model=gpt_parameters['engine'], backend=self.routes[role], cache_hit=False,
+                               stream=True) as span:
+            start = time.perf_counter()
+            pieces = []
+            # The scheduler only waits for the stream to open, its chunks are read here
+            for chunk in self._gpt_request(messages, gpt_parameters, stream=True, api_key=api_key,
+                                           priority=priority, role=role):
+                piece = chunk['choices'][0]['delta'].get('content')
+                if piece:
+                    if not pieces:
+                        self.metrics.record('first_token', time.perf_counter() - start)
+                    pieces.append(piece)
+                    yield piece
+
+            completion = ''.join(pieces)
+            logging.info(f'GPT Response: {completion}')
+            self._count_spent_tokens(self._count_usage(messages, completion, gpt_parameters), span)
+
+        if use_cache:
+            self._cache.put(cache_key, completion)
+
+    def _gpt_chat_samples(self, messages, gpt_parameters, n_samples, tolerance=None, strategy='parallel',
+                          use_cache=True, bypass_cache=False, api_key=None, priority=INTERACTIVE, role=GRADE):
+        """
+        Draws up to n_samples completions of the same messages (at a nonzero temperature, they differ) and returns
+        them along with their total token usage. The samples are requested all at once, either as concurrent
+        requests (strategy 'parallel') or as the choices of a single request (strategy 'n', the prompt is only
+        paid once), so they take about the time of one request. If tolerance is given, the first
+        EARLY_STOPPING_SAMPLES samples go first, and the others are only requested if their scores differ by
+        more than tolerance. Every sample is cached on its own.
+        """
+        if n_samples < 1:
+            raise ValueError('n_samples must be at least 1.')
+        if strategy not in ('parallel', 'n'):
+            raise ValueError(f"Unknown sampling strategy {strategy}, expected 'parallel' or 'n'.")
+
+        first_wave = n_samples if tolerance is None else min(n_samples, EARLY_STOPPING_SAMPLES)
+        with self.metrics.span('gpt_samples', model=gpt_parameters['engine'], strategy=strategy) as span:
+            completions, usage = self._gpt_sample_wave(messages, gpt_parameters, range(first_wave), strategy,
+                                                       use_cache, bypass_cache, api_key, priority, role)
+
+            scores = [self._postprocessor.parse_result(c).score for c in completions]
+            if first_wave < n_samples and not self._postprocessor.scores_agree(scores, tolerance):
+                more_completions, more_usage = self._gpt_sample_wave(messages, gpt_parameters,
+                                                                     range(first_wave, n_samples), strategy,
+                                                                     use_cache, bypass_cache, api_key, priority,
+                                                                     role)
+                completions += more_completions
+                usage = {k: usage[k] + more_usage[k] for k in usage}
+            elif first_wave < n_samples:
+                logging.info(f'Stopped after {first_wave} samples, their scores agree: {scores}')
+            span.update(n_samples=len(completions), **usage)
+
+        return completions, usage
+
+    def _gpt_sample_wave(self, messages, gpt_parameters, sample_indices, strategy, use_cache, bypass_cache,
+                         api_key, priority, role):
+        use_cache = self._cache is not None and use_cache
+        completions = {}
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+
+        # The first sample shares its cache entry with single-sample evaluations
+        cache_keys = {i: self._cache_key(messages, gpt_parameters, role, sample=i) for i in sample_indices}
+        if use_cache and not bypass_cache:
+            for i, cache_key in cache_keys.items():
+                completion = self._cached_completion(cache_key)
+                if completion is not None:
+                    completions[i] = completion
+                    for k, v in self._count_usage(messages, completion, gpt_parameters).items():
+                        usage[k] += v
+
+        missing = [i for i in sample_indices if i not in completions]
+        if strategy == 'n':
+            futures = [self._submit_gpt_request(messages, gpt_parameters, stream=False, api_key=api_key,
+                                                priority=priority, n=len(missing), role=role)] if missing else []
+        else:
+            futures = [self._submit_gpt_request(messages, gpt_parameters, stream=False, api_key=api_key,
+                                                priority=priority, role=role) for _ in missing]
+
+        new_completions = []
+        for future in futures:
+            response = future.result()
+            new_completions += [choice['message']['content'] for choice in response['choices']]
+            if 'usage' in response:
+                spent = {'prompt_tokens': response['usage']['prompt_tokens'],
+                         'completion_tokens': response['usage']['completion_tokens']}
+            else:
+                spent = {'prompt_tokens': 0, 'completion_tokens': 0}
+                for choice in response['choices']:
+                    for k, v in self._count_usage(messages, choice['message']['content'], gpt_parameters).items():
+                        spent[k] += v
+            self._count_spent_tokens(spent)
+            for k, v in spent.items():
+                usage[k] += v
+
+        for i, completion in zip(missing, new_completions):
+            completions[i] = completion
+            if use_cache:
+                self._cache.put(cache_keys[i], completion)
+        logging.info(f'GPT Responses: {new_completions}')
+
+        return [completions[i] for i in sample_indices if i in completions], usage
+
+    def _gpt_request(self, messages, gpt_parameters, stream, api_key=None, priority=INTERACTIVE, role=GRADE):
+        return self._submit_gpt_request(messages, gpt_parameters, stream, api_key=api_key, priority=priority,
+                                        role=role).result()
+
+    def _submit_gpt_request(self, messages, gpt_parameters, stream, api_key=None, priority=INTERACTIVE, n=1,
+                            role=GRADE):
+        """
+        Schedules a chat completion request to the backend of the role, and returns a Future of the response.
+        n is the number of choices.
+        """
+        backend_name = self.routes[role]
+        backend = self._backends[backend_name]
+        model = backend.model_for(gpt_parameters)
+
+        # Trim the completion budget, or the examples, if the prompt would not fit in the context window
+        messages, max_tokens = fit_to_context(messages, gpt_parameters['max_tokens'], model)
+
+        # A session's OpenAI key only goes to OpenAI
+        backend_key = api_key if isinstance(backend, OpenAIBackend) else None
+
+        def request(timeout):
+            # One span per attempt: the difference with the gpt stage is the time spent queued and backing off
+            with self.metrics.span('http', backend=backend_name, stream=stream, n=n):
+                return backend.chat(messages, gpt_parameters, max_tokens, stream=stream, n=n, timeout=timeout,
+                                    api_key=backend_key)
+
+        # The request may use up to its prompt plus max_tokens tokens per choice of the tokens per minute limit
+        tokens = count_message_tokens(messages, model) + max_tokens * n
+        return self._schedulers[backend_name].submit(request, tokens, priority=priority,
+                                                     deadline=time.monotonic() + self.request_deadline)
+
+    def _cache_key(self, messages, gpt_parameters, role=GRADE, sample=0):
+        # Completions of other backends than OpenAI's are cached apart. The first sample shares its cache entry
+        # with single-sample evaluations.
+        backend_name = self.routes[role]
+        backend = self._backends[backend_name]
+        parameters = dict(gpt_parameters)
+        if not isinstance(backend, OpenAIBackend):
+            parameters.update(backend=backend_name, engine=backend.model_for(gpt_parameters))
+        if sample:
+            parameters['sample'] = sample
+        return CompletionCache.key(messages, parameters)
+
+    def _cached_completion(self, cache_key):
+        with self.metrics.span('cache') as span:
+            completion = self._cache.get(cache_key)
+            span['cache_hit'] = completion is not None
+        self.metrics.increment('cache_hits' if completion is not None else 'cache_misses')
+        return completion
+
+    def _count_spent_tokens(self, usage, span=None):
+        # Tokens actually paid for, i.e., not served from the cache
+        self.metrics.increment('prompt_tokens', usage['prompt_tokens'])
+        self.metrics.increment('completion_tokens', usage['completion_tokens'])
+        if span is not None:
+            span.update(usage)
+
+    def _count_usage(self, messages, completion, gpt_parameters):
+        """
+        Token usage computed locally, for completions that come without OpenAI's usage (streamed or cached).
+        """
+        model = gpt_parameters['engine']
+        return {'prompt_tokens': count_message_tokens(messages, model),
+                'completion_tokens': count_tokens(completion, model)}
+
+    def set_openai_api_key(self, key):
+        for backend in self._backends.values():
+            if isinstance(backend, OpenAIBackend):
+                backend.api_key = key
+
+    def cache_stats(self):
+        """
+        Returns the completion cache counters (hits, misses, entries, bytes), or None if caching is disabled.
+        """
+        return self._cache.stats() if self._cache is not None else None
+
+    ##################
+    # Data utilities #
+    ##################
+
+    def export_data_to_binary(self, df, file_type=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Exports the DataFrame in the given format (csv, tsv, jsonl, parquet or excel, the default), written a chunk
+        at a time. Returns a file object positioned at its start, e.g., for a download: it is kept in memory while
+        small and spills to a temporary file on disk otherwise, so large exports do not double the memory use.
+        """
+        if file_type is None:
+            file_type = 'excel'
+
+        file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        try:
+            write_export(df, file, file_type, chunk_size=chunk_size)
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        return file
+
+    def export(self, file_type='csv', query=None, limit=None, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+        """
+        Exports the evaluations matching a search (see search for the query and the filters), all of them by default,
+        most recent first. Returns a file object as export_data_to_binary.
+        """
+        return self.export_data_to_binary(self.search(query, limit=limit, **filters), file_type, chunk_size)
+
+
+class EvaluationSession:
+    """
+    The evaluation context of one user of the app: their statement and GPT parameters and the evaluations they
+    have extracted but not committed yet. Sessions are cheap, and all of them share the engine's database,
+    cache and GPT client.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+
+        self.gpt_parameters = dict(engine.gpt_parameters)
+        self.statement_parameters = dict(engine.statement_parameters)
+        self.use_cache = True
+        # The OpenAI key of this user, if it differs from the engine's one
+        self.api_key = None
+        # Number of samples per evaluation, the score is their median. Sampling stops early once the scores of the
+        # first samples are within score_tolerance of each other (None: always draw all of them).
+        self.n_samples = 1
+        self.score_tolerance = 1.0
+        self.sampling_strategy = 'parallel'
+        # Output format GPT is asked for, 'text' or 'json' (sub-scores and justifications in a JSON object)
+        self.output_format = 'text'
+        # Whether statements are first graded by the prescreen backend (e.g., a local model), and only the ones it
+        # could score are then graded by the grade backend
+        self.prescreen = False
+        # Whether statements that fail the rule-based validation are rejected without asking GPT
+        self.validation = True
+
+        self._current_extracted_statement = None
+        self._current_extracted_statements = []
+
     #########################################
     # Evaluation insertion workflow methods #
     #########################################
 
-    def extract_evaluation(self, statement_utterance, user, user_score):
+    def extract_evaluation(self, statement_utterance, user, user_score, resample=False):
         """
         Extracts statement data from a natural language utterance. Returns a list of tuples (statement, tier, award, category, score).
+        If resample is True, a cached evaluation of the same statement is ignored and GPT is asked again.
+        Statements that fail validation (see EvaluatorEngine.validate_statement) are not sent to GPT, and have no
+        score nor justification.
         """
-
-        statement_tuple = self._postprocessor.result_to_tuple(
-            self._gpt_chat(self._preprocessor.extraction_prompt(statement_utterance, self.statement_parameters)),
-            statement_utterance,
-            self.statement_parameters,
-            user,
-            user_score)
+        statement_tuple = self._evaluate(statement_utterance, self.statement_parameters, user, user_score,
+                                         resample=resample)
 
         self._current_extracted_statement = statement_tuple
 
         return statement_tuple
 
+    def stream_evaluation(self, statement_utterance, user, user_score, resample=False):
+        """
+        Same as extract_evaluation, but streams the evaluation while GPT generates it. Yields pairs
+        (justification so far, score) where the score is None until the 'Total Score' line has arrived.
+        Once the stream is exhausted, the evaluation becomes the current extracted statement. Streamed
+        evaluations are always a single sample. A statement that fails validation yields nothing.
+        """
+        rejected = self._rejected(statement_utterance, self.statement_parameters, user, user_score)
+        if rejected is not None:
+            self._current_extracted_statement = rejected
+            return
+
+        parser = StreamingResultParser(self._engine._postprocessor)
+        with self._engine.metrics.span('prompt'):
+            messages = self._engine._preprocessor.extraction_prompt(statement_utterance, self.statement_parameters,
+                                                                    self.output_format)
+        for piece in self._engine._gpt_chat_stream(messages, self.gpt_parameters, use_cache=self.use_cache,
+                                                   bypass_cache=resample, api_key=self.api_key):
+            parser.feed(piece)
+            yield parser.justification(), parser.score
+        if parser.finish():
+            yield parser.justification(), parser.score
+
+        with self._engine.metrics.span('parse'):
+            self._current_extracted_statement = self._engine._postprocessor.result_to_tuple(
+                parser.result,
+                statement_utterance,
+                self.statement_parameters,
+                user,
+                user_score,
+                self._engine._count_usage(messages, parser.result, self.gpt_parameters))
+        self._engine.metrics.increment('evaluations')
+
+    def extract_evaluations(self, statement_utterances, user, user_scores=None, max_workers=None, resample=False):
+        """
+        Extracts the evaluations of several statements at once, sending the GPT requests concurrently.
+        At most max_workers requests are in flight at any time (defaults to max_concurrent_requests).
+        Returns the list of statement tuples, in the same order as the input utterances.
+        """
+        statement_utterances = list(statement_utterances)
+        if user_scores is None:
+            user_scores = [None] * len(statement_utterances)
+        if max_workers is None:
+            max_workers = self._engine.max_concurrent_requests
+
+        # Snapshot the parameters so that all statements in the batch are graded under the same settings
+        parameters = dict(self.statement_parameters)
+
+        def evaluate(statement_utterance, user_score):
+            return self._evaluate(statement_utterance, parameters, user, user_score, resample=resample,
+                                  priority=BATCH)
+
+        if not statement_utterances:
+            statement_tuples = []
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(statement_utterances)))) as executor:
+                # map() yields the results in input order, regardless of completion order
+                statement_tuples = list(executor.map(evaluate, statement_utterances, user_scores))
+
+        self._current_extracted_statements = statement_tuples
+
+        return statement_tuples
+
+    def settings(self):
+        """
+        The grading settings of the session, as a JSON serializable dictionary, e.g., to grade statements elsewhere
+        under the same settings (see jobs.py). The OpenAI key is left out.
+        """
+        return {'statement_parameters': dict(self.statement_parameters),
+                'gpt_parameters': dict(self.gpt_parameters),
+                'use_cache': self.use_cache,
+                'n_samples': self.n_samples,
+                'score_tolerance': self.score_tolerance,
+                'sampling_strategy': self.sampling_strategy,
+                'output_format': self.output_format,
+                'prescreen': self.prescreen,
+                'validation': self.validation}
+
+    def apply_settings(self, settings):
+        """
+        Grades under the given settings (see settings), the ones left out keep their current value.
+        """
+        for name, value in settings.items():
+            if name in ('statement_parameters', 'gpt_parameters'):
+                getattr(self, name).update(value)
+            elif name in ('use_cache', 'n_samples', 'score_tolerance', 'sampling_strategy', 'output_format',
+                          'prescreen', 'validation'):
+                setattr(self, name, value)
+
+    def submit_evaluations(self, job_queue, statement_utterances, user, user_scores=None, resample=False,
+                           commit=True):
+        """
+        Queues the statements in the job queue (a jobs.JobQueue), to be graded in the background under the
+        current settings of the session, and committed to the database as they are graded if commit is True.
+        Returns the id of the job.
+        """
+        return job_queue.submit(statement_utterances, user, user_scores=user_scores,
+                                settings=dict(self.settings(), resample=resample), commit=commit)
+
+    def job_evaluations(self, job_queue, job_id):
+        """
+        The graded statements of a job of the job queue so far, as dictionaries (see extracted_evaluations).
+        """
+        return [self._statement_tuple_to_dict(s) for s in job_queue.results(job_id) if s is not None]
+
     def has_extracted_statement(self):
         return self._current_extracted_statement is not None
 
@@ -91,7 +934,9 @@ class EvaluatorEngine:
         """
         Returns the current extracted statement as a list of dictionaries, for readability.
         """
-        s = self._current_extracted_statement
+        return self._statement_tuple_to_dict(self._current_extracted_statement)
+
+    def _statement_tuple_to_dict(self, s):
         s_dict = {'Statement': s[0],
                   'Score': s[1],
                   'User Score': s[2],
@@ -101,22 +946,51 @@ class EvaluatorEngine:
                   'Wing': s[6],
                   'Squadron': s[7],
                   'User': s[8],
-                  'Time': s[9]}
+                  'Time': s[9],
+                  'Prompt Tokens': s[10],
+                  'Completion Tokens': s[11],
+                  'Mean Score': s[12],
+                  'Score Spread': s[13],
+                  'Sample Scores': s[14],
+                  'Action Score': s[15],
+                  'Result Score': s[16],
+                  'Impact Score': s[17],
+                  'Scope Score': s[18]}
 
         return s_dict
 
+    def has_extracted_statements(self):
+        return len(self._current_extracted_statements) > 0
+
+    def extracted_evaluations(self):
+        """
+        Returns the current batch of extracted statements as a list of dictionaries, for readability.
+        """
+        return [self._statement_tuple_to_dict(s) for s in self._current_extracted_statements]
+
     def commit(self):
         """
         Commits the current evaluation to the database. If no evaluation has been extracted,
         the method just does nothing.
         """
         if self._current_extracted_statement is not None:
-            self._insert_evaluation()
+            self._engine.insert_evaluations([self._current_extracted_statement])
             self._current_extracted_statement = None
-            self._save()
         else:
             logging.info("Nothing to commit.")
 
+    def commit_batch(self, only_valid=True):
+        """
+        Commits the current batch of evaluations to the database. Statements without a justification
+        (i.e., that could not be evaluated) are skipped unless only_valid is False.
+        """
+        statement_tuples = [s for s in self._current_extracted_statements if not only_valid or s[3] is not None]
+        if statement_tuples:
+            self._engine.insert_evaluations(statement_tuples)
+        else:
+            logging.info("Nothing to commit.")
+        self._current_extracted_statements = []
+
     def cancel(self):
         """
         Cancel the current extracted facts. If no facts have been extracted, the method just does nothing.
@@ -126,129 +1000,301 @@ class EvaluatorEngine:
         else:
             logging.info('Nothing to revert')
 
-    def _insert_evaluation(self, statement_utterance = None):
+    def cancel_batch(self):
         """
-        Inserts a statement into the database.
+        Cancel the current batch of extracted statements.
         """
-
-        # reuse the extracted statement, if any
-        if self._current_extracted_statement is None:
-            statement_tuple = self.extract_evaluation(statement_utterance, user=None, user_score=None)
+        if self._current_extracted_statements:
+            self._current_extracted_statements = []
         else:
-            statement_tuple = self._current_extracted_statement
+            logging.info('Nothing to revert')
 
-        logging.info(f'Database has {len(self.database)} statements before insertion.')
-        logging.info(f'Inserting statement: {statement_tuple}')
+    def find_near_duplicate(self, statement_utterance, min_similarity=0.85):
+        """
+        Returns the stored evaluation of the statement most similar to the given one, graded under the same
+        parameters as this session, if it is at least min_similarity similar. Otherwise returns None.
+        """
+        results = self._engine.find_similar(statement_utterance, k=1, min_similarity=min_similarity,
+                                            parameters=self.statement_parameters, only_valid=True)
+        return results.iloc[0] if len(results) > 0 else None
 
-        df_to_add = pd.DataFrame([statement_tuple], columns=['statement', 'score', 'user_score',
-                                                             'explanation', 'award', 'tier',
-                                                             'wg', 'sq', 'user', 'datetime'])
-        self.database = pd.concat([self.database, df_to_add], ignore_index=True)
+    def reuse_evaluation(self, evaluation, statement_utterance, user, user_score):
+        """
+        Makes the current extracted statement out of a stored evaluation (a row of the database), e.g., a near
+        duplicate of the statement, instead of asking GPT. No tokens are spent.
+        """
+        # Evaluations stored before multi-sample scoring have no distribution, and before structured outputs no
+        # criteria scores
+        self._current_extracted_statement = (statement_utterance, evaluation['score'], user_score,
+                                             evaluation['explanation'], evaluation['award'], evaluation['tier'],
+                                             evaluation['wg'], evaluation['sq'], user, dt.now(), 0, 0,
+                                             evaluation.get('score_mean'), evaluation.get('score_spread'),
+                                             evaluation.get('score_samples'),
+                                             *(evaluation.get(f'{criterion}_score') for criterion in CRITERIA))
+        return self._current_extracted_statement
 
-        logging.info(f'Database has {len(self.database)} statements after insertion.')
+    def _evaluate(self, statement_utterance, parameters, user, user_score, resample=False, priority=INTERACTIVE):
+        rejected = self._rejected(statement_utterance, parameters, user, user_score)
+        if rejected is not None:
+            return rejected
+        if self.prescreen:
+            # The prescreen is a single sample; a statement it cannot score is not worth a remote grade
+            screened = self._grade(statement_utterance, parameters, user, user_score, resample, priority,
+                                   role=PRESCREEN, n_samples=1)
+            if screened[1] is None:
+                self._engine.metrics.increment('prescreen_rejections')
+                return screened
+        return self._grade(statement_utterance, parameters, user, user_score, resample, priority)
 
-    ###########
-    # GPT API #
-    ###########
+    def _rejected(self, statement_utterance, parameters, user, user_score):
+        # A statement that fails validation becomes an evaluation without score or justification, as if GPT could
+        # not evaluate it, but without spending a request
+        if not self.validation or self._engine.validate_statement(statement_utterance).valid:
+            return None
+        self._engine.metrics.increment('validation_rejections')
+        return self._engine._postprocessor.results_to_tuple([''], statement_utterance, parameters, user, user_score,
+                                                            {'prompt_tokens': 0, 'completion_tokens': 0})
 
-    def _gpt_chat(self, messages, stream=False):
-
-        response = openai.ChatCompletion.create(
-            model = self.gpt_parameters['engine'],
-            messages = messages,
-            temperature = self.gpt_parameters['temperature'],
-            top_p = self.gpt_parameters['top_p'],
-            stream = stream,
-            stop = self.gpt_parameters['stop'],
-            max_tokens = self.gpt_parameters['max_tokens'],
-            presence_penalty = self.gpt_parameters['presence_penalty'],
-            frequency_penalty = self.gpt_parameters['frequency_penalty'],
-            #user = user
-        )
+    def _grade(self, statement_utterance, parameters, user, user_score, resample=False, priority=INTERACTIVE,
+               role=GRADE, n_samples=None):
+        n_samples = self.n_samples if n_samples is None else n_samples
+        metrics = self._engine.metrics
+        with metrics.span('evaluation', n_samples=n_samples, batch=priority == BATCH, role=role):
+            with metrics.span('prompt'):
+                messages = self._engine._preprocessor.extraction_prompt(statement_utterance, parameters,
+                                                                        self.output_format)
 
-        completion = response['choices'][0]['message']['content']
-        logging.info(f'GPT Response: {completion}')
+            if n_samples > 1:
+                results, usage = self._engine._gpt_chat_samples(messages, self.gpt_parameters, n_samples,
+                                                                tolerance=self.score_tolerance,
+                                                                strategy=self.sampling_strategy,
+                                                                use_cache=self.use_cache, bypass_cache=resample,
+                                                                api_key=self.api_key, priority=priority, role=role)
+            else:
+                result, usage = self._gpt_chat(messages, bypass_cache=resample, priority=priority, role=role)
+                results = [result]
 
-        return completion
+            with metrics.span('parse'):
+                statement_tuple = self._engine._postprocessor.results_to_tuple(results, statement_utterance,
+                                                                               parameters, user, user_score, usage)
+        metrics.increment('evaluations')
+        return statement_tuple
 
-    def set_openai_api_key(self, key):
-        openai.api_key = key
+    def _gpt_chat(self, messages, bypass_cache=False, priority=INTERACTIVE, role=GRADE):
+        return self._engine._gpt_chat(messages, self.gpt_parameters, use_cache=self.use_cache,
+                                      bypass_cache=bypass_cache, api_key=self.api_key, priority=priority, role=role)
 
-    ##################
-    # Data utilities #
-    ##################
 
-    def export_data_to_binary(self, df, file_type=None):
-        if file_type is None:
-            file_type = 'excel'
+PromptPrefix = namedtuple('PromptPrefix', ['messages', 'hash', 'token_count'])
 
-        if file_type == 'excel':
-            memory_output = io.BytesIO()
-            with pd.ExcelWriter(memory_output) as writer:
-                df.to_excel(writer)
-            return memory_output
+ScoreDistribution = namedtuple('ScoreDistribution', ['mean', 'median', 'spread', 'scores'])
 
-        elif file_type == 'csv':
-            return df.to_csv().encode('utf-8')
+ParsedResult = namedtuple('ParsedResult', ['score', 'explanation', 'sub_scores'])
 
-        elif file_type == 'tsv':
-            return df.to_csv(sep='\t').encode('utf-8')
+# Formats GPT can be asked to answer in: the text of the examples, or a JSON object (see prompts.JSON_OUTPUT)
+OUTPUT_FORMATS = ('text', 'json')
+
+# Criteria graded out of 5 each, the total is out of 20. They are the criteria of the grading examples, and stand
+# in for the Airman Leadership Qualities of the prompt (prompts.ALQ), which the examples and the total are not
+# broken down by
+CRITERIA = ('action', 'result', 'impact', 'scope')
+MAX_CRITERION_SCORE = 5
+MAX_TOTAL_SCORE = 20
+
+# Everything the text format is parsed for, in a single scan: the criteria headers ('- Action:'), their scores
+# ('Score: 3/5') and the total ('Total Score: 12/20')
+TEXT_RESULT_PATTERN = re.compile(
+    r'(?P<total>Total Score:\s*(?P<total_score>\d+(?:\.\d+)?)\s*/\s*20)'
+    r'|(?P<criterion>^[ \t]*-?[ \t]*(?P<name>Action|Result|Impact|Scope):)'
+    r'|(?:Score:\s*(?P<criterion_score>\d+(?:\.\d+)?)\s*/\s*5)',
+    re.MULTILINE | re.IGNORECASE)
+
+
+def _find_total_score(text):
+    # Last 'Total Score' of the text, as a match of TEXT_RESULT_PATTERN, or None. As in the baseline, a result that
+    # repeats it is cut at the last one
+    total = None
+    for match in TEXT_RESULT_PATTERN.finditer(text):
+        if match.group('total') is not None:
+            total = match
+    return total
 
-        else:
-            return ValueError('Invalid file type.')
 
 class StatementPreprocessor:
     """
     Preprocessor for the user input to GPT. Notably, includes the mechanisms to build prompts.
+    Everything but the statement itself (the system message, the grading criteria for the award, tier, wing and
+    squadron, and the examples) is a prefix that only depends on the statement parameters, so it is built once per
+    combination of parameters and reused for every statement.
     """
 
-    def extraction_prompt(self, x, parameters):
+    def __init__(self, cache_size=128):
+        self._prompt_prefix = functools.lru_cache(maxsize=cache_size)(self._build_prompt_prefix)
+
+    def prompt_prefix(self, parameters, output_format='text'):
+        """
+        Returns the (memoized) PromptPrefix for the statement parameters and output format ('text' or 'json'):
+        the messages preceding the statement, a hash of their content, and their number of tokens.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown output format {output_format}, expected one of {", ".join(OUTPUT_FORMATS)}.')
+        return self._prompt_prefix(parameters['award'], parameters['tier'], parameters['wg'], parameters['sq'],
+                                   output_format)
+
+    def extraction_prompt(self, x, parameters, output_format='text'):
+        prefix = self.prompt_prefix(parameters, output_format)
+        messages = list(prefix.messages)
+        messages.append({'role': 'user', 'content': x})
+        logging.info(f'GPT Prompt: prefix {prefix.hash[:12]} ({prefix.token_count} tokens) + {x!r}')
+        return messages
+
+    def _build_prompt_prefix(self, award, tier, wg, sq, output_format='text'):
+        # The parameters are keys of the prompt dictionaries, but full texts are accepted as well
+        award = award_dict.get(award, award)
+        tier = tier_dict.get(tier, tier)
+        wg = wg_pri_dict.get(wg, wg)
+        sq = sq_pri_dict.get(sq, sq)
 
         main_prompt = \
 f"""
 This is the definition of a performance statement:
     {OVERVIEW}
     This is the definition of the award you are grading for:
-    {parameters['award']}
+    {award}
     This is the award nominee's rank tier and the expectations for that tier that you should take into account when grading:
-    {parameters['tier']}
+    {tier}
     This is the Wing Commander's priorities that you should take into account when grading:
-    {parameters['wg']}
+    {wg}
     This is the Squadron Commander's priorities that you should take into account when grading:
-    {parameters['sq']}
+    {sq}
     These are the Airman Leadership Qualities that you should grade the performance statement on:
     {ALQ}
 """
-        messages = [
+        messages = (
             {'role': 'system', 'content': SYSTEM},
             {'role': 'user', 'content': main_prompt},
             {'role': 'system', 'name': 'example_user', 'content': examples[0][0]},
             {'role': 'system', 'name': 'example_assistant', 'content': examples[0][1]},
             {'role': 'system', 'name': 'example_user', 'content': examples[1][0]},
             {'role': 'system', 'name': 'example_assistant', 'content': examples[1][0]},
-            {'role': 'user', 'content': x}
-        ]
-        logging.info(f'GPT Prompt: {messages}')
-        return messages
+        )
+        if output_format == 'json':
+            messages += ({'role': 'system', 'content': JSON_OUTPUT},)
+        prefix_hash = hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+        token_count = count_message_tokens(messages)
+
+        logging.debug(f'GPT Prompt prefix {prefix_hash[:12]}: {messages}')
+        return PromptPrefix(messages, prefix_hash, token_count)
+
 
 class StatementPostprocessor:
     """
     Postprocessor for the GPT raw outputs.
     """
 
-    def extract_score_from_result(self, result):
+    def extract_score_from_result(self, result, log=True):
         """
         Extracts the score from the result string
         """
-        score_pattern = r'Total Score: (\d+(\.\d+)?)/20'
-        match = re.search(score_pattern, result)
+        match = _find_total_score(result)
 
         if match:
-            score = float(match.group(1))
+            score = float(match.group('total_score'))
             return score
         else:
+            if log:
+                logging.info('No score found')
+            return None
+
+    def parse_result(self, result):
+        """
+        Parses a result, in either output format, into a ParsedResult: the total score, the justification (in the
+        text format) and the score of every criterion (None if missing). A JSON result is validated against the
+        schema; a result that is not valid JSON is parsed as text, so format drift does not lose the evaluation.
+        """
+        if '{' in result:
+            parsed = self._parse_json_result(result)
+            if parsed is not None:
+                return parsed
+        return self._parse_text_result(result)
+
+    def _parse_json_result(self, result):
+        # The object may be wrapped in a code block or in a sentence
+        try:
+            answer = json.loads(result[result.index('{'):result.rindex('}') + 1])
+        except ValueError:
+            return None
+        if not isinstance(answer, dict):
+            return None
+
+        sub_scores, sections = {}, []
+        for criterion in CRITERIA:
+            section = answer.get(criterion)
+            if not isinstance(section, dict):
+                section = {}
+            sub_scores[criterion] = self._bounded_score(section.get('score'), MAX_CRITERION_SCORE)
+            justification = section.get('justification')
+            if justification or sub_scores[criterion] is not None:
+                score = f'{sub_scores[criterion]:g}' if sub_scores[criterion] is not None else '?'
+                sections.append(f'- {criterion.capitalize()}: {justification or ""}\nScore: {score}/5')
+
+        score = self._bounded_score(answer.get('total'), MAX_TOTAL_SCORE)
+        if score is None and all(s is not None for s in sub_scores.values()):
+            score = sum(sub_scores.values())
+        if score is None:
+            logging.info('No score found in the JSON result.')
+            return None
+
+        if answer.get('justification'):
+            sections.append(str(answer['justification']))
+        return ParsedResult(score, '\n\n'.join(sections), sub_scores)
+
+    @staticmethod
+    def _bounded_score(value, maximum):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return value if 0 <= value <= maximum else None
+
+    def _parse_text_result(self, result):
+        score, explanation = None, None
+        sub_scores = dict.fromkeys(CRITERIA)
+        criterion = None
+        for match in TEXT_RESULT_PATTERN.finditer(result):
+            if match.group('total') is not None:
+                # The last one wins
+                score = float(match.group('total_score'))
+                explanation = result[:match.start()].strip()
+            elif match.group('criterion') is not None:
+                criterion = match.group('name').lower()
+            elif criterion is not None and sub_scores[criterion] is None:
+                sub_scores[criterion] = self._bounded_score(match.group('criterion_score'), MAX_CRITERION_SCORE)
+
+        if score is None:
             logging.info('No score found')
+        return ParsedResult(score, explanation, sub_scores)
+
+    def aggregate_scores(self, scores):
+        """
+        Distribution of the scores of several samples of the same evaluation: their mean, median and spread
+        (highest minus lowest). Samples without a score are left out, and None is returned if none has one.
+        """
+        scores = sorted(score for score in scores if score is not None)
+        if not scores:
             return None
+        middle = len(scores) // 2
+        median = scores[middle] if len(scores) % 2 == 1 else (scores[middle - 1] + scores[middle]) / 2
+        return ScoreDistribution(mean=sum(scores) / len(scores), median=median, spread=scores[-1] - scores[0],
+                                 scores=scores)
+
+    def scores_agree(self, scores, tolerance):
+        """
+        Whether all the samples have a score, and these scores are within tolerance of each other.
+        """
+        if not scores or any(score is None for score in scores):
+            return False
+        return max(scores) - min(scores) <= tolerance
 
     def extract_action_from_result(self, result):
         action_pattern = r'- Action: (.*?)(?=Score:)'
@@ -272,19 +1318,102 @@ class StatementPostprocessor:
             logging.info('No explanation found.')
             return None
 
-    def result_to_tuple(self, result, statement, parameters, user, user_score):
+    def result_to_tuple(self, result, statement, parameters, user, user_score, usage=None):
         """
         Converts a string that looks like a tuple to an actual Python tuple.
         """
+        return self.results_to_tuple([result], statement, parameters, user, user_score, usage)
+
+    def results_to_tuple(self, results, statement, parameters, user, user_score, usage=None):
+        """
+        Converts the results of one or more samples of the same evaluation to a statement tuple. The score is the
+        median of the samples' scores, the justification and criteria scores the ones of the sample closest to it,
+        and the mean, spread and scores of the samples are kept along. Every result is parsed once.
+        """
+        parsed = [self.parse_result(result) for result in results]
+        distribution = self.aggregate_scores([p.score for p in parsed])
+
         statement = statement
-        score = self.extract_score_from_result(result)
         user_score = user_score
-        explanation = self.extract_explanation_from_result(result)
+        if distribution is None:
+            score, score_mean, score_spread, score_samples = None, None, None, None
+            closest = parsed[0]
+        else:
+            score, score_mean, score_spread = distribution.median, distribution.mean, distribution.spread
+            score_samples = ';'.join(f'{s:g}' for s in distribution.scores)
+            closest = min((p for p in parsed if p.score is not None), key=lambda p: abs(p.score - distribution.median))
+        explanation = closest.explanation
+        if explanation is None:
+            logging.info('No explanation found.')
+        sub_scores = [closest.sub_scores[criterion] for criterion in CRITERIA]
         award = parameters['award']
         tier = parameters['tier']
         wg = parameters['wg']
         sq = parameters['sq']
         user = user
         date_time = dt.now()
+        prompt_tokens = usage['prompt_tokens'] if usage is not None else None
+        completion_tokens = usage['completion_tokens'] if usage is not None else None
+
+        return (statement, score, user_score, explanation, award, tier, wg, sq, user, date_time,
+                prompt_tokens, completion_tokens, score_mean, score_spread, score_samples, *sub_scores)
+
+
+class StreamingResultParser:
+    """
+    Incremental parser for a GPT result that arrives piece by piece. The score is looked up only in the new
+    piece (plus a small overlap, for a score split across pieces), so parsing the stream stays linear in its length.
+    The pattern allows any whitespace inside the score, so a split score can be longer than the overlap: finish
+    parses the whole result once the stream has ended.
+    """
+
+    # Length of the score pattern without unusual whitespace, e.g., 'Total Score: 12.5/20'
+    _overlap = 32
+
+    def __init__(self, postprocessor):
+        self._postprocessor = postprocessor
+        self._pieces = []
+        self._tail = ''
+        self._length = 0
+        # Position of the 'Total Score' line in the result, once found
+        self._score_start = None
+
+        self.score = None
 
-        return statement, score, user_score, explanation, award, tier, wg, sq, user, date_time
\ No newline at end of file
+    @property
+    def result(self):
+        if len(self._pieces) > 1:
+            self._pieces = [''.join(self._pieces)]
+        return self._pieces[0] if self._pieces else ''
+
+    def feed(self, piece):
+        self._pieces.append(piece)
+
+        # Same pattern as the final parse, so both find the same score: the last one
+        window = self._tail + piece
+        match = _find_total_score(window)
+        if match is not None:
+            self.score = float(match.group('total_score'))
+            self._score_start = self._length - len(self._tail) + match.start()
+        self._tail = window[-self._overlap:]
+        self._length += len(piece)
+
+    def finish(self):
+        """
+        Parses the whole result, once the stream has ended. Returns whether the score or the justification changed.
+        """
+        match = _find_total_score(self.result)
+        score = float(match.group('total_score')) if match is not None else None
+        score_start = match.start() if match is not None else None
+        changed = (score, score_start) != (self.score, self._score_start)
+        self.score, self._score_start = score, score_start
+        return changed
+
+    def justification(self):
+        """
+        The text received so far, without the 'Total Score' line once it has arrived.
+        """
+        result = self.result
+        if self.score is not None:
+            return result[:self._score_start].strip()
+        return result.strip()
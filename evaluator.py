@@ -0,0 +1,364 @@
+"""
+Command line interface of the Evaluator engine, to grade statements outside of the Streamlit app, e.g.:
+
+    python -m evaluator grade statements.csv --award 'of the Quarter' --tier NCO --output graded.csv
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import pandas as pd
+
+from backends import LocalModelBackend, OpenAIBackend, OpenAICompatibleBackend, GRADE, PRESCREEN
+from engine import EvaluatorEngine
+from exports import format_from_path, write_export
+from jobs import JobCommitter, JobQueue, WorkerPool, run_worker_processes
+from service import EngineService, DEFAULT_PORT
+from storage import convert_database
+from wal import WriteAheadLogLocked
+
+
+def read_statements(input_path, chunk_size, column='statement'):
+    """
+    Yields the statements of a CSV or JSONL file (with a statement column and optionally a user_score one) in
+    chunks of chunk_size pairs (statement, user_score), without loading the whole file.
+    """
+    if input_path.endswith('.jsonl'):
+        chunk = []
+        with open(input_path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    chunk.append((record[column], record.get('user_score')))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+    else:
+        for df in pd.read_csv(input_path, chunksize=chunk_size):
+            user_scores = df['user_score'] if 'user_score' in df.columns else [None] * len(df)
+            yield [(s, None if pd.isna(u) else u) for s, u in zip(df[column], user_scores)]
+
+
+class ResultWriter:
+    """
+    Writes graded statements to a CSV or JSONL file as they come, chunk by chunk.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self._header_written = False
+
+        # Start from an empty file
+        open(self.output_path, 'w').close()
+
+    def write(self, evaluations):
+        df = pd.DataFrame(evaluations)
+        if self.output_path.endswith('.jsonl'):
+            df.to_json(self.output_path, mode='a', orient='records', lines=True, date_format='iso')
+        else:
+            df.to_csv(self.output_path, mode='a', header=not self._header_written, index=False)
+        self._header_written = True
+
+
+def prescreen_backend(args):
+    """
+    Backend of the prescreen, if one is given: a local GGUF model or an OpenAI-compatible server.
+    """
+    if args.prescreen_model_path is not None:
+        return LocalModelBackend(args.prescreen_model_path, n_threads=args.prescreen_threads)
+    if args.prescreen_base is not None:
+        return OpenAICompatibleBackend(args.prescreen_base, model=args.prescreen_model,
+                                       max_concurrency=args.prescreen_workers)
+    return None
+
+
+def grading_engine(args, read_only=False):
+    """
+    Engine grading with the GPT and prescreen arguments of the grade and serve commands.
+    """
+    backends, routes = None, None
+    prescreen = prescreen_backend(args)
+    if prescreen is not None:
+        backends = {'openai': OpenAIBackend(api_key=args.api_key, api_base=args.api_base,
+                                            max_concurrency=args.workers),
+                    'prescreen': prescreen}
+        routes = {GRADE: 'openai', PRESCREEN: 'prescreen'}
+
+    return EvaluatorEngine(api_key=args.api_key,
+                           database_file_path=args.database,
+                           gpt_engine=args.model,
+                           gpt_temperature=args.temperature,
+                           api_base=args.api_base,
+                           max_concurrent_requests=args.workers,
+                           cache_file_path=None if args.no_cache else args.cache,
+                           lookup_file_path=args.lookup,
+                           metrics_file_path=args.metrics,
+                           backends=backends,
+                           routes=routes,
+                           read_only=read_only)
+
+
+def grade(args):
+    # Only an engine that commits writes the database, the others can run next to the app
+    engine = grading_engine(args, read_only=not args.commit)
+    session = engine.new_session()
+    session.prescreen = engine.routes[PRESCREEN] != engine.routes[GRADE]
+    session.validation = not args.no_validation
+    session.output_format = 'json' if args.json else 'text'
+    session.statement_parameters.update(award=args.award, tier=args.tier, wg=args.wg, sq=args.sq)
+
+    writer = ResultWriter(args.output) if args.output is not None else None
+    n_graded, n_invalid = 0, 0
+    for chunk in read_statements(args.input, args.chunk_size, column=args.column):
+        statements, user_scores = zip(*chunk)
+        session.extract_evaluations(statements, args.user, user_scores=list(user_scores), resample=args.resample)
+        evaluations = session.extracted_evaluations()
+
+        if writer is not None:
+            writer.write(evaluations)
+        else:
+            for e in evaluations:
+                print(json.dumps(e, default=str))
+
+        n_graded += len(evaluations)
+        n_invalid += sum(e['Justification'] is None for e in evaluations)
+        if args.commit:
+            session.commit_batch()
+        else:
+            session.cancel_batch()
+        logging.info(f'Graded {n_graded} statements.')
+    engine.close()
+
+    print(f'Graded {n_graded} statements ({n_invalid} could not be evaluated).', file=sys.stderr)
+    if session.prescreen:
+        print(f"{engine.metrics.counters().get('prescreen_rejections', 0)} statements were rejected by the "
+              f"prescreen.", file=sys.stderr)
+    for row in engine.metrics.summary():
+        logging.info(f"{row['stage']}: {row['count']} spans, p50 {row['p50'] * 1000:.1f} ms, "
+                     f"p95 {row['p95'] * 1000:.1f} ms, p99 {row['p99'] * 1000:.1f} ms")
+
+
+def submit(args):
+    engine = EvaluatorEngine(database_file_path=args.database, cache_file_path=None, lookup_file_path=args.lookup,
+                             gpt_engine=args.model, gpt_temperature=args.temperature, read_only=True)
+    session = engine.new_session()
+    session.statement_parameters.update(award=args.award, tier=args.tier, wg=args.wg, sq=args.sq)
+    session.output_format = 'json' if args.json else 'text'
+
+    statements, user_scores = [], []
+    for chunk in read_statements(args.input, 1000, column=args.column):
+        for statement, user_score in chunk:
+            statements.append(statement)
+            user_scores.append(user_score)
+    job_id = session.submit_evaluations(JobQueue(args.queue), statements, args.user, user_scores=user_scores,
+                                        resample=args.resample, commit=not args.no_commit)
+    print(job_id)
+    print(f'Queued job {job_id} ({len(statements)} statements).', file=sys.stderr)
+
+
+def jobs(args):
+    for job in JobQueue(args.queue).jobs(user=args.user, limit=args.limit):
+        print(json.dumps(job))
+
+
+def worker(args):
+    engine_arguments = dict(api_key=args.api_key, api_base=args.api_base, database_file_path=args.database,
+                            lookup_file_path=args.lookup, cache_file_path=None if args.no_cache else args.cache,
+                            max_concurrent_requests=args.workers, metrics_file_path=args.metrics)
+    run_worker_processes(args.queue, engine_arguments, n_processes=args.processes, commit=args.commit)
+
+
+def serve(args):
+    engine = grading_engine(args)
+    # The service commits the evaluations of the background jobs, graded by its own workers or by worker processes
+    job_queue = JobQueue(args.queue)
+    committer = JobCommitter(engine, job_queue).start()
+    pool = None
+    if args.job_workers > 0:
+        pool = WorkerPool(engine, job_queue, n_workers=args.job_workers, commit=False).start()
+
+    service = EngineService(engine, host=args.host, port=args.port)
+    print(f'Serving the engine on {service.url}', file=sys.stderr)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.stop()
+        committer.stop()
+        engine.close()
+
+
+def convert(args):
+    n_rows = convert_database(args.source, args.destination)
+    print(f'Converted {n_rows} evaluations.', file=sys.stderr)
+
+
+def export(args):
+    engine = EvaluatorEngine(database_file_path=args.database, cache_file_path=None, lookup_file_path=args.lookup,
+                             read_only=True)
+    evaluations = engine.search(args.query, award=args.award, tier=args.tier, wg=args.wg, sq=args.sq,
+                                user=args.user, min_score=args.min_score, max_score=args.max_score,
+                                start=args.start, end=args.end, limit=args.limit)
+    with open(args.output, 'wb') as f:
+        write_export(evaluations, f, args.format or format_from_path(args.output), chunk_size=args.chunk_size)
+    print(f'Exported {len(evaluations)} evaluations.', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='evaluator', description='Grade Air Force performance statements with GPT.')
+    parser.add_argument('--verbose', action='store_true', help='Log what the engine is doing.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    grade_parser = subparsers.add_parser('grade', help='Grade the statements of a CSV or JSONL file.')
+    grade_parser.add_argument('input', help='CSV or JSONL file with a statement column (and optionally user_score).')
+    grade_parser.add_argument('--output', default=None,
+                              help='CSV or JSONL file to write the evaluations to (default: JSON lines on stdout).')
+    grade_parser.add_argument('--column', default='statement', help='Column holding the statements.')
+    grade_parser.add_argument('--award', default='Performer of the Month')
+    grade_parser.add_argument('--tier', default='Amn')
+    grade_parser.add_argument('--wg', default='480 ISRW')
+    grade_parser.add_argument('--sq', default='30 IS')
+    grade_parser.add_argument('--user', default=None, help='Name recorded as the user of the evaluations.')
+    grade_parser.add_argument('--model', default='gpt-3.5-turbo')
+    grade_parser.add_argument('--temperature', type=float, default=0.7)
+    grade_parser.add_argument('--workers', type=int, default=8, help='Maximum number of concurrent GPT requests.')
+    grade_parser.add_argument('--chunk-size', type=int, default=50,
+                              help='Number of statements read, graded and written at a time.')
+    grade_parser.add_argument('--commit', action='store_true', help='Also add the evaluations to the database.')
+    grade_parser.add_argument('--database', default='./data/default_database.csv')
+    grade_parser.add_argument('--lookup', default='./data/lookup.csv')
+    grade_parser.add_argument('--cache', default='./data/completion_cache.sqlite')
+    grade_parser.add_argument('--no-cache', action='store_true', help='Do not use the completion cache.')
+    grade_parser.add_argument('--resample', action='store_true', help='Ignore cached evaluations.')
+    grade_parser.add_argument('--json', action='store_true',
+                              help='Ask GPT for a JSON object with the score of every criterion.')
+    grade_parser.add_argument('--no-validation', action='store_true',
+                              help='Send every statement to GPT, even the ones that fail the rule-based checks.')
+    grade_parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY'))
+    grade_parser.add_argument('--api-base', default=None, help='Base URL of an OpenAI compatible API.')
+    grade_parser.add_argument('--metrics', default=None, help='JSONL file to append the timing spans to.')
+    grade_parser.add_argument('--prescreen-base', default=None,
+                              help='Base URL of an OpenAI compatible server (e.g., a local model) that prescreens the '
+                                   'statements: only the ones it can score are graded by GPT.')
+    grade_parser.add_argument('--prescreen-model', default=None, help='Model to ask the prescreen server for.')
+    grade_parser.add_argument('--prescreen-workers', type=int, default=4,
+                              help='Maximum number of concurrent prescreen requests.')
+    grade_parser.add_argument('--prescreen-model-path', default=None,
+                              help='GGUF model run on the CPU to prescreen the statements (needs llama-cpp-python).')
+    grade_parser.add_argument('--prescreen-threads', type=int, default=None, help='CPU threads of the local model.')
+    grade_parser.set_defaults(function=grade)
+
+    export_parser = subparsers.add_parser('export', help='Export the evaluations matching a search.')
+    export_parser.add_argument('output', help='File to export to, in the format given by its extension '
+                                              '(csv, tsv, jsonl, parquet or xlsx) unless --format is given.')
+    export_parser.add_argument('--format', default=None, choices=['csv', 'tsv', 'jsonl', 'parquet', 'excel'])
+    export_parser.add_argument('--query', default=None,
+                               help='Words that must appear in the statement or its justification.')
+    export_parser.add_argument('--award', default=None)
+    export_parser.add_argument('--tier', default=None)
+    export_parser.add_argument('--wg', default=None)
+    export_parser.add_argument('--sq', default=None)
+    export_parser.add_argument('--user', default=None)
+    export_parser.add_argument('--min-score', type=float, default=None)
+    export_parser.add_argument('--max-score', type=float, default=None)
+    export_parser.add_argument('--start', default=None, help='Earliest evaluation time, e.g., 2023-04-01.')
+    export_parser.add_argument('--end', default=None, help='Latest evaluation time.')
+    export_parser.add_argument('--limit', type=int, default=None, help='Only export the most recent evaluations.')
+    export_parser.add_argument('--chunk-size', type=int, default=10000, help='Number of rows written at a time.')
+    export_parser.add_argument('--database', default='./data/default_database.csv')
+    export_parser.add_argument('--lookup', default='./data/lookup.csv')
+    export_parser.set_defaults(function=export)
+
+    submit_parser = subparsers.add_parser('submit', help='Queue the statements of a CSV or JSONL file, to be graded '
+                                                         'by the workers. Prints the id of the job.')
+    submit_parser.add_argument('input', help='CSV or JSONL file with a statement column (and optionally user_score).')
+    submit_parser.add_argument('--column', default='statement', help='Column holding the statements.')
+    submit_parser.add_argument('--award', default='Performer of the Month')
+    submit_parser.add_argument('--tier', default='Amn')
+    submit_parser.add_argument('--wg', default='480 ISRW')
+    submit_parser.add_argument('--sq', default='30 IS')
+    submit_parser.add_argument('--user', default=None, help='Name recorded as the user of the evaluations.')
+    submit_parser.add_argument('--model', default='gpt-3.5-turbo')
+    submit_parser.add_argument('--temperature', type=float, default=0.7)
+    submit_parser.add_argument('--json', action='store_true',
+                               help='Ask GPT for a JSON object with the score of every criterion.')
+    submit_parser.add_argument('--resample', action='store_true', help='Ignore cached evaluations.')
+    submit_parser.add_argument('--no-commit', action='store_true',
+                               help='Keep the evaluations in the queue instead of adding them to the database.')
+    submit_parser.add_argument('--queue', default='./data/jobs.sqlite')
+    submit_parser.add_argument('--database', default='./data/default_database.csv')
+    submit_parser.add_argument('--lookup', default='./data/lookup.csv')
+    submit_parser.set_defaults(function=submit)
+
+    jobs_parser = subparsers.add_parser('jobs', help='List the most recent jobs and their progress.')
+    jobs_parser.add_argument('--user', default=None)
+    jobs_parser.add_argument('--limit', type=int, default=20)
+    jobs_parser.add_argument('--queue', default='./data/jobs.sqlite')
+    jobs_parser.set_defaults(function=jobs)
+
+    worker_parser = subparsers.add_parser('worker', help='Grade the queued jobs until interrupted.')
+    worker_parser.add_argument('--processes', type=int, default=2, help='Number of worker processes.')
+    worker_parser.add_argument('--workers', type=int, default=8,
+                               help='Maximum number of concurrent GPT requests per process.')
+    worker_parser.add_argument('--queue', default='./data/jobs.sqlite')
+    worker_parser.add_argument('--database', default='./data/default_database.csv')
+    worker_parser.add_argument('--lookup', default='./data/lookup.csv')
+    worker_parser.add_argument('--cache', default='./data/completion_cache.sqlite')
+    worker_parser.add_argument('--no-cache', action='store_true', help='Do not use the completion cache.')
+    worker_parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY'))
+    worker_parser.add_argument('--api-base', default=None, help='Base URL of an OpenAI compatible API.')
+    worker_parser.add_argument('--metrics', default=None, help='JSONL file to append the timing spans to.')
+    worker_parser.add_argument('--commit', action='store_true',
+                               help='Also commit the evaluations to the database, when neither the app nor the '
+                                    'engine service runs (they commit them otherwise).')
+    worker_parser.set_defaults(function=worker)
+
+    serve_parser = subparsers.add_parser('serve', help='Serve the engine to the processes of the app over HTTP, '
+                                                       'until interrupted.')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument('--model', default='gpt-3.5-turbo')
+    serve_parser.add_argument('--temperature', type=float, default=0.7)
+    serve_parser.add_argument('--workers', type=int, default=8, help='Maximum number of concurrent GPT requests.')
+    serve_parser.add_argument('--job-workers', type=int, default=2,
+                              help='Threads grading the background jobs of the queue (0: none).')
+    serve_parser.add_argument('--queue', default='./data/jobs.sqlite')
+    serve_parser.add_argument('--database', default='./data/default_database.csv')
+    serve_parser.add_argument('--lookup', default='./data/lookup.csv')
+    serve_parser.add_argument('--cache', default='./data/completion_cache.sqlite')
+    serve_parser.add_argument('--no-cache', action='store_true', help='Do not use the completion cache.')
+    serve_parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY'))
+    serve_parser.add_argument('--api-base', default=None, help='Base URL of an OpenAI compatible API.')
+    serve_parser.add_argument('--metrics', default=None, help='JSONL file to append the timing spans to.')
+    serve_parser.add_argument('--prescreen-base', default=None,
+                              help='Base URL of an OpenAI compatible server (e.g., a local model) that prescreens the '
+                                   'statements of the sessions that ask for it.')
+    serve_parser.add_argument('--prescreen-model', default=None, help='Model to ask the prescreen server for.')
+    serve_parser.add_argument('--prescreen-workers', type=int, default=4,
+                              help='Maximum number of concurrent prescreen requests.')
+    serve_parser.add_argument('--prescreen-model-path', default=None,
+                              help='GGUF model run on the CPU to prescreen the statements (needs llama-cpp-python).')
+    serve_parser.add_argument('--prescreen-threads', type=int, default=None, help='CPU threads of the local model.')
+    serve_parser.set_defaults(function=serve)
+
+    convert_parser = subparsers.add_parser('convert', help='Convert the database between CSV and Parquet.')
+    convert_parser.add_argument('source', help='Database to convert, e.g., ./data/default_database.csv')
+    convert_parser.add_argument('destination', help='Converted database, in Parquet if it ends with .parquet')
+    convert_parser.set_defaults(function=convert)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    try:
+        args.function(args)
+    except WriteAheadLogLocked as e:
+        parser.exit(1, f'{parser.prog}: {e} Stop it, or commit through it.\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import logging
+
+# File extension and MIME type of every export format
+EXPORT_FORMATS = {'csv': ('csv', 'text/csv'),
+                  'tsv': ('tsv', 'text/tab-separated-values'),
+                  'jsonl': ('jsonl', 'application/jsonl'),
+                  'parquet': ('parquet', 'application/vnd.apache.parquet'),
+                  'excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Exports larger than this many bytes spill from memory to a temporary file
+EXPORT_SPOOL_SIZE = 16 * 2 ** 20
+
+
+def format_from_path(path):
+    """
+    Export format of a file path, from its extension.
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    for file_type, (file_extension, _) in EXPORT_FORMATS.items():
+        if extension == file_extension:
+            return file_type
+    raise ValueError(f'Unknown export format for {path}.')
+
+
+def iter_export(df, file_type='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Serializes the DataFrame chunk by chunk, yielding bytes as they are ready, so a large export never holds more
+    than a chunk in its serialized form. Only the text formats (csv, tsv and jsonl) can be streamed this way.
+    """
+    if file_type not in ('csv', 'tsv', 'jsonl'):
+        raise ValueError(f'Cannot stream {file_type} exports, only csv, tsv and jsonl.')
+
+    for start in range(0, max(len(df), 1), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        if file_type == 'jsonl':
+            if len(chunk) == 0:
+                break
+            text = chunk.to_json(orient='records', lines=True, date_format='iso')
+            # Older pandas versions do not end the last line
+            yield (text if text.endswith('\n') else text + '\n').encode('utf-8')
+        else:
+            # The header only goes with the first chunk
+            yield chunk.to_csv(sep='\t' if file_type == 'tsv' else ',', header=start == 0).encode('utf-8')
+
+
+def write_export(df, file, file_type='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the DataFrame to a binary file object in the given format (csv, tsv, jsonl, parquet or excel), a chunk
+    of rows at a time. Parquet exports need pyarrow and Excel ones xlsxwriter.
+    """
+    if file_type not in EXPORT_FORMATS:
+        raise ValueError(f'Invalid file type {file_type}, expected one of {", ".join(EXPORT_FORMATS)}.')
+
+    if file_type == 'parquet':
+        _write_parquet(df, file, chunk_size)
+    elif file_type == 'excel':
+        _write_excel(df, file)
+    else:
+        for data in iter_export(df, file_type, chunk_size):
+            file.write(data)
+    logging.info(f'Exported {len(df)} rows as {file_type}.')
+
+
+def _typed_chunk(chunk):
+    # Same types as the Parquet database, with plain strings instead of categories so that all the row groups
+    # share a schema
+    from storage import DATABASE_COLUMNS, ParquetStore
+
+    known_columns = [c for c in chunk.columns if c in DATABASE_COLUMNS]
+    typed = ParquetStore.typed(chunk[known_columns])
+    chunk = chunk.copy()
+    for column in known_columns:
+        chunk[column] = typed[column].astype('string') if typed[column].dtype == 'category' else typed[column]
+    return chunk
+
+
+def _write_parquet(df, file, chunk_size):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet exports require pyarrow (pip install pyarrow).') from None
+
+    writer, schema = None, None
+    try:
+        for start in range(0, max(len(df), 1), chunk_size):
+            table = pa.Table.from_pandas(_typed_chunk(df.iloc[start:start + chunk_size]), schema=schema,
+                                         preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(file, schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _excel_value(value):
+    import pandas as pd
+
+    # xlsxwriter cannot write missing values, they are left blank
+    try:
+        return None if pd.isna(value) else value
+    except (TypeError, ValueError):
+        return value
+
+
+def _write_excel(df, file):
+    try:
+        import xlsxwriter
+    except ImportError:
+        raise ImportError('Excel exports require xlsxwriter (pip install xlsxwriter).') from None
+
+    # In constant memory mode every row is flushed to disk as soon as the next one starts
+    workbook = xlsxwriter.Workbook(file, {'constant_memory': True, 'remove_timezone': True})
+    worksheet = workbook.add_worksheet()
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+
+    worksheet.write_row(0, 1, [str(c) for c in df.columns])
+    for row_number, row in enumerate(df.itertuples(index=True, name=None), start=1):
+        for column_number, value in enumerate(row):
+            value = _excel_value(value)
+            if value is None:
+                continue
+            if hasattr(value, 'to_pydatetime'):
+                worksheet.write_datetime(row_number, column_number, value.to_pydatetime(), date_format)
+            else:
+                worksheet.write(row_number, column_number, value)
+    workbook.close()
@@ -0,0 +1,453 @@
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from codec import decode_statement_tuple, dumps
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# A task is given back to the queue if its worker has not finished it after this many seconds, e.g., because the
+# worker process died
+DEFAULT_LEASE = 600
+
+# A task that failed this many times is not retried anymore
+MAX_ATTEMPTS = 3
+
+# Values of the committed column of the tasks: taken for a commit that may or may not have reached the database
+# yet (e.g., if the process died in the middle), and committed for sure
+COMMITTING = 2
+COMMITTED = 1
+
+Task = namedtuple('Task', ['position', 'statement', 'user_score'])
+Claim = namedtuple('Claim', ['job_id', 'user', 'settings', 'tasks'])
+
+
+class JobQueue:
+    """
+    Durable queue of grading jobs, stored in a SQLite file. A job is a package of statements graded under the
+    settings of the session that submitted it (see EvaluationSession.settings); every statement is a task. Workers,
+    in this process or in others, claim the queued tasks of a job a few at a time, and store the evaluations back
+    in the queue, where they stay until they are committed to the database. Claims are leases: the tasks of a
+    worker that died go back to the queue when the lease expires, so a job survives restarts of the app and of
+    the workers.
+    """
+
+    def __init__(self, file_path='./data/jobs.sqlite', lease=DEFAULT_LEASE, max_attempts=MAX_ATTEMPTS):
+        self.file_path = file_path
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        # Shared by the threads of the process, hence a single connection behind a lock. Transactions are explicit
+        # (BEGIN IMMEDIATE), so that two processes never claim the same task.
+        self._lock = threading.Lock()
+        # Serializes the commits of this process (see commit_finished)
+        self._commit_lock = threading.Lock()
+        self._connection = sqlite3.connect(self.file_path, check_same_thread=False, timeout=30,
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'user TEXT, '
+                               'settings TEXT NOT NULL, '
+                               'commit_results INTEGER NOT NULL, '
+                               'status TEXT NOT NULL, '
+                               'n_tasks INTEGER NOT NULL, '
+                               'created REAL NOT NULL, '
+                               'updated REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                               'job_id INTEGER NOT NULL, '
+                               'position INTEGER NOT NULL, '
+                               'statement TEXT NOT NULL, '
+                               'user_score REAL, '
+                               'status TEXT NOT NULL, '
+                               'attempts INTEGER NOT NULL DEFAULT 0, '
+                               'leased_until REAL, '
+                               'result TEXT, '
+                               'error TEXT, '
+                               'committed INTEGER NOT NULL DEFAULT 0, '
+                               'PRIMARY KEY (job_id, position))')
+            connection.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, job_id)')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def submit(self, statement_utterances, user, user_scores=None, settings=None, commit=True):
+        """
+        Queues a job grading the statements, and returns its id.
+        """
+        statement_utterances = list(statement_utterances)
+        if user_scores is None:
+            user_scores = [None] * len(statement_utterances)
+
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute('INSERT INTO jobs (user, settings, commit_results, status, n_tasks, created, '
+                                        'updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (user, json.dumps(settings or {}), int(commit),
+                                         QUEUED if statement_utterances else DONE, len(statement_utterances),
+                                         now, now))
+            job_id = cursor.lastrowid
+            connection.executemany('INSERT INTO tasks (job_id, position, statement, user_score, status) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   [(job_id, i, s, None if u is None else float(u), QUEUED)
+                                    for i, (s, u) in enumerate(zip(statement_utterances, user_scores))])
+        logging.info(f'Queued job {job_id} ({len(statement_utterances)} statements).')
+        return job_id
+
+    def claim(self, worker, limit):
+        """
+        Leases up to limit tasks of the oldest job with tasks left to the worker (a name, for the logs), and
+        returns them as a Claim, or None if there is nothing to do.
+        """
+        now = time.time()
+        available = f"(t.status = '{QUEUED}' OR (t.status = '{RUNNING}' AND t.leased_until < ?))"
+        with self._transaction() as connection:
+            row = connection.execute(f'SELECT t.job_id FROM tasks t JOIN jobs j ON j.id = t.job_id '
+                                     f"WHERE j.status IN ('{QUEUED}', '{RUNNING}') AND {available} "
+                                     f'ORDER BY t.job_id LIMIT 1', (now,)).fetchone()
+            if row is None:
+                return None
+            job_id = row[0]
+
+            tasks = [Task(*task) for task in connection.execute(
+                f'SELECT position, statement, user_score FROM tasks t WHERE job_id = ? AND {available} '
+                f'ORDER BY position LIMIT ?', (job_id, now, limit))]
+            connection.executemany('UPDATE tasks SET status = ?, leased_until = ?, attempts = attempts + 1 '
+                                   'WHERE job_id = ? AND position = ?',
+                                   [(RUNNING, now + self.lease, job_id, task.position) for task in tasks])
+            connection.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?',
+                               (RUNNING, now, job_id, QUEUED))
+            user, settings = connection.execute('SELECT user, settings FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+        logging.info(f'{worker} claimed {len(tasks)} statements of job {job_id}.')
+        return Claim(job_id, user, json.loads(settings), tasks)
+
+    def complete(self, job_id, statement_tuples):
+        """
+        Stores the evaluations of claimed tasks, given as a dictionary position -> statement tuple.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany('UPDATE tasks SET status = ?, result = ?, leased_until = NULL '
+                                   'WHERE job_id = ? AND position = ? AND status = ?',
+                                   [(DONE, dumps(s), job_id, position, RUNNING)
+                                    for position, s in statement_tuples.items()])
+            self._update_job(connection, job_id, now)
+
+    def fail(self, job_id, positions, error):
+        """
+        Gives claimed tasks back to the queue after an error, or marks them failed once they have been attempted
+        max_attempts times.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany('UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                                   'error = ?, leased_until = NULL WHERE job_id = ? AND position = ? AND status = ?',
+                                   [(self.max_attempts, FAILED, QUEUED, error, job_id, position, RUNNING)
+                                    for position in positions])
+            self._update_job(connection, job_id, now)
+
+    def cancel(self, job_id):
+        """
+        Cancels the tasks of the job that have not started yet.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('UPDATE tasks SET status = ? WHERE job_id = ? AND status = ?',
+                               (CANCELLED, job_id, QUEUED))
+            connection.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status IN (?, ?)',
+                               (CANCELLED, now, job_id, QUEUED, RUNNING))
+
+    def _update_job(self, connection, job_id, now):
+        # A job is done once none of its tasks is queued or running anymore
+        n_left, = connection.execute('SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status IN (?, ?)',
+                                     (job_id, QUEUED, RUNNING)).fetchone()
+        connection.execute('UPDATE jobs SET status = CASE WHEN ? = 0 AND status = ? THEN ? ELSE status END, '
+                           'updated = ? WHERE id = ?', (n_left, RUNNING, DONE, now, job_id))
+
+    def take_uncommitted(self, limit=500):
+        """
+        Marks up to limit graded statements of the jobs to commit as being committed, and returns their keys
+        (job id, position), their statement tuples, and whether some of them were already being committed by a
+        commit that did not finish, so may be in the database already. Once they are in the database, mark them
+        with mark_committed; if committing them fails, give them back with release.
+        """
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT t.job_id, t.position, t.result, t.committed FROM tasks t '
+                                      'JOIN jobs j ON j.id = t.job_id '
+                                      'WHERE j.commit_results = 1 AND t.status = ? AND t.committed IN (0, ?) '
+                                      'ORDER BY t.job_id, t.position LIMIT ?', (DONE, COMMITTING, limit)).fetchall()
+            connection.executemany('UPDATE tasks SET committed = ? WHERE job_id = ? AND position = ?',
+                                   [(COMMITTING, job_id, position) for job_id, position, _, _ in rows])
+        return ([(job_id, position) for job_id, position, _, _ in rows],
+                [decode_statement_tuple(json.loads(result)) for _, _, result, _ in rows],
+                any(committed == COMMITTING for _, _, _, committed in rows))
+
+    def mark_committed(self, keys):
+        with self._transaction() as connection:
+            connection.executemany('UPDATE tasks SET committed = ? WHERE job_id = ? AND position = ?',
+                                   [(COMMITTED, *key) for key in keys])
+
+    def release(self, keys):
+        with self._transaction() as connection:
+            connection.executemany('UPDATE tasks SET committed = 0 WHERE job_id = ? AND position = ?', keys)
+
+    def status(self, job_id):
+        """
+        The job as a dictionary: id, user, status, created and updated times, and the number of tasks in total and
+        per status. None if there is no such job.
+        """
+        jobs = self._jobs('WHERE id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def jobs(self, user=None, limit=20):
+        """
+        The most recent jobs (of the user, if given), as dictionaries (see status).
+        """
+        if user is None:
+            return self._jobs('ORDER BY id DESC LIMIT ?', (limit,))
+        return self._jobs('WHERE user = ? ORDER BY id DESC LIMIT ?', (user, limit))
+
+    def _jobs(self, clause, parameters):
+        with self._lock:
+            jobs = self._connection.execute(f'SELECT id, user, status, n_tasks, commit_results, created, updated '
+                                            f'FROM jobs {clause}', parameters).fetchall()
+            jobs = [dict(zip(('id', 'user', 'status', 'n_tasks', 'commit', 'created', 'updated'), job))
+                    for job in jobs]
+            for job in jobs:
+                counts = dict(self._connection.execute('SELECT status, COUNT(*) FROM tasks WHERE job_id = ? '
+                                                       'GROUP BY status', (job['id'],)).fetchall())
+                job['commit'] = bool(job['commit'])
+                for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED):
+                    job[f'n_{status}'] = counts.get(status, 0)
+        return jobs
+
+    def results(self, job_id):
+        """
+        The statement tuples of the job's tasks, in order, None for the ones not graded (yet).
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT result FROM tasks WHERE job_id = ? ORDER BY position',
+                                            (job_id,)).fetchall()
+        return [decode_statement_tuple(json.loads(result)) if result is not None else None for result, in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def commit_finished(engine, job_queue, limit=500):
+    """
+    Commits the graded statements of the jobs to commit to the engine's database, except the ones that could not
+    be evaluated. Returns the number of statements taken from the queue.
+
+    The statements are only marked committed in the queue once they are in the database (its write-ahead log), so
+    a crash in between loses nothing. The statements of a commit interrupted that way are committed again, except
+    the ones the database already has (same statement and time).
+    """
+    # A single commit at a time in this process, so that a commit in progress is never taken for an interrupted one
+    with job_queue._commit_lock:
+        keys, statement_tuples, interrupted = job_queue.take_uncommitted(limit)
+        valid = [s for s in statement_tuples if s[3] is not None]
+        try:
+            if valid and interrupted:
+                valid = engine.missing_evaluations(valid)
+            if valid:
+                engine.insert_evaluations(valid)
+        except BaseException:
+            job_queue.release(keys)
+            raise
+        job_queue.mark_committed(keys)
+    return len(keys)
+
+
+class JobWorker:
+    """
+    Grades the statements of the queued jobs with an engine, batch_size statements at a time (by default, as many
+    as the engine sends requests concurrently). If commit is True, the evaluations are committed to the engine's
+    database as they are graded; otherwise another process has to commit them (see commit_finished).
+    """
+
+    def __init__(self, engine, job_queue, name=None, batch_size=None, commit=True, poll_interval=1.0):
+        self.engine = engine
+        self.job_queue = job_queue
+        self.name = name or f'worker-{os.getpid()}-{threading.get_ident()}'
+        self.batch_size = batch_size or engine.max_concurrent_requests
+        self.commit = commit
+        self.poll_interval = poll_interval
+
+    def run_once(self):
+        """
+        Grades one batch of statements, and returns their number (0 if there was nothing to do).
+        """
+        claim = self.job_queue.claim(self.name, self.batch_size)
+        if claim is None:
+            return 0
+
+        positions = [task.position for task in claim.tasks]
+        session = self.engine.new_session()
+        session.apply_settings(claim.settings)
+        try:
+            statement_tuples = session.extract_evaluations([task.statement for task in claim.tasks], claim.user,
+                                                           user_scores=[task.user_score for task in claim.tasks],
+                                                           resample=claim.settings.get('resample', False))
+        except Exception as e:
+            logging.exception(f'{self.name} could not grade statements of job {claim.job_id}.')
+            self.job_queue.fail(claim.job_id, positions, f'{e.__class__.__name__}: {e}')
+            return len(positions)
+
+        self.job_queue.complete(claim.job_id, dict(zip(positions, statement_tuples)))
+        if self.commit:
+            commit_finished(self.engine, self.job_queue)
+        return len(positions)
+
+    def run(self, stop_event):
+        """
+        Grades statements until stop_event is set, waiting poll_interval seconds whenever the queue is empty.
+        """
+        logging.info(f'{self.name} started.')
+        while not stop_event.is_set():
+            try:
+                n_graded = self.run_once()
+            except Exception:
+                logging.exception(f'{self.name} failed.')
+                n_graded = 0
+            if n_graded == 0:
+                stop_event.wait(self.poll_interval)
+        logging.info(f'{self.name} stopped.')
+
+
+class WorkerPool:
+    """
+    Worker threads of this process, e.g., of the app: they keep grading jobs whatever the sessions that submitted
+    them do.
+    """
+
+    def __init__(self, engine, job_queue, n_workers=2, **worker_arguments):
+        self._workers = [JobWorker(engine, job_queue, name=f'worker-{i}', **worker_arguments)
+                         for i in range(n_workers)]
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target=worker.run, args=(self._stop_event,), daemon=True,
+                                          name=worker.name) for worker in self._workers]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class JobCommitter:
+    """
+    Thread committing the evaluations graded by the workers, of this process or of worker processes (see
+    run_worker_processes), to the engine's database. It runs in the process that owns the database, e.g., the app
+    or the engine service, so that the database has a single writer.
+    """
+
+    def __init__(self, engine, job_queue, poll_interval=1.0):
+        self.engine = engine
+        self.job_queue = job_queue
+        self.poll_interval = poll_interval
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='job-committer')
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread, after committing the evaluations graded so far.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                n_committed = commit_finished(self.engine, self.job_queue)
+            except Exception:
+                logging.exception('Could not commit the graded statements, they stay in the queue.')
+                n_committed = 0
+            if n_committed == 0:
+                if self._stop_event.is_set():
+                    return
+                self._stop_event.wait(self.poll_interval)
+
+
+def _worker_process(job_queue_file_path, engine_arguments, stop_event, batch_size):
+    from engine import EvaluatorEngine
+
+    # Workers never write the database, the process owning it commits their evaluations
+    engine = EvaluatorEngine(**dict(engine_arguments, read_only=True))
+    job_queue = JobQueue(job_queue_file_path)
+    JobWorker(engine, job_queue, name=f'worker-{os.getpid()}', batch_size=batch_size, commit=False).run(stop_event)
+
+
+def run_worker_processes(job_queue_file_path, engine_arguments, n_processes=2, batch_size=None, poll_interval=1.0,
+                         stop_event=None, commit=False):
+    """
+    Grades the queued jobs in n_processes worker processes, each with its own engine (built from
+    engine_arguments, see EvaluatorEngine), until stop_event is set or the process is interrupted. The workers only
+    grade: their evaluations stay in the queue until the process owning the database (the app or the engine
+    service, see JobCommitter) commits them. If commit is True, this process commits them instead, when nothing
+    else writes the database.
+    """
+    committer = None
+    if commit:
+        from engine import EvaluatorEngine
+
+        committer = JobCommitter(EvaluatorEngine(**engine_arguments), JobQueue(job_queue_file_path),
+                                 poll_interval=poll_interval).start()
+
+    context = multiprocessing.get_context('spawn')
+    stop_event = stop_event or context.Event()
+    processes = [context.Process(target=_worker_process, name=f'worker-{i}',
+                                 args=(job_queue_file_path, engine_arguments, stop_event, batch_size))
+                 for i in range(n_processes)]
+    for process in processes:
+        process.start()
+    logging.info(f'Started {n_processes} worker processes.')
+
+    try:
+        while not stop_event.wait(poll_interval):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        for process in processes:
+            process.join()
+        if committer is not None:
+            # Including the evaluations of the last batches
+            committer.stop()
+            committer.engine.close()
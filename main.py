@@ -1,11 +1,16 @@
 import streamlit as st
 import openai
+from datetime import timedelta
 from prompts import award_dict, tier_dict, sq_pri_dict, wg_pri_dict
 from streamlit.components.v1 import html
 
 import sys
 sys.path.append('.')
+from backends import BackendError, OpenAIBackend, OpenAICompatibleBackend, GRADE, PRESCREEN
 from engine import EvaluatorEngine
+from exports import EXPORT_FORMATS
+from jobs import JobCommitter, JobQueue, WorkerPool
+from service import RemoteEngine
 
 def app():
 
@@ -45,12 +50,41 @@ def app():
         unsafe_allow_html=True,
     )
 
-    # Set up the engine
+    # Set up the engine. With several processes of the app, they share the engine of an engine service
+    # (python -m evaluator serve) instead, the only writer of the database.
     @st.cache_resource
     def create_engine():
-        return EvaluatorEngine()
+        if 'ENGINE_SERVICE_URL' in st.secrets:
+            return RemoteEngine(st.secrets['ENGINE_SERVICE_URL'])
+        # Statements can be prescreened by an OpenAI-compatible server, e.g. a local model, before the final grade
+        if 'PRESCREEN_API_BASE' not in st.secrets:
+            return EvaluatorEngine(api_key=st.secrets["OPENAI_API_KEY"])
+        backends = {'openai': OpenAIBackend(api_key=st.secrets["OPENAI_API_KEY"]),
+                    'prescreen': OpenAICompatibleBackend(st.secrets['PRESCREEN_API_BASE'],
+                                                         model=st.secrets.get('PRESCREEN_MODEL'))}
+        return EvaluatorEngine(backends=backends, routes={GRADE: 'openai', PRESCREEN: 'prescreen'})
     engine = create_engine()
 
+    # Packages of statements can be graded in the background, by workers that outlive the sessions (and, with
+    # JOB_WORKERS = 0, by separate worker processes: python -m evaluator worker). The app commits their
+    # evaluations, being the only writer of the database. The engine service grades and commits them itself.
+    @st.cache_resource
+    def create_job_queue(_engine):
+        job_queue = JobQueue(st.secrets.get('JOB_QUEUE_PATH', './data/jobs.sqlite'))
+        if isinstance(_engine, RemoteEngine):
+            return job_queue
+        JobCommitter(_engine, job_queue).start()
+        n_workers = int(st.secrets.get('JOB_WORKERS', 2))
+        if n_workers > 0:
+            WorkerPool(_engine, job_queue, n_workers=n_workers, commit=False).start()
+        return job_queue
+    job_queue = create_job_queue(engine)
+
+    # The engine is shared by everybody, the evaluations in progress and the parameters belong to this session
+    if 'evaluation_session' not in st.session_state:
+        st.session_state['evaluation_session'] = engine.new_session()
+    session = st.session_state['evaluation_session']
+
 
     st.title('The Fisch Rank')
     st.write('A simple app to evaluate a performance statement and then dump it into a database to query it later.')
@@ -66,31 +100,64 @@ def app():
                                  value= 'Levon')
 
     token = st.sidebar.text_input(label= 'OpenAI API access token',
-                                  value= openai.api_key if openai.api_key is not None else '',
+                                  value= engine.api_key if engine.api_key is not None else '',
                                   type = 'password',
                                   help = 'Get it on https://beta.openai.com/')
 
-    engine.gpt_parameters['engine'] = st.sidebar.text_input('GPT Engine', 'gpt-3.5-turbo')
-    engine.gpt_parameters['temperature'] = st.sidebar.slider('GPT Temperature',
-                                                             value = 0.7,
-                                                             min_value = 0.0,
-                                                             max_value= 1.0,
-                                                             step = 0.1)
-    engine.gpt_parameters['frequency_penalty'] = st.sidebar.slider('GPT Frequency Penalty',
+    session.gpt_parameters['engine'] = st.sidebar.text_input('GPT Engine', 'gpt-3.5-turbo')
+    session.gpt_parameters['temperature'] = st.sidebar.slider('GPT Temperature',
+                                                              value = 0.7,
+                                                              min_value = 0.0,
+                                                              max_value= 1.0,
+                                                              step = 0.1)
+    session.gpt_parameters['frequency_penalty'] = st.sidebar.slider('GPT Frequency Penalty',
+                                                                    value=0.0,
+                                                                    min_value=0.0,
+                                                                    max_value=1.0,
+                                                                    step=0.1)
+    session.gpt_parameters['presence_penalty'] = st.sidebar.slider('GPT Presence Penalty',
                                                                    value=0.0,
                                                                    min_value=0.0,
                                                                    max_value=1.0,
                                                                    step=0.1)
-    engine.gpt_parameters['presence_penalty'] = st.sidebar.slider('GPT Presence Penalty',
-                                                                  value=0.0,
-                                                                  min_value=0.0,
-                                                                  max_value=1.0,
-                                                                  step=0.1)
-
-    engine.set_openai_api_key(token)
+    session.gpt_parameters['max_tokens'] = st.sidebar.number_input('GPT Max Tokens',
+                                                                   value=1000,
+                                                                   min_value=100,
+                                                                   max_value=4000,
+                                                                   step=100)
+
+    session.api_key = token
+
+    session.use_cache = st.sidebar.checkbox('Reuse cached evaluations', value=True,
+                                            help='Statements already graded with the same parameters are not sent to GPT again.')
+    session.n_samples = st.sidebar.number_input('Samples per evaluation', value=1, min_value=1, max_value=10, step=1,
+                                                help='Grade several samples at once and keep their median score. '
+                                                     'Evaluations with several samples are not streamed.')
+    if session.n_samples > 1:
+        session.score_tolerance = st.sidebar.slider('Stop early within', value=1.0, min_value=0.0, max_value=5.0,
+                                                    step=0.5, help='Stop after 3 samples if their scores are '
+                                                                   'within this many points of each other.')
+        session.sampling_strategy = 'n' if st.sidebar.checkbox('Sample in a single request', value=False,
+                                                               help="Use the API's n parameter, the prompt is "
+                                                                    "only paid once.") else 'parallel'
+    if engine.routes[PRESCREEN] != engine.routes[GRADE]:
+        session.prescreen = st.sidebar.checkbox('Prescreen statements', value=False,
+                                                help='Grade statements with the prescreen model first, and only send '
+                                                     'the ones it could score to GPT. Prescreened evaluations are '
+                                                     'not streamed.')
+    session.output_format = 'json' if st.sidebar.checkbox('Structured answers', value=False,
+                                                          help='Ask GPT for a JSON object with the score of every '
+                                                               'criterion. Structured evaluations are not '
+                                                               'streamed.') else 'text'
+    resample = st.sidebar.checkbox('Resample', value=False,
+                                   help='Ask GPT again even if the statement was already graded, and cache the new answer.')
+    cache_stats = engine.cache_stats()
+    if cache_stats is not None:
+        st.sidebar.caption(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                           f"{cache_stats['entries']} entries")
 
     # We have different tabs for searching and for statement evaluation
-    tab1, tab2 = st.tabs(['Evaluate Statement', 'Search Statements'])
+    tab1, tab2, tab3, tab4 = st.tabs(['Evaluate Statement', 'Search Statements', 'Analytics', 'Ops'])
 
     ################
     # Evaluate tab #
@@ -99,18 +166,18 @@ def app():
     with tab1:
         #Make buttons to select Tier, Award, and category
         col1, col2, col3, col4 = st.columns(4)
-        engine.statement_parameters['tier'] = col1.selectbox(label='Tier',
-                                                             options=tier_dict,
-                                                             index=0)
-        engine.statement_parameters['award'] = col2.selectbox(label='Award',
-                                               options=award_dict,
-                                               index=0)
-        engine.statement_parameters['sq'] = col3.selectbox(label='Squadron',
-                                            options=sq_pri_dict,
-                                            index=0)
-        engine.statement_parameters['wg'] = col4.selectbox(label='Wing',
-                                            options=wg_pri_dict,
-                                            index=0)
+        session.statement_parameters['tier'] = col1.selectbox(label='Tier',
+                                                              options=tier_dict,
+                                                              index=0)
+        session.statement_parameters['award'] = col2.selectbox(label='Award',
+                                                options=award_dict,
+                                                index=0)
+        session.statement_parameters['sq'] = col3.selectbox(label='Squadron',
+                                             options=sq_pri_dict,
+                                             index=0)
+        session.statement_parameters['wg'] = col4.selectbox(label='Wing',
+                                             options=wg_pri_dict,
+                                             index=0)
 
         with st.form('new_statement_form', clear_on_submit=True):
             col1, col2 = st.columns((4, 1))
@@ -119,34 +186,93 @@ def app():
             add_statement = st.form_submit_button('Evaluate')
 
         manual_check = st.checkbox('Check before adding', value = True)
+        stream = st.checkbox('Stream the justification', value = True)
+        check_duplicates = st.checkbox('Look for near-duplicates first', value = True,
+                                       help='Offer the evaluation of a very similar statement, instead of asking GPT again.')
 
         # placeholder for where the manual check pane will be
         manual_check_pane = st.empty()
 
         # auxiliary function to commit extraction, will be used more than once below
         def aux_commit_extraction():
-            st.session_state['latest_insertions'] = engine.extracted_evaluation()
-            engine.commit()
+            st.session_state['latest_insertions'] = session.extracted_evaluation()
+            session.commit()
 
         def aux_cancel_extraction():
-            engine.cancel()
+            session.cancel()
             st.session_state['insertion_cancelled'] = True
 
+        #
+        # VALIDATION: Statements that break the rules of a performance statement are caught before asking GPT.
+        #
+        if add_statement and not session.has_extracted_statement():
+            validation = engine.validate_statement(new_statement_utterance)
+            for warning in validation.warnings:
+                st.warning(warning)
+            if not validation.valid:
+                with manual_check_pane.container():
+                    st.error('Not a performance statement, fix it before we reel in an evaluation!')
+                    for error in validation.errors:
+                        st.write(f'- {error}')
+                add_statement = False
+
+        #
+        # DUPLICATES: If a very similar statement was already graded, offer its evaluation instead.
+        #
+        if 'near_duplicate' not in st.session_state:
+            st.session_state['near_duplicate'] = None
+
+        if add_statement and check_duplicates and not session.has_extracted_statement():
+            near_duplicate = session.find_near_duplicate(new_statement_utterance)
+            if near_duplicate is not None:
+                st.session_state['near_duplicate'] = (new_statement_utterance, user_score, near_duplicate)
+                add_statement = False
+
+        if st.session_state['near_duplicate'] is not None:
+            statement_utterance, duplicate_user_score, near_duplicate = st.session_state['near_duplicate']
+            with manual_check_pane.container():
+                st.info(f"A very similar statement ({near_duplicate['similarity']:.0%} similar) was already "
+                        f"graded {near_duplicate['score']}:")
+                st.write(near_duplicate['statement'])
+                st.write(near_duplicate['explanation'])
+                reuse = st.button('Use this evaluation')
+                evaluate_anyway = st.button('Evaluate anyway')
+
+            if reuse:
+                session.reuse_evaluation(near_duplicate, statement_utterance, user, duplicate_user_score)
+                st.session_state['near_duplicate'] = None
+            elif evaluate_anyway:
+                new_statement_utterance, user_score, add_statement = statement_utterance, duplicate_user_score, True
+                st.session_state['near_duplicate'] = None
+
         #
         # EXTRACT: If we don't have an extracted statement yet, let's try to do that.
         #
-        if not engine.has_extracted_statement():
-            if add_statement:
-                with st.spinner('Evaluating....'):
-                    engine.extract_evaluation(new_statement_utterance, user, user_score)
+        if not session.has_extracted_statement():
+            try:
+                if add_statement and stream and session.n_samples == 1 and not session.prescreen \
+                        and session.output_format == 'text':
+                    with manual_check_pane.container():
+                        score_slot = st.empty()
+                        justification_slot = st.empty()
+                        for justification, score in session.stream_evaluation(new_statement_utterance, user,
+                                                                              user_score, resample=resample):
+                            if score is not None:
+                                score_slot.subheader(f"Fisch's Score: {score}")
+                            justification_slot.write(justification)
+                elif add_statement:
+                    with st.spinner('Evaluating....'):
+                        session.extract_evaluation(new_statement_utterance, user, user_score, resample=resample)
+            except (TimeoutError, BackendError, openai.error.OpenAIError) as e:
+                manual_check_pane.error(f'Could not reach GPT, try again in a moment! ({e})')
 
         #
         # COMMIT: If now we have the extracted statement, prepare to commit or commit them directly.
         #
-        if engine.has_extracted_statement():
+        if session.has_extracted_statement():
 
             # Check if it was a valid performance statement
-            if not engine.has_valid_statement():
+            if not session.has_valid_statement():
                 with manual_check_pane.container():
                     st.error('Could not reel in an evaluation! Check for performance statement structure.')
                     aux_cancel_extraction()
@@ -156,7 +282,7 @@ def app():
 
                 with manual_check_pane.container():
 
-                    e = engine.extracted_evaluation()
+                    e = session.extracted_evaluation()
 
                     st.header('Performance Statement:')
                     st.write(e['Statement'])
@@ -166,6 +292,15 @@ def app():
                     with col1:
                         st.header("Fisch's Score")
                         st.subheader(e['Score'])
+                        if e['Sample Scores'] is not None and ';' in e['Sample Scores']:
+                            st.caption(f"Median of {e['Sample Scores'].replace(';', ', ')} "
+                                       f"(mean {e['Mean Score']:.1f}, spread {e['Score Spread']:g})")
+                    with col2:
+                        sub_scores = {c: e[f'{c} Score'] for c in ('Action', 'Result', 'Impact', 'Scope')
+                                      if e[f'{c} Score'] is not None}
+                        if sub_scores:
+                            st.header('Criteria')
+                            st.write(', '.join(f'{c} {s:g}/5' for c, s in sub_scores.items()))
                     with col3:
                         st.header(f"{e['User']}'s Score")
                         st.subheader(e['User Score'])
@@ -187,8 +322,198 @@ def app():
             else: # no manual check needed, lets just commit
                 aux_commit_extraction()
 
+        #
+        # BATCH: Evaluate a whole package of statements at once, one statement per line.
+        #
+        st.write('---')
+        with st.expander('Evaluate many statements'):
+            with st.form('new_statements_form', clear_on_submit=True):
+                new_statement_utterances = st.text_area('New Performance Statements', value='', height=300,
+                                                        help='Paste your statements here, one per line.')
+                background = st.checkbox('Grade in the background', value=False,
+                                         help='The statements are graded and added to the database even if you '
+                                              'leave the page. Follow them under Background jobs.')
+                add_statements = st.form_submit_button('Evaluate All')
+
+            if add_statements:
+                utterances = [u.strip() for u in new_statement_utterances.splitlines() if u.strip()]
+                if utterances and background:
+                    job_id = session.submit_evaluations(job_queue, utterances, user, resample=resample)
+                    st.success(f'Queued job {job_id} ({len(utterances)} statements).')
+                elif utterances:
+                    with st.spinner(f'Evaluating {len(utterances)} statements....'):
+                        try:
+                            session.extract_evaluations(utterances, user, resample=resample)
+                        except (TimeoutError, BackendError, openai.error.OpenAIError) as e:
+                            st.error(f'Could not reach GPT, try again in a moment! ({e})')
+
+            if session.has_extracted_statements():
+                evaluations = session.extracted_evaluations()
+                st.dataframe([{k: e[k] for k in ('Statement', 'Score', 'Justification')} for e in evaluations])
+
+                n_invalid = sum(e['Justification'] is None for e in evaluations)
+                if n_invalid > 0:
+                    st.warning(f'Could not reel in an evaluation for {n_invalid} statements! '
+                               f'They will not be added to the database.')
+                    for e in evaluations:
+                        errors = engine.validate_statement(e['Statement']).errors if e['Justification'] is None else []
+                        if errors:
+                            st.write(f"- {e['Statement']}: {' '.join(errors)}")
+
+                accept_all = st.button('Accept Scores')
+                cancel_all = st.button('Cancel Scores')
+
+                if accept_all:
+                    st.session_state['latest_insertions'] = evaluations
+                    session.commit_batch()
+                elif cancel_all:
+                    session.cancel_batch()
+                    st.session_state['insertion_cancelled'] = True
+
+        #
+        # JOBS: Progress and results of the packages graded in the background.
+        #
+        jobs = job_queue.jobs(user=user, limit=10)
+        if jobs:
+            with st.expander('Background jobs'):
+                st.button('Refresh')
+                for job in jobs:
+                    n_finished = job['n_done'] + job['n_failed'] + job['n_cancelled']
+                    st.progress(n_finished / job['n_tasks'] if job['n_tasks'] else 1.0,
+                                text=f"Job {job['id']}: {job['status']}, {job['n_done']}/{job['n_tasks']} graded"
+                                     + (f", {job['n_failed']} failed" if job['n_failed'] else ''))
+                    if job['status'] in ('queued', 'running'):
+                        if st.button('Cancel', key=f"cancel_job_{job['id']}"):
+                            job_queue.cancel(job['id'])
+                    if job['n_done'] > 0 and st.checkbox('Show the evaluations', key=f"show_job_{job['id']}"):
+                        st.dataframe([{k: e[k] for k in ('Statement', 'Score', 'Justification')}
+                                      for e in session.job_evaluations(job_queue, job['id'])])
+
     with tab2:
-        st.text('Database and Search coming soon.')
+        query = st.text_input('Search', value='', help='Words that must appear in the statement or its justification.')
+
+        # 'Any' means no filter
+        col1, col2, col3, col4, col5 = st.columns(5)
+        search_tier = col1.selectbox('Tier', options=['Any'] + list(tier_dict), index=0, key='search_tier')
+        search_award = col2.selectbox('Award', options=['Any'] + list(award_dict), index=0, key='search_award')
+        search_sq = col3.selectbox('Squadron', options=['Any'] + list(sq_pri_dict), index=0, key='search_sq')
+        search_wg = col4.selectbox('Wing', options=['Any'] + list(wg_pri_dict), index=0, key='search_wg')
+        search_user = col5.text_input('User', value='', key='search_user')
+
+        col1, col2 = st.columns(2)
+        min_score, max_score = col1.slider('Score', min_value=0.0, max_value=20.0, value=(0.0, 20.0), step=0.5)
+        dates = col2.date_input('Dates', value=[])
+
+        search_filters = dict(tier=None if search_tier == 'Any' else search_tier,
+                              award=None if search_award == 'Any' else search_award,
+                              sq=None if search_sq == 'Any' else search_sq,
+                              wg=None if search_wg == 'Any' else search_wg,
+                              user=search_user or None,
+                              # Unscored evaluations only show up when the score range is left untouched
+                              min_score=None if min_score == 0.0 else min_score,
+                              max_score=None if max_score == 20.0 else max_score,
+                              start=dates[0] if len(dates) > 0 else None,
+                              end=dates[1] + timedelta(days=1) if len(dates) > 1 else None)
+
+        # Every tab runs on every rerun, so the search (which loads the database and builds the index the first
+        # time) only runs once asked for: when a query or a filter is set, or on the button. The results are kept
+        # until the criteria change or the button is pressed again.
+        criteria = (query, tuple(search_filters.items()))
+        has_criteria = bool(query) or any(value is not None for value in search_filters.values())
+        searched = st.session_state.get('search_results')
+        if st.button('Search', help='Runs the search again, e.g., to see the latest evaluations.') \
+                or (has_criteria and (searched is None or searched[0] != criteria)):
+            searched = (criteria, engine.search(query, **search_filters))
+            st.session_state['search_results'] = searched
+
+        if searched is None or searched[0] != criteria:
+            st.caption('Type a query or pick a filter, or press Search to list every statement.')
+        else:
+            results = searched[1]
+            st.caption(f'{len(results)} statements found.')
+            st.dataframe(results)
+
+            # Export all the matches, not only the ones shown. The file is only built on request.
+            col1, col2 = st.columns([1, 3])
+            export_type = col1.selectbox('Export format', options=list(EXPORT_FORMATS), index=0)
+            if col2.button('Export the matching statements'):
+                try:
+                    export_file = engine.export(export_type, query, **search_filters)
+                except ImportError as e:
+                    st.error(str(e))
+                else:
+                    # download_button only takes bytes, strings and in-memory files, and keeps the data in memory
+                    # anyway
+                    with export_file:
+                        data = export_file.read()
+                    extension, mime = EXPORT_FORMATS[export_type]
+                    col2.download_button('Download', data=data, file_name=f'evaluations.{extension}', mime=mime)
+
+        like_statement = st.text_input('More like this', value='', help='Paste a statement to find the most similar ones.')
+        if like_statement:
+            st.dataframe(engine.find_similar(like_statement, k=10))
+
+    #################
+    # Analytics tab #
+    #################
+
+    with tab3:
+        # Every tab runs on every rerun, so the analytics (built from the whole database the first time) are only
+        # queried once asked for. The results are kept until refreshed.
+        analytics_results = st.session_state.get('analytics_results')
+        if st.button('Refresh' if analytics_results is not None else 'Show the analytics', key='show_analytics'):
+            analytics_results = st.session_state['analytics_results'] = {}
+
+        if analytics_results is None:
+            st.caption('Score distributions, calibration and trends of all the stored evaluations.')
+        else:
+            def query_analytics(method, *arguments):
+                if (method, *arguments) not in analytics_results:
+                    analytics_results[(method, *arguments)] = getattr(engine.analytics(), method)(*arguments)
+                return analytics_results[(method, *arguments)]
+
+            group_names = {'Everything': None, 'Award': 'award', 'Tier': 'tier', 'Wing': 'wg', 'Squadron': 'sq',
+                           'User': 'user'}
+            col1, col2 = st.columns(2)
+            group = group_names[col1.selectbox('Group by', options=list(group_names), index=0)]
+            summary = query_analytics('summary', group)
+            st.caption('Scores of GPT, and their error against the scores given by the users (GPT minus user).')
+            st.dataframe(summary)
+
+            # Histogram and trend of one group
+            value = None
+            if group is not None and len(summary) > 0:
+                value = col2.selectbox('Show', options=list(summary.index), index=0)
+            st.bar_chart(query_analytics('histogram', group, value))
+
+            frequency = st.radio('Trend', options=['day', 'week', 'month'], index=1, horizontal=True)
+            trend = query_analytics('trend', group, value, frequency)
+            if len(trend) > 0:
+                st.line_chart(trend[['mean_score', 'mean_absolute_error']])
+
+    ###########
+    # Ops tab #
+    ###########
+
+    with tab4:
+        st.write('Where the time goes, per stage of the evaluation pipeline, since the app started.')
+        stages = engine.metrics.summary()
+        if stages:
+            # Durations in milliseconds, easier to read
+            st.dataframe([{k: round(v * 1000, 1) if k not in ('stage', 'count') else v for k, v in row.items()}
+                          for row in stages])
+        else:
+            st.info('Nothing measured yet, evaluate a statement first.')
+
+        counters = engine.metrics.counters()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric('Evaluations', counters.get('evaluations', 0))
+        col2.metric('Cache hits', counters.get('cache_hits', 0))
+        col3.metric('Prompt tokens', counters.get('prompt_tokens', 0))
+        col4.metric('Completion tokens', counters.get('completion_tokens', 0))
+
+        with st.expander('Prometheus metrics'):
+            st.code(engine.metrics.to_prometheus(), language='text')
 
     ###################
     # Status messages #
@@ -0,0 +1,117 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Metrics:
+    """
+    Timing spans and counters of the evaluation pipeline. Every stage (prompt build, GPT call, parsing, insertion,
+    save, ...) records its durations, and the latest max_samples of them per stage give its percentiles. Spans can
+    carry attributes, e.g., token counts or whether the completion came from the cache; if a file path is given,
+    every span is also appended to it as a JSON line, for offline analysis. The counters and percentiles can be
+    exported in the Prometheus text format.
+    """
+
+    def __init__(self, file_path=None, max_samples=10000):
+        self.file_path = file_path
+        self.max_samples = max_samples
+
+        self._durations = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._counts = Counter()
+        self._sums = Counter()
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """
+        Times the code of the with block as the given stage. The block gets the attributes dictionary of the span,
+        and can add to it. A span that raises is still recorded, with an error attribute.
+        """
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = e.__class__.__name__
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, **attributes)
+
+    def record(self, stage, duration, **attributes):
+        """
+        Records a span of the stage that took duration seconds.
+        """
+        with self._lock:
+            self._durations[stage].append(duration)
+            self._counts[stage] += 1
+            self._sums[stage] += duration
+
+            if self.file_path is not None:
+                try:
+                    with open(self.file_path, 'a') as f:
+                        f.write(json.dumps({'time': time.time(), 'stage': stage, 'duration': duration,
+                                            **attributes}, default=str) + '\n')
+                except OSError as e:
+                    logging.warning(f'Could not write metrics to {self.file_path}: {e}')
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def percentiles(self, stage, quantiles=QUANTILES):
+        """
+        Percentiles of the recent durations of the stage, in seconds, as a dictionary quantile -> duration.
+        """
+        with self._lock:
+            durations = sorted(self._durations.get(stage, ()))
+        if not durations:
+            return {q: None for q in quantiles}
+        return {q: durations[min(len(durations) - 1, int(q * len(durations)))] for q in quantiles}
+
+    def summary(self):
+        """
+        One dictionary per stage: number of spans, total, mean, p50, p95, p99 and max duration (in seconds).
+        """
+        with self._lock:
+            stages = sorted(self._counts)
+        rows = []
+        for stage in stages:
+            with self._lock:
+                count, total, maximum = self._counts[stage], self._sums[stage], max(self._durations[stage])
+            p50, p95, p99 = (self.percentiles(stage)[q] for q in QUANTILES)
+            rows.append({'stage': stage, 'count': count, 'total': total, 'mean': total / count,
+                         'p50': p50, 'p95': p95, 'p99': p99, 'max': maximum})
+        return rows
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def to_prometheus(self, prefix='evaluator'):
+        """
+        The metrics in the Prometheus text exposition format: a summary of the stage durations (quantiles over the
+        recent spans, count and sum over all of them) and one counter per counter.
+        """
+        lines = [f'# HELP {prefix}_stage_seconds Duration of the stages of the evaluation pipeline.',
+                 f'# TYPE {prefix}_stage_seconds summary']
+        for row in self.summary():
+            for q, value in self.percentiles(row['stage']).items():
+                lines.append(f'{prefix}_stage_seconds{{stage="{row["stage"]}",quantile="{q}"}} {value}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{row["stage"]}"}} {row["total"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{row["stage"]}"}} {row["count"]}')
+        for counter, value in sorted(self.counters().items()):
+            lines.append(f'# TYPE {prefix}_{counter}_total counter')
+            lines.append(f'{prefix}_{counter}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._counts.clear()
+            self._sums.clear()
+            self._counters.clear()
@@ -24,6 +24,33 @@ identified on the approved Air Force Acronym and Abbreviation List, unless noted
 approved category.
 """
 
+# Acronyms and abbreviations a statement can use without defining them, from the Air Force Acronym and
+# Abbreviation List (the common ones) and the approved categories: ranks, units and intelligence disciplines
+APPROVED_ACRONYMS = frozenset("""
+    A1C SrA SSgt TSgt MSgt SMSgt CMSgt NCO SNCO NCOIC OIC CC CCC CV DO DOD DoD USAF USSF AF AFB AFSC AFPC
+    ACC AMC AETC AFMC AFGSC AFRC AFSOC ANG PACAF USAFE MAJCOM NAF CCMD COCOM CENTCOM EUCOM INDOPACOM PACOM AFRICOM
+    SOUTHCOM NORTHCOM SPACECOM STRATCOM SOCOM CYBERCOM TRANSCOM NATO US USA UK HQ WG SQ GP FLT DET
+    ISR ISRW ISRG IS ISS IC NSA NGA DIA CIA NRO FBI SIGINT ELINT COMINT GEOINT IMINT MASINT HUMINT OSINT FMV DCGS DGS
+    AOC AOR CAOC JTF JADC2 TTP SOP IAW POC PME ALS NCOA SNCOA CCAF CLEP CDC OJT TDY PCS EPR OPR EPB OPB LOA LOE DV
+    IT KM GPA AFI DAFI MOU MOA TO CONUS OCONUS STEM ROTC JROTC NJROTC AFJROTC PT CPR AED EOD SAR CSAR QA UMD UTC AEF
+    IG UCI MICT ORI CFC AFAF CFL POL RPA UAS FY FYDP Q1 Q2 Q3 Q4
+""".split())
+
+# Output format of the evaluations in the structured (JSON) mode, instead of the text of the examples
+JSON_OUTPUT = \
+"""
+Answer with a single JSON object and nothing else, following this schema (scores are numbers, halves allowed):
+{
+    "action": {"justification": "<how well the statement describes the action>", "score": <0 to 5>},
+    "result": {"justification": "<how well it shows the result of the action>", "score": <0 to 5>},
+    "impact": {"justification": "<how well it shows the impact on the mission>", "score": <0 to 5>},
+    "scope": {"justification": "<how broad and challenging the scope is>", "score": <0 to 5>},
+    "total": <sum of the four scores, 0 to 20>,
+    "justification": "<one or two sentences on how to improve the statement>"
+}
+Grade on the same criteria as the examples, which show the text format instead.
+"""
+
 PERFORMANCE_LEVELS = \
 """
 Membership
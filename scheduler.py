@@ -0,0 +1,214 @@
+import functools
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+# Priorities of the requests, lower goes first
+INTERACTIVE = 0
+BATCH = 10
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors():
+    """
+    Errors worth retrying: rate limits, server errors and network hiccups. openai is only imported on the first
+    request, it is slow to import.
+    """
+    import openai
+    from backends import RetryableBackendError
+    return (RetryableBackendError,
+            openai.error.RateLimitError,
+            openai.error.APIError,
+            openai.error.ServiceUnavailableError,
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            openai.error.TryAgain)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a constant rate per minute, holding at most one minute worth of tokens.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+
+        self._tokens = float(rate_per_minute)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes amount tokens from the bucket, possibly going into debt, and returns how many seconds the caller
+        has to wait before the tokens are actually available.
+        """
+        # A single request larger than the bucket would wait forever
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def wait_time(self, amount):
+        """
+        How many seconds until amount tokens are in the bucket, without taking them.
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            return max(0.0, (amount - self._tokens) / self.rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class _Request:
+    """
+    A submitted request, with the state of its retries.
+    """
+
+    def __init__(self, request, tokens, priority, deadline, future):
+        self.request = request
+        self.tokens = tokens
+        self.priority = priority
+        self.deadline = deadline
+        self.future = future
+        self.attempt = 0
+
+
+class RequestScheduler:
+    """
+    Scheduler of the requests to OpenAI. Requests wait in a priority queue (interactive evaluations go before
+    batch jobs) and are run by a fixed pool of workers, within the requests per minute and tokens per minute limits
+    of the account (token buckets, None for no limit). Rate limits, server errors and timeouts are retried with exponential backoff
+    and jitter, until the request succeeds, runs out of retries, or passes its deadline.
+
+    Workers never wait: a request is only handed to a worker once the rate limits allow it, and a request to retry
+    goes back to the queue, not before the end of its backoff. The workers are thus free for the other requests in
+    the meantime, and an interactive request never waits behind batch requests that are backing off.
+    """
+
+    def __init__(self, requests_per_minute=3500, tokens_per_minute=90000, max_workers=8,
+                 max_retries=5, base_delay=1.0, max_delay=60.0, request_timeout=60):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_timeout = request_timeout
+
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+        # Requests ready to run, by priority, and requests backing off, by the time they can run again. The
+        # counter is a tie breaker, so that requests of the same priority run in submission order.
+        self._condition = threading.Condition()
+        self._ready = []
+        self._delayed = []
+        self._counter = itertools.count()
+        self._workers = [threading.Thread(target=self._work, daemon=True, name=f'gpt-scheduler-{i}')
+                         for i in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, request, tokens, priority=BATCH, deadline=None):
+        """
+        Schedules request, a function of the timeout (in seconds) to give to the HTTP call. tokens is the number
+        of tokens the request may use (prompt and completion), deadline the time.monotonic() by which it has to
+        succeed. Returns a Future of the request's result.
+        """
+        future = Future()
+        with self._condition:
+            heapq.heappush(self._ready, (priority, next(self._counter),
+                                         _Request(request, tokens, priority, deadline, future)))
+            self._condition.notify()
+        return future
+
+    def call(self, request, tokens, priority=BATCH, deadline=None):
+        """
+        Same as submit, but waits for the result.
+        """
+        return self.submit(request, tokens, priority=priority, deadline=deadline).result()
+
+    def _work(self):
+        while True:
+            request = self._next()
+            if request.attempt == 0 and not request.future.set_running_or_notify_cancel():
+                continue
+
+            timeout = self.request_timeout
+            if request.deadline is not None:
+                timeout = min(timeout, request.deadline - time.monotonic())
+            try:
+                request.future.set_result(request.request(timeout))
+            except retryable_errors() as e:
+                self._retry(request, e)
+            except BaseException as e:
+                request.future.set_exception(e)
+
+    def _next(self):
+        # Waits for the request of highest priority that is ready to run and within the rate limits, and takes it
+        # from the queue, along with its share of the rate limits
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, count, request = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (request.priority, count, request))
+                timeout = self._delayed[0][0] - now if self._delayed else None
+
+                if self._ready:
+                    request = self._ready[0][2]
+                    if request.future.cancelled():
+                        heapq.heappop(self._ready)
+                        continue
+                    wait = self._rate_limit_wait(request.tokens)
+                    if request.deadline is not None and now + wait >= request.deadline:
+                        heapq.heappop(self._ready)
+                        request.future.set_exception(TimeoutError('GPT request deadline exceeded.'))
+                        continue
+                    if wait == 0:
+                        heapq.heappop(self._ready)
+                        if self._request_bucket is not None:
+                            self._request_bucket.reserve(1)
+                        if self._token_bucket is not None:
+                            self._token_bucket.reserve(request.tokens)
+                        return request
+                    # Requests of lower priority do not overtake the one waiting for the rate limits
+                    timeout = wait if timeout is None else min(timeout, wait)
+
+                self._condition.wait(timeout)
+
+    def _rate_limit_wait(self, tokens):
+        return max(self._request_bucket.wait_time(1) if self._request_bucket is not None else 0.0,
+                   self._token_bucket.wait_time(tokens) if self._token_bucket is not None else 0.0)
+
+    def _retry(self, request, error):
+        request.attempt += 1
+        if request.attempt > self.max_retries:
+            request.future.set_exception(error)
+            return
+
+        # Exponential backoff with full jitter, unless the server says how long to wait
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** request.attempt))
+        retry_after = (getattr(error, 'headers', None) or {}).get('retry-after')
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        not_before = time.monotonic() + delay
+        if request.deadline is not None and not_before >= request.deadline:
+            request.future.set_exception(TimeoutError('GPT request deadline exceeded.'))
+            return
+
+        logging.info(f'GPT request failed ({error.__class__.__name__}: {error}), retry {request.attempt} in '
+                     f'{delay:.1f}s.')
+        with self._condition:
+            heapq.heappush(self._delayed, (not_before, next(self._counter), request))
+            self._condition.notify()
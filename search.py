@@ -0,0 +1,114 @@
+import logging
+import re
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Columns of the database that can be filtered on, by equality
+FILTER_COLUMNS = ['award', 'tier', 'wg', 'sq', 'user']
+
+
+def tokenize(text):
+    """
+    Lowercase alphanumeric tokens of a text, as a set.
+    """
+    if not isinstance(text, str):
+        return set()
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+
+class SearchIndex:
+    """
+    Index of the evaluation database for the search tab. It keeps an inverted index (token -> row numbers) over
+    the statement and explanation of every evaluation, and a copy of the columns the results can be filtered on
+    (award, tier, wing, squadron, user, score and time) as numpy arrays, with the text columns encoded as integer
+    codes. Rows are identified by their position in the database and can only be appended, so the index is updated
+    incrementally as evaluations are committed: each batch of rows adds a chunk to every column, and the chunks are
+    concatenated on the next search.
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(list)
+        self._posting_arrays = {}
+        self._codes = {column: {} for column in FILTER_COLUMNS}
+        self._chunks = {column: [] for column in FILTER_COLUMNS + ['score', 'datetime']}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def add(self, rows):
+        """
+        Indexes the rows (a DataFrame with the database columns), numbered after the rows already indexed.
+        """
+        first_id = len(self)
+        statements = rows['statement'].tolist()
+        explanations = rows['explanation'].tolist()
+        for row_id, (statement, explanation) in enumerate(zip(statements, explanations), start=first_id):
+            for token in tokenize(statement) | tokenize(explanation):
+                self._postings[token].append(row_id)
+                self._posting_arrays.pop(token, None)
+
+        for column in FILTER_COLUMNS:
+            codes = self._codes[column]
+            values = rows[column].tolist()
+            for value in set(values) - codes.keys():
+                codes[value] = len(codes)
+            self._chunks[column].append(np.array([codes[value] for value in values], dtype=np.int32))
+        self._chunks['score'].append(pd.to_numeric(rows['score'], errors='coerce').to_numpy(dtype=float))
+        self._chunks['datetime'].append(pd.to_datetime(rows['datetime'], errors='coerce').to_numpy(dtype='datetime64[us]'))
+
+        self._length += len(rows)
+        logging.info(f'Indexed {len(rows)} rows, the search index has {len(self)} rows.')
+
+    def search(self, query=None, award=None, tier=None, wg=None, sq=None, user=None,
+               min_score=None, max_score=None, start=None, end=None, limit=100):
+        """
+        Returns the row numbers of the evaluations whose statement or explanation contain all the words of the
+        query, and that match all the given filters, most recent first. start and end bound the evaluation time.
+        """
+        arrays = self._get_arrays()
+        mask = np.ones(len(self), dtype=bool)
+
+        for term in tokenize(query):
+            postings = self._posting_array(term)
+            if len(postings) == 0:
+                return []
+            term_mask = np.zeros(len(self), dtype=bool)
+            term_mask[postings] = True
+            mask &= term_mask
+
+        for column, value in zip(FILTER_COLUMNS, (award, tier, wg, sq, user)):
+            if value is not None:
+                if value not in self._codes[column]:
+                    return []
+                mask &= arrays[column] == self._codes[column][value]
+        if min_score is not None:
+            mask &= arrays['score'] >= min_score
+        if max_score is not None:
+            mask &= arrays['score'] <= max_score
+        if start is not None:
+            mask &= arrays['datetime'] >= np.datetime64(pd.Timestamp(start))
+        if end is not None:
+            mask &= arrays['datetime'] <= np.datetime64(pd.Timestamp(end))
+
+        row_ids = np.flatnonzero(mask)[::-1]
+        if limit is not None:
+            row_ids = row_ids[:limit]
+        return row_ids.tolist()
+
+    def _posting_array(self, term):
+        if term not in self._posting_arrays:
+            self._posting_arrays[term] = np.array(self._postings.get(term, ()), dtype=np.int64)
+        return self._posting_arrays[term]
+
+    def _get_arrays(self):
+        arrays = {}
+        for column, chunks in self._chunks.items():
+            if len(chunks) > 1:
+                chunks[:] = [np.concatenate(chunks)]
+            arrays[column] = chunks[0] if chunks else np.array([])
+        return arrays
@@ -0,0 +1,444 @@
+"""
+The engine as a local HTTP service, shared by several processes of the app:
+
+    OPENAI_API_KEY=... python -m evaluator serve --port 8765
+
+then set ENGINE_SERVICE_URL = 'http://127.0.0.1:8765' in the secrets of every replica of the app. The service
+process holds the only EvaluatorEngine, so there is a single writer of the database, one completion cache and one
+pool of connections (and rate limits) per backend, whatever the number of replicas. The replicas use a
+RemoteEngine, which has the methods of EvaluatorEngine the app uses, and RemoteSession objects, which keep the
+evaluations in progress of their user like EvaluationSession and ask the service to grade and commit them.
+
+Requests and replies are JSON. Statement tuples and DataFrames travel as lists, with their times as ISO strings.
+"""
+import json
+import logging
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from backends import BackendError
+from codec import decode_statement_tuple, dumps
+from engine import EvaluationSession
+from exports import EXPORT_SPOOL_SIZE
+from validation import StatementValidator
+
+DEFAULT_PORT = 8765
+
+# Seconds to wait for the connection to the service; replies can take as long as GPT does
+CONNECT_TIMEOUT = 5
+
+# Bytes of an export sent at a time
+EXPORT_CHUNK_SIZE = 2 ** 20
+
+
+class ServiceError(BackendError):
+    """
+    The engine service is unreachable, or failed for a reason other than GPT.
+    """
+
+
+def _dumps(payload):
+    return dumps(payload).encode('utf-8')
+
+
+def _encode_frame(df):
+    """
+    A DataFrame (or a Series) as a JSON serializable dictionary, see _decode_frame.
+    """
+    import pandas as pd
+
+    series = isinstance(df, pd.Series)
+    if series:
+        df = df.to_frame()
+    values = df.astype(object).where(df.notna(), None)
+    return {'columns': list(df.columns),
+            'index': [None if pd.isna(i) else i for i in df.index],
+            'index_name': df.index.name,
+            'dates': [column for column in df.columns
+                      if pd.api.types.infer_dtype(df[column], skipna=True) in ('datetime64', 'datetime', 'date')],
+            'date_index': isinstance(df.index, pd.DatetimeIndex),
+            'data': values.values.tolist(),
+            'series': series}
+
+
+def _decode_frame(payload):
+    import pandas as pd
+
+    index = pd.Index(payload['index'], name=payload['index_name'])
+    if payload['date_index']:
+        index = pd.DatetimeIndex(pd.to_datetime(payload['index']), name=payload['index_name'])
+    df = pd.DataFrame(payload['data'], columns=payload['columns'], index=index)
+    for column in payload['dates']:
+        df[column] = pd.to_datetime(df[column])
+    return df.iloc[:, 0] if payload['series'] else df
+
+
+def _error_status(error):
+    # Timeouts and GPT errors get their own status, so that the client raises the same kind of error as the engine
+    if isinstance(error, TimeoutError):
+        return 504
+    if isinstance(error, BackendError):
+        return 502
+    try:
+        import openai
+    except ImportError:
+        return 500
+    return 502 if isinstance(error, openai.error.OpenAIError) else 500
+
+
+class EngineService:
+    """
+    HTTP server in front of an engine, one thread per request. The evaluation requests carry the settings of the
+    session that sends them (see EvaluationSession.settings), and are graded by a throwaway session of the engine,
+    so the service holds no per-user state.
+    """
+
+    def __init__(self, engine, host='127.0.0.1', port=DEFAULT_PORT):
+        self.engine = engine
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def serve_forever(self):
+        logging.info(f'Serving the engine on {self.url}')
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True, name='engine-service')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _session(self, request):
+        session = self.engine.new_session()
+        session.apply_settings(request.get('settings', {}))
+        session.api_key = request.get('api_key')
+        return session
+
+    #############
+    # Endpoints #
+    #############
+
+    def info(self, request):
+        engine = self.engine
+        return {'gpt_parameters': engine.gpt_parameters,
+                'statement_parameters': engine.statement_parameters,
+                'max_concurrent_requests': engine.max_concurrent_requests,
+                'routes': engine.routes}
+
+    def database_size(self, request):
+        return {'database_size': self.engine.database_size()}
+
+    def evaluate(self, request):
+        session = self._session(request)
+        return {'statement_tuple': session.extract_evaluation(request['statement'], request['user'],
+                                                              request.get('user_score'),
+                                                              resample=request.get('resample', False))}
+
+    def evaluate_batch(self, request):
+        session = self._session(request)
+        return {'statement_tuples': session.extract_evaluations(request['statements'], request['user'],
+                                                                user_scores=request.get('user_scores'),
+                                                                resample=request.get('resample', False))}
+
+    def insert(self, request):
+        statement_tuples = [decode_statement_tuple(s) for s in request['statement_tuples']]
+        self.engine.insert_evaluations(statement_tuples)
+        return {'inserted': len(statement_tuples)}
+
+    def search(self, request):
+        return _encode_frame(self.engine.search(**request))
+
+    def find_similar(self, request):
+        return _encode_frame(self.engine.find_similar(**request))
+
+    def analytics(self, request):
+        method = request['method']
+        if method not in ('summary', 'histogram', 'trend'):
+            raise ValueError(f'Unknown analytics query {method}.')
+        return _encode_frame(getattr(self.engine.analytics(), method)(**request.get('arguments', {})))
+
+    def cache_stats(self, request):
+        return {'cache_stats': self.engine.cache_stats()}
+
+    def metrics(self, request):
+        metrics = self.engine.metrics
+        return {'summary': metrics.summary(), 'counters': metrics.counters(), 'prometheus': metrics.to_prometheus()}
+
+    ENDPOINTS = ('info', 'database_size', 'evaluate', 'evaluate_batch', 'insert', 'search', 'find_similar',
+                 'analytics', 'cache_stats', 'metrics')
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so that the clients reuse their connections
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def _send(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_error(self, error):
+                if _error_status(error) == 500:
+                    logging.exception(f'{self.path} failed.')
+                self._send(_error_status(error), _dumps({'error': error.__class__.__name__, 'message': str(error)}))
+
+            def do_POST(self):
+                endpoint = urlsplit(self.path).path.strip('/')
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    if endpoint == 'stream':
+                        self._stream(request)
+                    elif endpoint == 'export':
+                        self._export(request)
+                    elif endpoint in service.ENDPOINTS:
+                        self._send(200, _dumps(getattr(service, endpoint)(request)))
+                    else:
+                        self._send(404, _dumps({'error': 'NotFound', 'message': f'No endpoint {endpoint}.'}))
+                except Exception as e:
+                    self._send_error(e)
+
+            do_GET = do_POST
+
+            def _write_chunk(self, data):
+                # A chunk of a reply of unknown length (Transfer-Encoding: chunked), empty for the last one
+                self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+
+            def _export(self, request):
+                # Sent as it is read, so that a large export is never in memory at once
+                file = service.engine.export(**request)
+                with file:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for data in iter(lambda: file.read(EXPORT_CHUNK_SIZE), b''):
+                        self._write_chunk(data)
+                    self._write_chunk(b'')
+
+            def _stream(self, request):
+                # Newline delimited JSON: the (justification, score) pairs, then the statement tuple. The first
+                # pair is awaited before answering, so that the errors of the GPT request get their status.
+                session = service._session(request)
+                pieces = session.stream_evaluation(request['statement'], request['user'], request.get('user_score'),
+                                                   resample=request.get('resample', False))
+                first = next(pieces, None)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                def write(payload):
+                    self._write_chunk(_dumps(payload) + b'\n')
+                    self.wfile.flush()
+
+                try:
+                    if first is not None:
+                        write({'justification': first[0], 'score': first[1]})
+                        for justification, score in pieces:
+                            write({'justification': justification, 'score': score})
+                    write({'statement_tuple': session._current_extracted_statement})
+                except Exception as e:
+                    logging.exception('Streamed evaluation failed.')
+                    write({'error': e.__class__.__name__, 'message': str(e), 'status': _error_status(e)})
+                self._write_chunk(b'')
+
+        return Handler
+
+
+def _raise_for_error(status, payload):
+    message = f"{payload.get('error')}: {payload.get('message')}"
+    if status == 504:
+        raise TimeoutError(message)
+    if status == 502:
+        raise BackendError(message)
+    raise ServiceError(f'The engine service answered {status}, {message}')
+
+
+class RemoteMetrics:
+    """
+    The metrics of the service's engine, with the methods of Metrics the app uses.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def summary(self):
+        return self._engine._call('metrics')['summary']
+
+    def counters(self):
+        return self._engine._call('metrics')['counters']
+
+    def to_prometheus(self):
+        return self._engine._call('metrics')['prometheus']
+
+
+class RemoteAnalytics:
+    """
+    The analytics of the service's engine, with the queries of ScoreAnalytics.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def _query(self, method, **arguments):
+        return _decode_frame(self._engine._call('analytics', {'method': method, 'arguments': arguments}))
+
+    def summary(self, column=None):
+        return self._query('summary', column=column)
+
+    def histogram(self, column=None, value=None):
+        return self._query('histogram', column=column, value=value)
+
+    def trend(self, column=None, value=None, frequency='day'):
+        return self._query('trend', column=column, value=value, frequency=frequency)
+
+
+class RemoteEngine:
+    """
+    Client of an EngineService, in place of an EvaluatorEngine: it has the methods of the engine the app uses, and
+    its sessions are RemoteSession objects. Statements are validated locally, everything else is done by the
+    service. The OpenAI key of the service is never sent to the clients, so api_key is None.
+    """
+
+    api_key = None
+
+    def __init__(self, url, max_connections=16):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.url = url.rstrip('/')
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+
+        info = self._call('info')
+        self.gpt_parameters = info['gpt_parameters']
+        self.statement_parameters = info['statement_parameters']
+        self.max_concurrent_requests = info['max_concurrent_requests']
+        self.routes = info['routes']
+        self.validator = StatementValidator()
+        self.metrics = RemoteMetrics(self)
+
+    def _post(self, endpoint, request=None, stream=False):
+        import requests
+
+        try:
+            response = self._http.post(f'{self.url}/{endpoint}', data=_dumps(request or {}),
+                                       headers={'Content-Type': 'application/json'},
+                                       timeout=(CONNECT_TIMEOUT, None), stream=stream)
+        except requests.RequestException as e:
+            raise ServiceError(f'The engine service at {self.url} is unreachable: {e}') from e
+        if response.status_code != 200:
+            _raise_for_error(response.status_code, response.json())
+        return response
+
+    def _call(self, endpoint, request=None):
+        return self._post(endpoint, request).json()
+
+    def new_session(self):
+        return RemoteSession(self)
+
+    def validate_statement(self, statement_utterance):
+        return self.validator.validate(statement_utterance)
+
+    def database_size(self):
+        return self._call('database_size')['database_size']
+
+    def insert_evaluations(self, statement_tuples):
+        self._call('insert', {'statement_tuples': list(statement_tuples)})
+
+    def search(self, query=None, **filters):
+        return _decode_frame(self._call('search', dict(filters, query=query)))
+
+    def find_similar(self, statement_utterance, k=5, min_similarity=0.0, parameters=None, only_valid=False):
+        return _decode_frame(self._call('find_similar', {'statement_utterance': statement_utterance, 'k': k,
+                                                         'min_similarity': min_similarity,
+                                                         'parameters': parameters, 'only_valid': only_valid}))
+
+    def analytics(self):
+        return RemoteAnalytics(self)
+
+    def cache_stats(self):
+        return self._call('cache_stats')['cache_stats']
+
+    def export(self, file_type='csv', query=None, limit=None, **filters):
+        """
+        The export of the service, as a file object like EvaluatorEngine.export: received a chunk at a time, and
+        spilled to a temporary file on disk if large.
+        """
+        request = dict(filters, file_type=file_type, query=query, limit=limit)
+        file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        try:
+            with self._post('export', request, stream=True) as response:
+                for data in response.iter_content(EXPORT_CHUNK_SIZE):
+                    file.write(data)
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        return file
+
+
+class RemoteSession(EvaluationSession):
+    """
+    EvaluationSession of a RemoteEngine: the evaluations in progress stay here, with the user, but are graded and
+    committed by the service, under the settings of this session.
+    """
+
+    def _request(self, **request):
+        return dict(request, settings=self.settings(), api_key=self.api_key or None)
+
+    def extract_evaluation(self, statement_utterance, user, user_score, resample=False):
+        reply = self._engine._call('evaluate', self._request(statement=statement_utterance, user=user,
+                                                             user_score=user_score, resample=resample))
+        self._current_extracted_statement = decode_statement_tuple(reply['statement_tuple'])
+        return self._current_extracted_statement
+
+    def stream_evaluation(self, statement_utterance, user, user_score, resample=False):
+        response = self._engine._post('stream', self._request(statement=statement_utterance, user=user,
+                                                              user_score=user_score, resample=resample),
+                                      stream=True)
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                payload = json.loads(line)
+                if 'error' in payload:
+                    _raise_for_error(payload['status'], payload)
+                elif 'statement_tuple' in payload:
+                    self._current_extracted_statement = decode_statement_tuple(payload['statement_tuple'])
+                else:
+                    yield payload['justification'], payload['score']
+
+    def extract_evaluations(self, statement_utterances, user, user_scores=None, max_workers=None, resample=False):
+        # The service sends the requests of the batch concurrently, max_workers is its own
+        reply = self._engine._call('evaluate_batch', self._request(statements=list(statement_utterances), user=user,
+                                                                   user_scores=user_scores, resample=resample))
+        self._current_extracted_statements = [decode_statement_tuple(s) for s in reply['statement_tuples']]
+        return self._current_extracted_statements
@@ -0,0 +1,105 @@
+import logging
+import re
+
+import numpy as np
+
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Number of set bits of every byte, to count the bits of the signatures' XOR
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def shingles(text, n=3):
+    """
+    Set of the character n-grams of the normalized text (lowercase words separated by single spaces).
+    """
+    if not isinstance(text, str):
+        return set()
+    normalized = ' '.join(WORD_PATTERN.findall(text.lower()))
+    if len(normalized) < n:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + n] for i in range(len(normalized) - n + 1)}
+
+
+def simhashes(feature_sets):
+    """
+    64-bit SimHashes of several sets of features at once: texts sharing most of their features get signatures
+    that differ in only a few bits. The features are hashed with Python's hash(), which is salted per process,
+    so the signatures must not be persisted.
+    """
+    lengths = np.array([len(features) for features in feature_sets], dtype=np.int64)
+    signatures = np.zeros(len(feature_sets), dtype=np.uint64)
+    if lengths.sum() == 0:
+        return signatures
+
+    hashes = np.fromiter((hash(f) & 0xFFFFFFFFFFFFFFFF for features in feature_sets for f in features),
+                         dtype=np.uint64, count=int(lengths.sum()))
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+
+    # Sum the bits of the features of every set (empty sets keep a zero signature)
+    non_empty = lengths > 0
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])[non_empty]
+    votes = 2 * np.add.reduceat(bits, offsets, axis=0, dtype=np.int32) - lengths[non_empty, None]
+    signatures[non_empty] = np.packbits(votes > 0, axis=1, bitorder='little').view(np.uint64).ravel()
+    return signatures
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest neighbour index of the stored statements, to find near-duplicates without calling GPT.
+    Every statement is reduced to the SimHash of its character trigrams. A query scans all the signatures at once
+    (XOR and bit count, vectorized) for the closest ones in Hamming distance, and only these candidates are
+    compared exactly, by the Jaccard similarity of their trigrams. Rows are identified by their position in the
+    database, and are appended as evaluations are committed.
+    """
+
+    def __init__(self, n_candidates=50):
+        self.n_candidates = n_candidates
+
+        self._texts = []
+        self._chunks = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def add(self, statements, batch_size=4096):
+        statements = list(statements)
+        self._texts.extend(statements)
+        for i in range(0, len(statements), batch_size):
+            self._chunks.append(simhashes([shingles(s) for s in statements[i:i + batch_size]]))
+        self._length += len(statements)
+        logging.info(f'Indexed {len(statements)} statements, the similarity index has {len(self)} statements.')
+
+    def query(self, statement, k=5, min_similarity=0.0, row_mask=None):
+        """
+        Returns up to k pairs (row number, similarity) of the statements most similar to the given one, most
+        similar first. The similarity is the Jaccard similarity of the trigrams, between 0 and 1. row_mask, a
+        boolean array over the rows, restricts the search to some of them.
+        """
+        if self._length == 0:
+            return []
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        signatures = self._chunks[0]
+
+        query_shingles = shingles(statement)
+        distances = _POPCOUNT[(signatures ^ simhashes([query_shingles])[0]).view(np.uint8)] \
+            .reshape(-1, 8).sum(axis=1, dtype=np.int64)
+        if row_mask is not None:
+            distances = np.where(row_mask, distances, 65)
+
+        n_candidates = min(max(k, self.n_candidates), self._length)
+        candidates = np.argpartition(distances, n_candidates - 1)[:n_candidates]
+        candidates = candidates[distances[candidates] <= 64]
+
+        neighbours = [(int(row_id), jaccard(query_shingles, shingles(self._texts[row_id]))) for row_id in candidates]
+        neighbours = [(row_id, similarity) for row_id, similarity in neighbours if similarity >= min_similarity]
+        neighbours.sort(key=lambda n: n[1], reverse=True)
+        return neighbours[:k]
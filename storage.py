@@ -0,0 +1,406 @@
+import csv
+import glob
+import hashlib
+import logging
+import os
+import shutil
+from datetime import datetime as dt
+
+import pandas as pd
+
+from prompts import award_dict, tier_dict, wg_pri_dict, sq_pri_dict
+
+DATABASE_COLUMNS = ['statement', 'score', 'user_score',
+                    'explanation', 'award', 'tier',
+                    'wg', 'sq', 'user', 'datetime',
+                    'prompt_tokens', 'completion_tokens',
+                    'score_mean', 'score_spread', 'score_samples',
+                    'action_score', 'result_score', 'impact_score', 'scope_score']
+
+# The database stores the keys of these dictionaries, the texts behind the keys live in the lookup table
+LOOKUP_DIMENSIONS = {'award': award_dict,
+                     'tier': tier_dict,
+                     'wg': wg_pri_dict,
+                     'sq': sq_pri_dict}
+
+LOOKUP_COLUMNS = ['dimension', 'key', 'version', 'text', 'since']
+
+# Types of the database columns in the columnar format (the others are strings)
+FLOAT_COLUMNS = ['score', 'user_score', 'score_mean', 'score_spread',
+                 'action_score', 'result_score', 'impact_score', 'scope_score']
+INTEGER_COLUMNS = ['prompt_tokens', 'completion_tokens']
+CATEGORICAL_COLUMNS = ['award', 'tier', 'wg', 'sq']
+TIMESTAMP_COLUMNS = ['datetime']
+
+
+def open_store(file_path, compact_every=1000):
+    """
+    Storage of the database at file_path, in the columnar format if the path ends with .parquet, in CSV otherwise.
+    """
+    if file_path.endswith('.parquet'):
+        return ParquetStore(file_path, compact_every=compact_every)
+    return CSVStore(file_path, compact_every=compact_every)
+
+
+def convert_database(source_path, destination_path):
+    """
+    Copies the database at source_path to destination_path, e.g., from CSV to Parquet. The formats are chosen
+    from the paths as in open_store. Returns the number of rows.
+    """
+    database = open_store(source_path).load()
+    open_store(destination_path).compact(database)
+    logging.info(f'Converted database {source_path} to {destination_path} ({len(database)} rows).')
+    return len(database)
+
+
+def _fsync(path):
+    # Waits until the file is on disk, e.g., before the commits it holds are removed from the write-ahead log
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _parquet():
+    # pyarrow is optional, only the Parquet store needs it (and it is slow to import)
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('The Parquet database format requires pyarrow (pip install pyarrow).') from None
+    return pq
+
+
+class CSVStore:
+    """
+    Append-only CSV storage for the evaluation database. New evaluations are appended to the end of the file
+    instead of rewriting it, so the cost of a commit only depends on the number of new rows. Every so often
+    (or whenever the schema of the new rows does not match the file header) the file is compacted, i.e.,
+    rewritten in full from the in-memory database.
+
+    The size of the file before an append is kept aside until the append is on disk: an append interrupted by a
+    crash is cut off the file on the next load, instead of leaving a partial row.
+    """
+
+    def __init__(self, file_path, compact_every=1000):
+        self.file_path = file_path
+        self.compact_every = compact_every
+
+        self._header = None
+        self._appends_since_compaction = 0
+        self._append_marker_path = f'{file_path}.appending'
+
+    def load(self, read_only=False):
+        """
+        Loads the whole database, or creates an empty one if the file does not exist yet. With read_only, e.g.,
+        when another engine writes the file, the file is neither recovered nor created.
+        """
+        if not read_only:
+            self._recover()
+        try:
+            # Only empty fields are missing values, 'N/A' is a valid key of the prompt dictionaries
+            database = pd.read_csv(self.file_path, keep_default_na=False, na_values=[''], dtype={'score_samples': str})
+            logging.info(f'Loaded database from {self.file_path}.')
+        except FileNotFoundError:
+            database = pd.DataFrame(columns=DATABASE_COLUMNS)
+            if not read_only:
+                self.compact(database)
+                logging.info(f'Created database in {self.file_path}')
+
+        self._header = list(database.columns)
+        return database
+
+    def append(self, rows):
+        """
+        Appends the rows (a DataFrame) to the end of the file, in the column order of the file header.
+        Returns False, without writing anything, if the rows have columns the file does not know about;
+        the caller then has to compact the full database instead.
+        """
+        if len(rows) == 0:
+            return True
+
+        header = self._read_header()
+        if header is None or not set(rows.columns) <= set(header):
+            return False
+
+        self._recover()
+        with open(self._append_marker_path, 'w') as f:
+            f.write(str(os.path.getsize(self.file_path)))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.file_path, 'a', newline='') as f:
+            rows.reindex(columns=header).to_csv(f, header=False, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(self._append_marker_path)
+        self._appends_since_compaction += 1
+        logging.info(f'Appended {len(rows)} rows to {self.file_path}.')
+        return True
+
+    def needs_compaction(self):
+        return self._appends_since_compaction >= self.compact_every
+
+    def compact(self, database):
+        """
+        Rewrites the whole file from the given database. The new file is written next to the old one and then
+        moved over it, so a failure mid-write never leaves a truncated database behind.
+        """
+        tmp_file_path = f'{self.file_path}.tmp'
+        database.to_csv(tmp_file_path, index=False)
+        _fsync(tmp_file_path)
+        os.replace(tmp_file_path, self.file_path)
+
+        self._header = list(database.columns)
+        self._appends_since_compaction = 0
+        logging.info(f'Compacted database in {self.file_path} ({len(database)} rows).')
+
+    def _recover(self):
+        try:
+            with open(self._append_marker_path) as f:
+                size = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return
+        if os.path.exists(self.file_path):
+            os.truncate(self.file_path, size)
+        os.remove(self._append_marker_path)
+        logging.warning(f'Removed the rows of an interrupted append from {self.file_path}.')
+
+    def _read_header(self):
+        if self._header is None:
+            try:
+                with open(self.file_path, newline='') as f:
+                    self._header = next(csv.reader(f), None)
+            except FileNotFoundError:
+                return None
+        return self._header
+
+
+class ParquetStore:
+    """
+    Columnar storage for the evaluation database: a directory of Parquet files with typed columns (float scores,
+    categorical award, tier, wing and squadron, timestamps). Every append writes a new part file, so a commit never
+    rewrites the existing data; compacting merges the parts into a single one. Loads are memory-mapped and can be
+    restricted to some of the columns, e.g., for analytics over the scores.
+    """
+
+    def __init__(self, file_path, compact_every=1000):
+        self.file_path = file_path
+        self.compact_every = compact_every
+
+        self._columns = None
+        self._appends_since_compaction = 0
+
+    def load(self, columns=None, read_only=False):
+        """
+        Loads the database, only the given columns if any, or creates an empty one if the directory does not
+        exist yet. With read_only, e.g., when another engine writes the database, it is neither recovered nor
+        created.
+        """
+        pq = _parquet()
+        if not read_only:
+            self._recover()
+
+        parts = self._parts()
+        if parts:
+            database = pq.read_table(parts, columns=columns, memory_map=True).to_pandas()
+            self._columns = self._schema_columns(parts[0])
+            logging.info(f'Loaded database from {self.file_path} ({len(parts)} parts).')
+        else:
+            database = self.typed(pd.DataFrame(columns=DATABASE_COLUMNS))
+            if not read_only:
+                self.compact(database)
+                logging.info(f'Created database in {self.file_path}')
+            if columns is not None:
+                database = database[columns]
+        return database
+
+    def append(self, rows):
+        """
+        Writes the rows (a DataFrame) to a new part file. Returns False, without writing anything, if the rows
+        have columns the database does not know about; the caller then has to compact the full database instead.
+        """
+        if len(rows) == 0:
+            return True
+
+        columns = self._read_columns()
+        if columns is None or not set(rows.columns) <= set(columns):
+            return False
+
+        self._write(self.typed(rows.reindex(columns=columns)), self._next_part())
+        self._appends_since_compaction += 1
+        logging.info(f'Appended {len(rows)} rows to {self.file_path}.')
+        return True
+
+    def needs_compaction(self):
+        return self._appends_since_compaction >= self.compact_every
+
+    def compact(self, database):
+        """
+        Rewrites the whole database as a single part. The new directory is written next to the old one and then
+        swapped with it, so a failure mid-write never leaves a partial database behind.
+        """
+        tmp_path = f'{self.file_path}.tmp'
+        old_path = f'{self.file_path}.old'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        self._write(self.typed(database), os.path.join(tmp_path, 'part-00000000.parquet'))
+
+        if os.path.exists(self.file_path):
+            os.replace(self.file_path, old_path)
+        os.replace(tmp_path, self.file_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        self._columns = list(database.columns)
+        self._appends_since_compaction = 0
+        logging.info(f'Compacted database in {self.file_path} ({len(database)} rows).')
+
+    @staticmethod
+    def typed(database):
+        """
+        Copy of the database with the column types of the columnar format.
+        """
+        database = database.copy()
+        for column in database.columns:
+            if column in FLOAT_COLUMNS:
+                database[column] = pd.to_numeric(database[column], errors='coerce').astype('float64')
+            elif column in INTEGER_COLUMNS:
+                database[column] = pd.to_numeric(database[column], errors='coerce').astype('Int64')
+            elif column in CATEGORICAL_COLUMNS:
+                database[column] = database[column].astype('category')
+            elif column in TIMESTAMP_COLUMNS:
+                # A single unit, so that every part has the same schema whatever the times it holds
+                database[column] = pd.to_datetime(database[column], errors='coerce').astype('datetime64[ns]')
+            else:
+                database[column] = database[column].astype('string')
+        return database
+
+    def _write(self, database, path):
+        pq = _parquet()
+        import pyarrow as pa
+
+        # Written aside and then renamed, so an interrupted write never leaves a partial part behind
+        table = pa.Table.from_pandas(database, preserve_index=False)
+        tmp_path = f'{path}.tmp'
+        pq.write_table(table, tmp_path)
+        _fsync(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _parts(self):
+        return sorted(glob.glob(os.path.join(self.file_path, 'part-*.parquet')))
+
+    def _next_part(self):
+        parts = self._parts()
+        number = int(os.path.basename(parts[-1])[5:13]) + 1 if parts else 0
+        return os.path.join(self.file_path, f'part-{number:08d}.parquet')
+
+    def _recover(self):
+        # A compaction interrupted between the two renames leaves the previous database aside
+        old_path = f'{self.file_path}.old'
+        if not os.path.exists(self.file_path) and os.path.exists(old_path):
+            os.replace(old_path, self.file_path)
+            logging.warning(f'Recovered database {self.file_path} from an interrupted compaction.')
+
+    def _read_columns(self):
+        if self._columns is None:
+            parts = self._parts()
+            if not parts:
+                return None
+            self._columns = self._schema_columns(parts[0])
+        return self._columns
+
+    @staticmethod
+    def _schema_columns(path):
+        return _parquet().read_schema(path).names
+
+
+class PriorityLookup:
+    """
+    Lookup table of the texts behind the award, tier, wing and squadron keys stored in the evaluation database.
+    Every text is stored once, along with a version (a hash of the text) and the time it was first seen, so that
+    evaluations made before a text was edited in prompts.py can still be traced back to the text they were graded
+    against.
+
+    With read_only, e.g., for an engine next to the one writing the database, new texts are only added in memory.
+    """
+
+    def __init__(self, file_path='./data/lookup.csv', read_only=False):
+        self.file_path = file_path
+        self.read_only = read_only
+
+        try:
+            self.table = pd.read_csv(self.file_path, keep_default_na=False)
+        except FileNotFoundError:
+            self.table = pd.DataFrame(columns=LOOKUP_COLUMNS)
+
+        self.register_current()
+
+    @staticmethod
+    def version(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:8]
+
+    def register_current(self):
+        """
+        Adds the current texts from prompts.py to the table, if they are not there yet.
+        """
+        new_rows = []
+        for dimension, dictionary in LOOKUP_DIMENSIONS.items():
+            for key, text in dictionary.items():
+                if text is not None and not self._has(dimension, key, self.version(text)):
+                    new_rows.append((dimension, key, self.version(text), text, dt.now()))
+        self._add(new_rows)
+
+    def text(self, dimension, key, version=None):
+        """
+        Returns the text behind a key, in its latest version unless a version is given.
+        """
+        rows = self.table[(self.table['dimension'] == dimension) & (self.table['key'] == key)]
+        if version is not None:
+            rows = rows[rows['version'] == version]
+        return rows['text'].iloc[-1] if len(rows) > 0 else None
+
+    def key(self, dimension, text):
+        """
+        Returns the key of a text, registering it under a new key derived from its version if it is unknown.
+        """
+        version = self.version(text)
+        rows = self.table[(self.table['dimension'] == dimension) & (self.table['version'] == version)]
+        if len(rows) > 0:
+            return rows['key'].iloc[-1]
+
+        key = f'custom-{version}'
+        self._add([(dimension, key, version, text, dt.now())])
+        return key
+
+    def normalize(self, database):
+        """
+        Migrates a database that stores full texts in the award, tier, wing and squadron columns to one that stores
+        their keys. Returns the migrated database and the number of values that were replaced.
+        """
+        database = database.copy()
+        n_replaced = 0
+        for dimension in LOOKUP_DIMENSIONS:
+            if dimension not in database.columns:
+                continue
+            values = database[dimension].dropna().unique()
+            # Anything that is not already a key is a text to be replaced by its key. The keys without a text
+            # (e.g., 'N/A') are not in the table, but are keys all the same.
+            known_keys = set(self.table.loc[self.table['dimension'] == dimension, 'key'])
+            known_keys.update(LOOKUP_DIMENSIONS[dimension])
+            mapping = {v: self.key(dimension, v) for v in values if isinstance(v, str) and v not in known_keys}
+            if mapping:
+                n_replaced += int(database[dimension].isin(list(mapping)).sum())
+                column = database[dimension]
+                replaced = column.astype(object).replace(mapping)
+                # Categorical columns (columnar format) cannot take new values in place
+                database[dimension] = replaced.astype('category') if column.dtype == 'category' else replaced
+        return database, n_replaced
+
+    def _has(self, dimension, key, version):
+        return ((self.table['dimension'] == dimension) & (self.table['key'] == key)
+                & (self.table['version'] == version)).any()
+
+    def _add(self, rows):
+        if not rows:
+            return
+        self.table = pd.concat([self.table, pd.DataFrame(rows, columns=LOOKUP_COLUMNS)], ignore_index=True)
+        if self.read_only:
+            return
+        self.table.to_csv(self.file_path, index=False)
+        logging.info(f'Added {len(rows)} texts to the lookup table in {self.file_path}.')
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_llm import FakeLLMServer  # noqa: E402
+
+
+@pytest.fixture
+def fake_llm():
+    """
+    Fake chat completion server (see benchmarks/fake_llm.py), without latency.
+    """
+    with FakeLLMServer(latency=0.0) as server:
+        yield server
+
+
+@pytest.fixture
+def make_engine(tmp_path, fake_llm):
+    """
+    Builds engines on a database in the test's directory, talking to the fake server; they are closed at the end
+    of the test.
+    """
+    from engine import EvaluatorEngine
+
+    engines = []
+
+    def make(database_file_path=None, **kwargs):
+        arguments = dict(api_key='fake', api_base=fake_llm.url,
+                         database_file_path=database_file_path or str(tmp_path / 'database.csv'),
+                         lookup_file_path=str(tmp_path / 'lookup.csv'), cache_file_path=None,
+                         requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9, checkpoint_interval=3600)
+        arguments.update(kwargs)
+        engine = EvaluatorEngine(**arguments)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        engine.close()
@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fake_llm import FakeLLMServer
+from storage import DATABASE_COLUMNS
+
+
+def statement_tuple(statement, score=12.0, user='user', **fields):
+    s = dict.fromkeys(DATABASE_COLUMNS)
+    s.update(statement=statement, score=score, explanation='Good.', award='Performer of the Month', tier='Amn',
+             wg='480 ISRW', sq='30 IS', user=user, datetime=pd.Timestamp.now().to_pydatetime())
+    s.update(fields)
+    return tuple(s[column] for column in DATABASE_COLUMNS)
+
+
+def test_commits_before_the_load_are_not_lost(make_engine):
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('first')])
+    engine.close()
+
+    # Committed to the write-ahead log while the database is not loaded yet
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('second')])
+    assert engine.database_size() == 2
+    assert list(engine.search('second')['statement']) == ['second']
+    assert engine.analytics().summary().loc[None, 'count'] == 2
+
+    engine.checkpoint()
+    engine.compact()
+    engine.close()
+    assert sorted(make_engine().database['statement']) == ['first', 'second']
+
+
+def test_service_commits_before_the_load(make_engine):
+    from service import EngineService, RemoteEngine
+
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('first')])
+    engine.close()
+
+    with EngineService(make_engine(), port=0) as service:
+        remote = RemoteEngine(service.url)
+        remote.insert_evaluations([statement_tuple(f'statement {i}') for i in range(4)])
+        assert remote.database_size() == 5
+
+
+def test_commits_are_replayed_after_a_crash(tmp_path, make_engine):
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('first'), statement_tuple('second')])
+    # A crash: the log is not checkpointed, and its lock released
+    engine._checkpoint_stop.set()
+    engine._wal.close()
+    engine._wal = None
+
+    assert sorted(make_engine().database['statement']) == ['first', 'second']
+    assert not (tmp_path / 'database.csv.wal').read_bytes()
+
+
+def test_sessions_commit_to_the_database(make_engine):
+    engine = make_engine()
+    session = engine.new_session()
+    session.extract_evaluations([f'- Led {i} Amn; saved {i} hrs' for i in range(3)], 'user')
+    session.commit_batch()
+    assert engine.database_size() == 3
+    assert engine.database['score'].notna().all()
+
+
+def test_batches_keep_the_input_order(make_engine):
+    statements = [f'- Led {i} Amn through the exercise; saved {i} hrs' for i in range(12)]
+    with FakeLLMServer(latency=0.0, jitter=0.05, seed=1) as server:
+        session = make_engine(api_base=server.url).new_session()
+        statement_tuples = session.extract_evaluations(statements, 'user', max_workers=6)
+    # The replies came back out of order, the results did not
+    assert sorted(server.replied) == sorted(statements) and server.replied != statements
+    assert [s[0] for s in statement_tuples] == statements
+
+
+def test_batches_send_at_most_max_workers_requests_at_once(make_engine):
+    statements = [f'- Led {i} Amn through the exercise; saved {i} hrs' for i in range(12)]
+    with FakeLLMServer(latency=0.01, jitter=0.05, seed=2) as server:
+        session = make_engine(api_base=server.url).new_session()
+        session.extract_evaluations(statements, 'user', max_workers=3)
+    assert server.n_requests == len(statements)
+    assert server.max_in_flight == 3
+
+
+def test_reused_legacy_evaluation_is_committed(tmp_path, make_engine):
+    # Rows from before multi-sample scoring have no samples: missing values (pd.NA, NaN) in the Parquet database
+    pytest.importorskip('pyarrow')
+    database_file_path = str(tmp_path / 'database.parquet')
+    engine = make_engine(database_file_path)
+    engine.insert_evaluations([statement_tuple('- Led 5 Amn through the exercise; saved 10 hrs')])
+    engine.close()
+
+    engine = make_engine(database_file_path)
+    session = engine.new_session()
+    near_duplicate = session.find_near_duplicate('- Led 5 Amn through the exercise; saved 12 hrs')
+    assert near_duplicate is not None
+    session.reuse_evaluation(near_duplicate, '- Led 5 Amn through the exercise; saved 12 hrs', 'user', None)
+    session.commit()
+    engine.close()
+
+    database = make_engine(database_file_path).database
+    assert len(database) == 2
+    assert database['score_samples'].isna().all()
+
+
+def test_missing_values_are_encoded_as_null():
+    from codec import decode_statement_tuple, dumps
+
+    s = statement_tuple('statement')
+    s = s[:1] + (np.float32('nan'),) + s[2:9] + (pd.NaT,) + s[10:14] + (pd.NA,) + s[15:]
+    decoded = decode_statement_tuple(json.loads(dumps(s)))
+    assert decoded[1] is None and decoded[9] is None and decoded[14] is None
+
+
+def test_a_second_writer_refuses_to_start(make_engine):
+    from wal import WriteAheadLogLocked
+
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('first')])
+    with pytest.raises(WriteAheadLogLocked):
+        make_engine()
+
+    # Readers do not take the lock, and see what has been checkpointed
+    engine.checkpoint()
+    reader = make_engine(read_only=True)
+    assert list(reader.database['statement']) == ['first']
+    with pytest.raises(RuntimeError):
+        reader.insert_evaluations([statement_tuple('second')])
+
+
+def test_readers_leave_an_append_in_progress_alone(tmp_path, make_engine):
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('first')])
+    engine.checkpoint()
+
+    # The writer is in the middle of an append
+    database_file_path = tmp_path / 'database.csv'
+    marker = tmp_path / 'database.csv.appending'
+    marker.write_text(str(database_file_path.stat().st_size))
+    with open(database_file_path, 'a') as f:
+        f.write('second,12\n')
+
+    make_engine(read_only=True).database_size()
+    assert marker.exists()
+    assert database_file_path.read_text().endswith('second,12\n')
+    marker.unlink()
+
+
+def test_keys_without_text_survive_a_reload(tmp_path, make_engine):
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('statement', award='N/A', wg='N/A')])
+    engine.close()
+    size = (tmp_path / 'database.csv').stat().st_size
+
+    engine = make_engine()
+    assert list(engine.search(award='N/A', wg='N/A')['statement']) == ['statement']
+    # Nothing to migrate, so the file is not rewritten
+    assert (tmp_path / 'database.csv').stat().st_size == size
+
+
+@pytest.mark.parametrize('compaction', [False, True])
+def test_commits_go_on_during_a_checkpoint(tmp_path, make_engine, compaction):
+    engine = make_engine()
+    engine.insert_evaluations([statement_tuple('first')])
+    # Loaded, the database is read from memory; only a first load has to wait for the file
+    assert engine.database_size() == 1
+    if compaction:
+        engine._get_storage().needs_compaction = lambda: True
+
+    # The disk is slow: the checkpoint waits in the middle of its append
+    storage = engine._get_storage()
+    appending, resume = threading.Event(), threading.Event()
+    append = storage.append
+
+    def slow_append(rows):
+        appending.set()
+        resume.wait(10)
+        return append(rows)
+
+    storage.append = slow_append
+    checkpoint = threading.Thread(target=engine.checkpoint)
+    checkpoint.start()
+    assert appending.wait(10)
+
+    started = time.monotonic()
+    engine.insert_evaluations([statement_tuple('second')])
+    assert engine.database_size() == 2
+    assert time.monotonic() - started < 5
+    resume.set()
+    checkpoint.join()
+
+    # Only the commit that was checkpointed leaves the log
+    assert [[s[0] for s in record] for record in engine._wal.records()] == [['second']]
+    storage.append = append
+    engine.close()
+    assert not (tmp_path / 'database.csv.wal').read_bytes()
+    assert sorted(make_engine().database['statement']) == ['first', 'second']
@@ -0,0 +1,150 @@
+import multiprocessing
+import threading
+import time
+
+from jobs import (CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobCommitter, JobQueue, JobWorker, commit_finished,
+                  run_worker_processes)
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(str(tmp_path / 'jobs.sqlite'), **kwargs)
+
+
+def test_claim_leases_the_tasks_in_order(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.submit(['a', 'b', 'c'], 'user', user_scores=[1, None, 3], settings={'resample': True})
+
+    claim = queue.claim('worker', 2)
+    assert claim.job_id == job_id
+    assert claim.user == 'user'
+    assert claim.settings == {'resample': True}
+    assert [(task.position, task.statement, task.user_score) for task in claim.tasks] == [(0, 'a', 1.0),
+                                                                                         (1, 'b', None)]
+    assert [task.position for task in queue.claim('worker', 2).tasks] == [2]
+    assert queue.claim('worker', 2) is None
+
+    status = queue.status(job_id)
+    assert status['status'] == RUNNING
+    assert status['n_running'] == 3
+
+
+def test_failed_tasks_are_retried_up_to_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    job_id = queue.submit(['a'], 'user')
+
+    queue.fail(job_id, [queue.claim('worker', 1).tasks[0].position], 'RateLimitError')
+    assert queue.status(job_id)['n_queued'] == 1
+
+    queue.fail(job_id, [queue.claim('worker', 1).tasks[0].position], 'RateLimitError')
+    status = queue.status(job_id)
+    assert status['n_failed'] == 1
+    assert status['status'] == DONE
+    assert queue.claim('worker', 1) is None
+
+
+def test_expired_lease_goes_back_to_the_queue(tmp_path):
+    queue = make_queue(tmp_path, lease=0.05)
+    job_id = queue.submit(['a'], 'user')
+
+    assert queue.claim('dead worker', 1) is not None
+    assert queue.claim('worker', 1) is None
+    time.sleep(0.1)
+    claim = queue.claim('worker', 1)
+    assert claim.job_id == job_id
+
+    # The dead worker's results are ignored once the task is completed by the other one
+    queue.complete(job_id, {0: ('a', 12.0)})
+    assert queue.status(job_id)['status'] == DONE
+
+
+def test_cancel_leaves_the_running_tasks(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.submit(['a', 'b'], 'user')
+    queue.claim('worker', 1)
+    queue.cancel(job_id)
+
+    status = queue.status(job_id)
+    assert status['status'] == CANCELLED
+    assert (status['n_running'], status['n_cancelled'], status[f'n_{QUEUED}']) == (1, 1, 0)
+
+
+def test_worker_grades_and_commits_a_job(tmp_path, make_engine):
+    engine = make_engine()
+    queue = make_queue(tmp_path)
+    statements = [f'- Led {i} Amn through mission {i}; saved {i} hrs' for i in range(5)]
+    job_id = queue.submit(statements, 'user', settings=engine.new_session().settings())
+
+    worker = JobWorker(engine, queue, batch_size=2, commit=False)
+    while worker.run_once():
+        pass
+    results = queue.results(job_id)
+    assert [s[0] for s in results] == statements
+    assert all(s[1] is not None for s in results)
+    assert queue.status(job_id)[f'n_{DONE}'] == 5
+
+    assert commit_finished(engine, queue) == 5
+    assert commit_finished(engine, queue) == 0
+    assert engine.database_size() == 5
+    assert queue.status(job_id)[f'n_{FAILED}'] == 0
+
+
+def test_worker_processes_leave_the_commits_to_the_committer(tmp_path, fake_llm, make_engine):
+    engine = make_engine()
+    assert engine.database_size() == 0
+    queue = make_queue(tmp_path)
+    statements = [f'- Led {i} Amn through mission {i}; saved {i} hrs' for i in range(4)]
+    job_id = queue.submit(statements, 'user', settings=engine.new_session().settings())
+
+    engine_arguments = dict(api_key='fake', api_base=fake_llm.url, database_file_path=str(tmp_path / 'database.csv'),
+                            lookup_file_path=str(tmp_path / 'lookup.csv'), cache_file_path=None)
+    stop_event = multiprocessing.get_context('spawn').Event()
+    workers = threading.Thread(target=run_worker_processes, args=(queue.file_path, engine_arguments),
+                               kwargs=dict(n_processes=1, poll_interval=0.1, stop_event=stop_event))
+    workers.start()
+    try:
+        deadline = time.monotonic() + 60
+        while queue.status(job_id)['status'] != DONE and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        stop_event.set()
+        workers.join()
+    assert queue.status(job_id)[f'n_{DONE}'] == 4
+    # Nothing is committed until the committer runs
+    assert engine.database_size() == 0
+
+    committer = JobCommitter(engine, queue, poll_interval=0.1).start()
+    committer.stop()
+    assert sorted(engine.database['statement']) == sorted(statements)
+
+
+def graded_job(tmp_path, engine, n=3):
+    queue = make_queue(tmp_path)
+    statements = [f'- Led {i} Amn through mission {i}; saved {i} hrs' for i in range(n)]
+    queue.submit(statements, 'user', settings=engine.new_session().settings())
+    worker = JobWorker(engine, queue, commit=False)
+    while worker.run_once():
+        pass
+    return queue
+
+
+def test_commit_interrupted_before_the_insert(tmp_path, make_engine):
+    engine = make_engine()
+    queue = graded_job(tmp_path, engine)
+    # The process dies after taking the statements from the queue
+    queue.take_uncommitted()
+
+    assert commit_finished(engine, queue) == 3
+    assert engine.database_size() == 3
+    assert commit_finished(engine, queue) == 0
+
+
+def test_commit_interrupted_after_the_insert(tmp_path, make_engine):
+    engine = make_engine()
+    queue = graded_job(tmp_path, engine)
+    # The process dies once the statements are in the database, before they are marked committed
+    _, statement_tuples, _ = queue.take_uncommitted()
+    engine.insert_evaluations(statement_tuples)
+
+    assert commit_finished(engine, queue) == 3
+    assert engine.database_size() == 3
+    assert commit_finished(engine, queue) == 0
@@ -0,0 +1,94 @@
+import re
+
+import pytest
+
+from engine import StatementPostprocessor, StreamingResultParser
+from fake_llm import canned_reply
+from prompts import examples
+
+# The parsing of the baseline: one regex per field
+BASELINE_SCORE_PATTERN = r'Total Score: (\d+(\.\d+)?)/20'
+BASELINE_EXPLANATION_PATTERN = r'(.*)(?=Total Score:)'
+
+
+def baseline_score(result):
+    match = re.search(BASELINE_SCORE_PATTERN, result)
+    return float(match.group(1)) if match else None
+
+
+def baseline_explanation(result):
+    match = re.search(BASELINE_EXPLANATION_PATTERN, result, re.DOTALL)
+    return match.group(1).strip() if match else None
+
+
+RESULTS = [answer for _, answer in examples] + [canned_reply(f'statement {i}') for i in range(20)]
+
+
+@pytest.mark.parametrize('result', RESULTS)
+def test_parse_result_matches_the_baseline(result):
+    parsed = StatementPostprocessor().parse_result(result)
+    assert parsed.score == baseline_score(result)
+    assert parsed.explanation == baseline_explanation(result)
+
+
+def test_criteria_scores():
+    # The scores of the canned replies add up, unlike some of the examples'
+    for i in range(20):
+        parsed = StatementPostprocessor().parse_result(canned_reply(f'statement {i}'))
+        assert None not in parsed.sub_scores.values()
+        assert sum(parsed.sub_scores.values()) == parsed.score
+
+
+def test_json_result_is_parsed_like_its_text():
+    text = StatementPostprocessor().parse_result(canned_reply('statement'))
+    parsed = StatementPostprocessor().parse_result(canned_reply('statement', output_format='json'))
+    assert parsed.score == text.score
+    assert parsed.sub_scores == text.sub_scores
+
+
+def test_result_without_score():
+    parsed = StatementPostprocessor().parse_result('I cannot grade this statement.')
+    assert parsed.score is None
+
+
+@pytest.mark.parametrize('piece_length', [1, 3, 7, 50])
+def test_streaming_parser_matches_the_final_parser(piece_length):
+    postprocessor = StatementPostprocessor()
+    for result in RESULTS:
+        parser = StreamingResultParser(postprocessor)
+        for i in range(0, len(result), piece_length):
+            parser.feed(result[i:i + piece_length])
+        assert parser.result == result
+        assert parser.score == postprocessor.parse_result(result).score
+
+
+@pytest.mark.parametrize('total', ['Total Score: 14/20', 'total score: 14/20', 'TOTAL SCORE:14 / 20'])
+def test_streaming_parser_finds_the_score_as_the_final_parser(total):
+    result = f'- Action: Led the team.\nScore: 4/5\n\n{total}\n'
+    parser = StreamingResultParser(StatementPostprocessor())
+    for i in range(0, len(result), 5):
+        parser.feed(result[i:i + 5])
+    assert parser.score == StatementPostprocessor().parse_result(result).score == 14
+    assert parser.justification() == '- Action: Led the team.\nScore: 4/5'
+
+
+def test_the_last_total_score_wins():
+    result = '- Action: Led the team.\nScore: 4/5\n\nTotal Score: 12/20\n\nOn second thought:\nTotal Score: 14/20\n'
+    parsed = StatementPostprocessor().parse_result(result)
+    assert parsed.score == StatementPostprocessor().extract_score_from_result(result) == 14
+    assert parsed.explanation == baseline_explanation(result)
+
+
+@pytest.mark.parametrize('whitespace', ['', ' ' * 100, '\n' * 40])
+def test_streaming_parser_finds_a_score_split_inside_its_label(whitespace):
+    result = f'- Action: Led the team.\nScore: 4/5\n\nTotal Score:{whitespace} 14 /{whitespace}20\n'
+    start = result.index('Total Score')
+    postprocessor = StatementPostprocessor()
+    for split in range(start + 1, len(result)):
+        parser = StreamingResultParser(postprocessor)
+        parser.feed(result[:split])
+        for i in range(split, len(result), 7):
+            parser.feed(result[i:i + 7])
+        parser.finish()
+        assert parser.score == postprocessor.parse_result(result).score == 14
+        assert parser.justification() == '- Action: Led the team.\nScore: 4/5'
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from backends import OpenAICompatibleBackend, RetryableBackendError
+from fake_llm import FakeLLMServer
+from scheduler import BATCH, INTERACTIVE, RequestScheduler
+
+PARAMETERS = {'engine': 'gpt-3.5-turbo', 'temperature': 0.7, 'top_p': 1.0, 'presence_penalty': 0.0,
+              'frequency_penalty': 0.0, 'stop': None}
+
+
+def chat(backend, statement):
+    def request(timeout):
+        return backend.chat([{'role': 'user', 'content': statement}], PARAMETERS, 100, timeout=timeout)
+    return request
+
+
+def make_scheduler(**kwargs):
+    arguments = dict(requests_per_minute=None, tokens_per_minute=None, max_workers=1, base_delay=0.01)
+    arguments.update(kwargs)
+    return RequestScheduler(**arguments)
+
+
+def test_rate_limited_requests_are_retried():
+    with FakeLLMServer(latency=0.0, error_rate=0.5, error_status=429) as server:
+        backend = OpenAICompatibleBackend(server.url)
+        scheduler = make_scheduler(max_workers=4, max_retries=20)
+        futures = [scheduler.submit(chat(backend, f'statement {i}'), 100) for i in range(20)]
+        responses = [future.result(timeout=10) for future in futures]
+
+    assert all('Total Score' in r['choices'][0]['message']['content'] for r in responses)
+    assert server.n_errors > 0
+    assert server.n_requests == 20 + server.n_errors
+
+
+def test_requests_give_up_after_max_retries():
+    with FakeLLMServer(latency=0.0, error_rate=1.0, error_status=500) as server:
+        scheduler = make_scheduler(max_retries=2)
+        future = scheduler.submit(chat(OpenAICompatibleBackend(server.url), 'statement'), 100)
+        with pytest.raises(RetryableBackendError):
+            future.result(timeout=10)
+    assert server.n_requests == 3
+
+
+def test_backoff_does_not_hold_the_workers(fake_llm):
+    backend = OpenAICompatibleBackend(fake_llm.url)
+    scheduler = make_scheduler(max_workers=1)
+    completed = []
+
+    def rate_limited_once(timeout, attempts=[]):
+        if not attempts:
+            attempts.append(timeout)
+            raise RetryableBackendError('Rate limited.', headers={'retry-after': '0.5'})
+        completed.append(BATCH)
+        return chat(backend, 'batch')(timeout)
+
+    def interactive(timeout):
+        completed.append(INTERACTIVE)
+        return chat(backend, 'interactive')(timeout)
+
+    start = time.monotonic()
+    batch_future = scheduler.submit(rate_limited_once, 100, priority=BATCH)
+    time.sleep(0.1)
+    scheduler.submit(interactive, 100, priority=INTERACTIVE).result(timeout=10)
+    # Served while the batch request backs off on the only worker
+    assert time.monotonic() - start < 0.4
+    batch_future.result(timeout=10)
+    assert completed == [INTERACTIVE, BATCH]
+
+
+def test_interactive_requests_go_first(fake_llm):
+    backend = OpenAICompatibleBackend(fake_llm.url)
+    scheduler = make_scheduler(max_workers=1)
+    release = threading.Event()
+    completed = []
+
+    def blocking(timeout):
+        release.wait()
+        return chat(backend, 'blocking')(timeout)
+
+    def recorded(name):
+        def request(timeout):
+            completed.append(name)
+            return chat(backend, name)(timeout)
+        return request
+
+    scheduler.submit(blocking, 100)
+    futures = [scheduler.submit(recorded(f'batch {i}'), 100, priority=BATCH) for i in range(3)]
+    futures += [scheduler.submit(recorded(f'interactive {i}'), 100, priority=INTERACTIVE) for i in range(2)]
+    release.set()
+    for future in futures:
+        future.result(timeout=10)
+    assert completed == ['interactive 0', 'interactive 1', 'batch 0', 'batch 1', 'batch 2']
+
+
+def test_tokens_per_minute_limit(fake_llm):
+    backend = OpenAICompatibleBackend(fake_llm.url)
+    # 100 tokens per second, starting from an empty bucket
+    scheduler = make_scheduler(max_workers=4, tokens_per_minute=6000)
+    scheduler._token_bucket.reserve(6000)
+
+    start = time.monotonic()
+    futures = [scheduler.submit(chat(backend, f'statement {i}'), 20) for i in range(5)]
+    for future in futures:
+        future.result(timeout=10)
+    assert time.monotonic() - start >= 0.9
+
+
+def test_deadline_exceeded_while_rate_limited(fake_llm):
+    scheduler = make_scheduler(requests_per_minute=60)
+    scheduler._request_bucket.reserve(60)
+    future = scheduler.submit(chat(OpenAICompatibleBackend(fake_llm.url), 'statement'), 100,
+                              deadline=time.monotonic() + 0.5)
+    with pytest.raises(TimeoutError):
+        future.result(timeout=10)
@@ -0,0 +1,39 @@
+import pytest
+
+from service import EngineService, RemoteEngine, ServiceError
+from test_engine import statement_tuple
+
+
+@pytest.fixture
+def service(make_engine):
+    with EngineService(make_engine(), port=0) as service:
+        yield service
+
+
+def test_remote_session_grades_and_commits(service):
+    remote = RemoteEngine(service.url)
+    session = remote.new_session()
+    evaluation = session.extract_evaluation('- Led 5 Amn; saved 10 hrs', 'user', 12)
+    assert evaluation[1] is not None
+    session.commit()
+
+    assert remote.database_size() == 1
+    results = remote.search('Led')
+    assert list(results['statement']) == ['- Led 5 Amn; saved 10 hrs']
+    assert results['datetime'].iloc[0] == evaluation[9]
+
+
+def test_export_is_streamed(service, make_engine):
+    remote = RemoteEngine(service.url)
+    remote.insert_evaluations([statement_tuple(f'statement {i}') for i in range(50)])
+
+    with remote.export('csv', chunk_size=7) as file:
+        exported = file.read()
+    with service.engine.export('csv', chunk_size=7) as file:
+        assert exported == file.read()
+    assert exported.count(b'\n') == 51
+
+
+def test_errors_are_raised_by_the_client(service):
+    with pytest.raises(ServiceError):
+        RemoteEngine(service.url)._call('nowhere')
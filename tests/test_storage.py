@@ -0,0 +1,56 @@
+import os
+
+import pandas as pd
+
+from prompts import award_dict
+from storage import DATABASE_COLUMNS, CSVStore, PriorityLookup
+
+
+def rows(n, offset=0):
+    return pd.DataFrame([[f'statement {i}', 10.0] + [None] * (len(DATABASE_COLUMNS) - 2)
+                         for i in range(offset, offset + n)], columns=DATABASE_COLUMNS)
+
+
+def test_append_is_read_back(tmp_path):
+    store = CSVStore(str(tmp_path / 'database.csv'))
+    store.load()
+    assert store.append(rows(3))
+    assert store.append(rows(2, offset=3))
+    assert list(CSVStore(store.file_path).load()['statement']) == [f'statement {i}' for i in range(5)]
+
+
+def test_interrupted_append_is_cut_off(tmp_path):
+    store = CSVStore(str(tmp_path / 'database.csv'))
+    store.load()
+    store.append(rows(3))
+
+    # A crash in the middle of an append: the marker holds the size before it, and half a row was written
+    with open(f'{store.file_path}.appending', 'w') as f:
+        f.write(str(os.path.getsize(store.file_path)))
+    with open(store.file_path, 'a') as f:
+        f.write('statement 3,1')
+
+    database = CSVStore(store.file_path).load()
+    assert list(database['statement']) == [f'statement {i}' for i in range(3)]
+    assert not os.path.exists(f'{store.file_path}.appending')
+
+
+def test_append_of_unknown_columns_asks_for_compaction(tmp_path):
+    store = CSVStore(str(tmp_path / 'database.csv'))
+    store.load()
+    assert not store.append(rows(1).assign(unknown=1))
+
+
+def test_keys_without_text_are_kept(tmp_path):
+    lookup = PriorityLookup(str(tmp_path / 'lookup.csv'))
+    database = pd.DataFrame({'award': ['N/A', 'Performer of the Month', award_dict['Performer of the Month']],
+                             'tier': ['N/A', 'Amn', 'N/A'], 'wg': ['N/A'] * 3, 'sq': ['N/A'] * 3})
+    normalized, n_replaced = lookup.normalize(database)
+    assert n_replaced == 1
+    assert list(normalized['award']) == ['N/A', 'Performer of the Month', 'Performer of the Month']
+    assert list(normalized['wg']) == ['N/A'] * 3
+
+
+def test_read_only_lookup_is_not_written(tmp_path):
+    PriorityLookup(str(tmp_path / 'lookup.csv'), read_only=True).key('award', 'A new award.')
+    assert not (tmp_path / 'lookup.csv').exists()
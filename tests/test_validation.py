@@ -0,0 +1,33 @@
+import pytest
+
+from validation import StatementValidator
+
+
+@pytest.mark.parametrize('statement', [
+    'Led 12 Amn in daily ops; 100% mission success',
+    '- Managed flight of 6; zero mishaps',
+    'Supervising 3 Amn; on-time rate up to 98%',
+    'Leads 12 Amn in daily ops; 100% mission success',
+    'Manages flight of 6; zero mishaps',
+    '- Supervises 3 Amn; on-time rate up to 98%',
+])
+def test_past_and_present_tense_actions(statement):
+    validation = StatementValidator().validate(statement)
+    assert validation.valid
+    assert validation.warnings == []
+
+
+def test_missing_action_is_only_a_warning():
+    validation = StatementValidator().validate('A flight of 6 people; zero mishaps')
+    assert validation.valid
+    assert any('No action' in warning for warning in validation.warnings)
+
+
+def test_missing_result_is_an_error():
+    validation = StatementValidator().validate('Led the flight through the exercise')
+    assert not validation.valid
+
+
+def test_several_statements_are_an_error():
+    validation = StatementValidator().validate('- Led 5 Amn; saved 10 hrs\n- Managed 6 Amn; saved 20 hrs')
+    assert not validation.valid
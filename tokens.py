@@ -0,0 +1,117 @@
+import functools
+import logging
+import math
+
+from prompts import SYSTEM, OVERVIEW, ALQ, tier_dict, award_dict, sq_pri_dict, wg_pri_dict, examples
+
+# tiktoken is optional: without it, token counts are estimated from the number of characters
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+MODEL_CONTEXT_WINDOWS = {'gpt-3.5-turbo': 4096,
+                         'gpt-3.5-turbo-16k': 16384,
+                         'gpt-4': 8192,
+                         'gpt-4-32k': 32768}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Tokens the chat format adds around each message and before the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# Never trim the completion below this many tokens, a grade needs room for the justification
+MIN_COMPLETION_TOKENS = 300
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # tiktoken downloads its vocabularies on first use, which fails on hosts without network access
+        logging.warning(f'Could not load the tokenizer for {model}, token counts will be estimated: {e}')
+        return None
+
+
+def count_tokens(text, model='gpt-3.5-turbo'):
+    """
+    Number of tokens of the text for the model, or an estimate (~4 characters per token) if the tokenizer
+    is not available.
+    """
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model='gpt-3.5-turbo'):
+    """
+    Number of prompt tokens of a chat message list, including the chat format overhead.
+    """
+    n_tokens = REPLY_OVERHEAD
+    for message in messages:
+        n_tokens += MESSAGE_OVERHEAD + count_tokens(message['content'], model)
+        if 'name' in message:
+            n_tokens += count_tokens(message['name'], model)
+    return n_tokens
+
+
+def context_window(model):
+    for name in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_CONTEXT_WINDOWS[name]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+@functools.lru_cache(maxsize=None)
+def prompt_section_tokens(model='gpt-3.5-turbo'):
+    """
+    Number of tokens of each section of the prompts: SYSTEM, OVERVIEW, ALQ, every tier, award, squadron and wing
+    entry (as 'tier:<key>', etc.), and every example (as 'example_<i>', input and output together).
+    """
+    sections = {'SYSTEM': count_tokens(SYSTEM, model),
+                'OVERVIEW': count_tokens(OVERVIEW, model),
+                'ALQ': count_tokens(ALQ, model)}
+    for dimension, dictionary in (('tier', tier_dict), ('award', award_dict),
+                                  ('sq', sq_pri_dict), ('wg', wg_pri_dict)):
+        for key, text in dictionary.items():
+            # 'N/A' entries have no text
+            sections[f'{dimension}:{key}'] = count_tokens(text, model) if text is not None else 0
+    for i, (example_input, example_output) in enumerate(examples):
+        sections[f'example_{i + 1}'] = count_tokens(example_input, model) + count_tokens(example_output, model)
+    return sections
+
+
+def fit_to_context(messages, max_tokens, model='gpt-3.5-turbo'):
+    """
+    Makes sure the prompt and the completion fit in the context window of the model. The completion budget
+    (max_tokens) is trimmed first, down to MIN_COMPLETION_TOKENS, then the few-shot examples are dropped, the
+    last ones first. Returns the (possibly trimmed) messages and max_tokens, or raises a ValueError if the prompt
+    still does not fit.
+    """
+    window = context_window(model)
+    prompt_tokens = count_message_tokens(messages, model)
+    if prompt_tokens + max_tokens <= window:
+        return messages, max_tokens
+
+    messages = list(messages)
+    while prompt_tokens + MIN_COMPLETION_TOKENS > window:
+        example_indices = [i for i, m in enumerate(messages) if m.get('name', '').startswith('example_')]
+        if not example_indices:
+            raise ValueError(f'Prompt of {prompt_tokens} tokens does not fit in the {window} tokens '
+                             f'context window of {model}.')
+        # Drop the last example pair (user and assistant messages)
+        for i in reversed(example_indices[-2:]):
+            del messages[i]
+        prompt_tokens = count_message_tokens(messages, model)
+
+    trimmed_max_tokens = min(max_tokens, window - prompt_tokens)
+    logging.info(f'Trimmed prompt to {prompt_tokens} tokens and completion to {trimmed_max_tokens} tokens '
+                 f'to fit the {window} tokens context window of {model}.')
+    return messages, trimmed_max_tokens
@@ -0,0 +1,107 @@
+import logging
+import re
+from collections import namedtuple
+
+from prompts import APPROVED_ACRONYMS
+
+# Rule-based checks of the OVERVIEW rules of prompts.py, run before spending a GPT request on a statement. The
+# patterns are compiled once, at import. Errors are statements that cannot be graded (no impact or result, several
+# statements at once); warnings are rule breaks GPT will only take points off for, and what the heuristics cannot
+# tell for sure (no action found).
+
+MIN_WORDS = 4
+
+# Past tense verbs (regular and the common irregular ones) and present participles: the action of the statement
+ACTION_PATTERN = re.compile(
+    r'\b(?:[a-z]{2,}(?:ed|ing)|led|built|wrote|ran|drove|taught|won|made|oversaw|kept|sent|spent|sold|held|met|'
+    r'brought|fought|gave|took|flew|did|set|cut|put|began|chose|drew|grew|caught|found|forged|spearheaded)\b',
+    re.IGNORECASE)
+
+# A statement in the present tense starts with its verb, e.g., "Leads 12 Amn..." or "- Supervises 3 Amn..."
+PRESENT_ACTION_PATTERN = re.compile(r'^\s*(?:[-*•]\s*)?[A-Z][a-z]+s\b')
+
+# Numbers, money, percentages, the usual result verbs, and the separators between an action and its impact
+RESULT_PATTERN = re.compile(
+    r'\d|%|\$|;|///|--|—|'
+    r'\b(?:sav|cut|reduc|increas|improv|enabl|ensur|boost|result|yield|garner|earn|secur|deliver|support|enhanc|'
+    r'bolster|expand|accelerat|streamlin|prevent|protect|advanc|rais|lower|decreas|eliminat|recoup|generat|'
+    r'spark|propel|fuel|posture|driv|drove|lead to|led to|allow|contribut|strengthen|optimiz|maximiz|minimiz|'
+    r'award|recogniz|lauded|selected|ranked)\w*',
+    re.IGNORECASE)
+
+# Two or more capital letters in a word, e.g., ISR, DoD or TSgt
+ACRONYM_PATTERN = re.compile(r'(?<![A-Za-z0-9&])[A-Z][A-Za-z0-9&]*[A-Z][A-Za-z0-9&]*(?![A-Za-z0-9&])')
+
+# An acronym defined in the statement, e.g., Analysis Exploitation Teams (AET)
+DEFINED_ACRONYM_PATTERN = re.compile(r'\(([A-Z][A-Za-z0-9&]*?)s?\)')
+
+# End of a sentence: a period, exclamation or question mark followed by a capitalized word. Abbreviations with a
+# period (Lt., e.g., U.S.) are not sentence ends.
+SENTENCE_END_PATTERN = re.compile(r'(?<!\b[A-Z])(?<!\bLt)(?<!\bCol)(?<!\bGen)(?<!\bMaj)(?<!\bCapt)(?<!\bvs)'
+                                  r'(?<!\be\.g)(?<!\bi\.e)[.!?]\s+(?=[A-Z])')
+
+# A bullet at the start of a line: several of them are several statements
+BULLET_PATTERN = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s+', re.MULTILINE)
+
+WORD_PATTERN = re.compile(r"[A-Za-z0-9][\w'&/-]*")
+
+ValidationResult = namedtuple('ValidationResult', ['valid', 'errors', 'warnings'])
+
+
+class StatementValidator:
+    """
+    Checks a statement against the rules of a performance statement before it is sent to GPT: it is a single,
+    standalone sentence, with an action and an impact or result, and only uses approved acronyms (or ones it
+    defines). Takes microseconds, so the user gets instant feedback instead of a failed GPT evaluation.
+    """
+
+    def __init__(self, approved_acronyms=APPROVED_ACRONYMS):
+        self.approved_acronyms = frozenset(approved_acronyms)
+
+    def validate(self, statement):
+        """
+        Returns a ValidationResult: whether the statement can be graded, and the errors and warnings found.
+        """
+        errors, warnings = [], []
+        statement = statement.strip() if statement is not None else ''
+
+        words = WORD_PATTERN.findall(statement)
+        if len(words) < MIN_WORDS:
+            errors.append(f'Too short: a performance statement has at least {MIN_WORDS} words.')
+            return ValidationResult(False, errors, warnings)
+
+        if len(BULLET_PATTERN.findall(statement)) > 1:
+            errors.append('Several statements: grade them one at a time.')
+
+        # The verbs are only guessed from their endings, so a statement without any is still graded
+        if ACTION_PATTERN.search(statement) is None and PRESENT_ACTION_PATTERN.match(statement) is None:
+            warnings.append('No action found: start with what was done, e.g., "Led 5 Amn..." or "Leads 5 Amn..."')
+        if RESULT_PATTERN.search(statement) is None:
+            errors.append('No impact or result: say what the action achieved, e.g., "...; saved 20 hrs".')
+
+        n_sentences = len(SENTENCE_END_PATTERN.findall(statement.rstrip('.!? '))) + 1
+        if n_sentences > 1:
+            warnings.append(f'Not a standalone sentence: {n_sentences} sentences.')
+
+        unapproved = self.unapproved_acronyms(statement)
+        if unapproved:
+            warnings.append(f'Acronyms not on the approved list: {", ".join(unapproved)}.')
+
+        if errors:
+            logging.info(f'Invalid statement {statement!r}: {errors}')
+        return ValidationResult(not errors, errors, warnings)
+
+    def unapproved_acronyms(self, statement):
+        """
+        The acronyms of the statement that are neither approved nor defined in it, in order of appearance.
+        """
+        defined = set(DEFINED_ACRONYM_PATTERN.findall(statement))
+        unapproved = []
+        for acronym in ACRONYM_PATTERN.findall(statement):
+            # Plurals, e.g., NCOs
+            singular = acronym[:-1] if acronym.endswith('s') else acronym
+            if acronym in self.approved_acronyms or singular in self.approved_acronyms or singular in defined:
+                continue
+            if acronym not in unapproved:
+                unapproved.append(acronym)
+        return unapproved
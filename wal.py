@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import threading
+import zlib
+
+from codec import dumps
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows: the log is then not protected against a second engine
+    fcntl = None
+
+
+class WriteAheadLogLocked(Exception):
+    """
+    The write-ahead log is used by another engine, e.g., of another process.
+    """
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the commits to the evaluation database. A commit is a single line (a checksum and the JSON
+    list of its statement tuples) appended to the file and fsynced before the commit returns, so its cost does not
+    depend on the size of the database, and a commit that returned survives a crash. The engine writes the commits
+    to the database file later (a checkpoint) and then drops them from the log; after a crash, the commits still in
+    the log are replayed. A line cut short by a crash fails its checksum and is ignored: that commit never returned.
+
+    Only one engine can use a log at a time: it holds an exclusive lock on the file while it is open.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.n_records = 0
+
+        self._lock = threading.Lock()
+        self._file = self._open()
+
+    def _open(self):
+        while True:
+            file = open(self.file_path, 'ab')
+            if fcntl is None:
+                return file
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                file.close()
+                raise WriteAheadLogLocked(f'{self.file_path} is held by another engine (e.g., of the app, the engine '
+                                          f'service or a command): the database can only have one writer.') from None
+            # The log may have been replaced (see truncate) between the open and the lock
+            try:
+                if os.stat(self.file_path).st_ino == os.fstat(file.fileno()).st_ino:
+                    return file
+            except FileNotFoundError:
+                pass
+            file.close()
+
+    def append(self, rows):
+        """
+        Appends a record (a list of JSON serializable rows, e.g., statement tuples) and waits until it is on disk.
+        """
+        payload = dumps(list(rows)).encode('utf-8')
+        line = b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.n_records += 1
+
+    def records(self):
+        """
+        The records of the log, in order, as lists of rows (with the times as ISO strings). Stops at the first
+        record that is incomplete or corrupted.
+        """
+        records = []
+        with self._lock, open(self.file_path, 'rb') as f:
+            for line in f:
+                checksum, _, payload = line.rstrip(b'\n').partition(b' ')
+                try:
+                    valid = line.endswith(b'\n') and int(checksum, 16) == zlib.crc32(payload)
+                except ValueError:
+                    valid = False
+                if not valid:
+                    logging.warning(f'Ignoring the end of {self.file_path} from record {len(records)}: incomplete '
+                                    f'or corrupted.')
+                    break
+                records.append(json.loads(payload))
+        return records
+
+    def truncate(self, n_records=None):
+        """
+        Drops the first n_records records of the log (all of them by default), once they are safely in the
+        database file.
+        """
+        with self._lock:
+            if n_records is None or n_records >= self.n_records:
+                self._file.truncate(0)
+                os.fsync(self._file.fileno())
+                self.n_records = 0
+                return
+            if n_records <= 0:
+                return
+
+            # The records appended since are copied to a new log, locked before it replaces this one
+            with open(self.file_path, 'rb') as f:
+                kept = f.readlines()[n_records:]
+            temporary_path = f'{self.file_path}.tmp'
+            file = open(temporary_path, 'ab')
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            file.truncate(0)
+            file.writelines(kept)
+            file.flush()
+            os.fsync(file.fileno())
+            os.replace(temporary_path, self.file_path)
+            self._file.close()
+            self._file = file
+            self.n_records -= n_records
+
+    def close(self):
+        with self._lock:
+            self._file.close()